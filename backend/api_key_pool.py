@@ -0,0 +1,830 @@
+import os
+import json
+import time
+import logging
+import atexit
+import tempfile
+import random
+import itertools
+import threading
+import collections
+from datetime import datetime
+from typing import NamedTuple, Tuple, Dict
+
+from key_pool_state import SqliteKeyPoolState
+from metrics import KEY_ROTATIONS, key_label
+from logging_setup import sampled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KEY_RPM = int(os.getenv('GEMINI_KEY_RPM', '15'))
+DEFAULT_KEY_RPD = int(os.getenv('GEMINI_KEY_RPD', '1500'))
+KEY_BREAKER_BASE_COOLDOWN = float(os.getenv('KEY_BREAKER_BASE_COOLDOWN', '5'))
+KEY_BREAKER_MAX_COOLDOWN = float(os.getenv('KEY_BREAKER_MAX_COOLDOWN', '300'))
+KEY_BREAKER_MAX_EXPONENT = 16  # failures beyond this stop doubling the cooldown
+KEY_BREAKER_PROBE_TIMEOUT = float(os.getenv('KEY_BREAKER_PROBE_TIMEOUT', '60'))
+KEY_POOL_FLUSH_INTERVAL = float(os.getenv('KEY_POOL_FLUSH_INTERVAL', '2'))
+KEY_POOL_SHARED_STATE_DB = os.getenv('KEY_POOL_SHARED_STATE_DB', '')
+
+
+class _UsageCounter:
+    """Per-key usage counter
+
+    Increments are serialized by the counter's own lock, so no update is lost
+    whichever thread makes it; reading value is a plain attribute load.
+    """
+    __slots__ = ('value', 'flushed', '_lock')
+
+    def __init__(self, start=0):
+        self.value = start
+        self.flushed = start  # value already folded into shared state
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self.value += 1
+            return self.value
+
+
+class _TokenBucket:
+    """Continuously refilling token bucket
+
+    tokens() is a lock-free, possibly slightly stale read used for ranking;
+    try_take() is exact and serialized by the bucket's own lock.
+    """
+    __slots__ = ('capacity', 'refill_per_second', '_tokens', '_updated', '_lock')
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def tokens(self, now):
+        return min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_second)
+
+    def try_take(self, now):
+        with self._lock:
+            self._tokens = self.tokens(now)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def give_back(self, now):
+        with self._lock:
+            self._tokens = min(self.capacity, self.tokens(now) + 1)
+            self._updated = now
+
+    def drain(self, now):
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = now
+
+
+class _KeyQuota:
+    """Per-key requests-per-minute and requests-per-day buckets"""
+    __slots__ = ('rpm', 'rpd', 'per_minute', 'per_day')
+
+    def __init__(self, rpm=None, rpd=None):
+        self.rpm = int(rpm or DEFAULT_KEY_RPM)
+        self.rpd = int(rpd or DEFAULT_KEY_RPD)
+        self.per_minute = _TokenBucket(self.rpm, self.rpm / 60.0)
+        self.per_day = _TokenBucket(self.rpd, self.rpd / 86400.0)
+
+    def remaining(self, now):
+        """Requests this key can make right now before hitting either limit"""
+        return min(self.per_minute.tokens(now), self.per_day.tokens(now))
+
+    def try_take(self, now):
+        if not self.per_day.try_take(now):
+            return False
+        if not self.per_minute.try_take(now):
+            self.per_day.give_back(now)
+            return False
+        return True
+
+    def exhaust(self, now):
+        """Upstream said this key is throttled; stop scheduling it until the minute bucket refills"""
+        self.per_minute.drain(now)
+
+
+class _KeyBreaker:
+    """Closed/open/half-open circuit breaker for one key
+
+    A throttled key opens for a jittered, exponentially growing cooldown. Once
+    the cooldown expires a single half-open probe request is let through; its
+    success closes the breaker, another throttle re-opens it for longer.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    __slots__ = ('state', 'failures', 'open_until', 'probe_started', '_lock')
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_started = None
+        self._lock = threading.Lock()
+
+    def allows(self, now):
+        """Lock-free check whether the key may be scheduled at all"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return now >= self.open_until
+        probe_started = self.probe_started
+        return probe_started is None or now - probe_started >= KEY_BREAKER_PROBE_TIMEOUT
+
+    def try_acquire(self, now):
+        """Admit a request; for a non-closed breaker this claims the single probe slot"""
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if not self.allows(now):
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started = now
+            return True
+
+    def release(self):
+        """Give back an unused probe slot"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.probe_started = None
+
+    def record_success(self):
+        """Close the breaker; returns True if that was a state change"""
+        if self.state == self.CLOSED and self.failures == 0:
+            return False
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_started = None
+        return True
+
+    def record_failure(self, now):
+        """Open the breaker; returns True if that was a state change
+
+        Throttles reported while the breaker is already open come from requests
+        admitted before it opened, so they neither count as another failure nor
+        lengthen the cooldown.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return False
+            self.failures += 1
+            exponent = min(self.failures, KEY_BREAKER_MAX_EXPONENT) - 1
+            cooldown = min(KEY_BREAKER_MAX_COOLDOWN, KEY_BREAKER_BASE_COOLDOWN * 2 ** exponent)
+            # Equal jitter keeps at least half the cooldown while de-synchronizing workers
+            self.open_until = now + random.uniform(cooldown / 2, cooldown)
+            self.state = self.OPEN
+            self.probe_started = None
+            return True
+
+    def apply_shared(self, failures, open_until, now):
+        """Adopt a breaker transition another worker recorded in shared state"""
+        with self._lock:
+            if failures == 0:
+                if self.state != self.CLOSED or self.failures:
+                    self.state = self.CLOSED
+                    self.failures = 0
+                    self.probe_started = None
+            elif open_until > now and (self.state != self.OPEN or open_until > self.open_until):
+                self.state = self.OPEN
+                self.failures = max(self.failures, failures)
+                self.open_until = open_until
+                self.probe_started = None
+
+
+class _PoolSnapshot(NamedTuple):
+    """Immutable view of the pool; replaced wholesale on every rotation or update"""
+    keys: Tuple[str, ...]
+    index: int
+    usage: Dict[str, _UsageCounter]
+    quotas: Dict[str, _KeyQuota]
+    breakers: Dict[str, _KeyBreaker]
+
+
+class _WriteBehindPersister:
+    """Coalesces pool state changes and flushes them to disk off the request path
+
+    mark_dirty() only sets an event. A daemon thread waits for it, lets further
+    changes accumulate for the flush interval, then writes the latest snapshot
+    once. Pending changes are also flushed at interpreter shutdown.
+    """
+
+    def __init__(self, write, interval):
+        self._write = write
+        self.interval = interval
+        self._dirty = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The flusher thread does not survive fork; the child starts its own on demand
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def mark_dirty(self):
+        if self._dirty.is_set() and self._thread is not None:
+            return
+        self._dirty.set()
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='key-pool-persister', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            # Coalescing window: every change made meanwhile lands in one write
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Write the current state now if anything changed since the last write"""
+        with self._flush_lock:
+            if not self._dirty.is_set():
+                return
+            self._dirty.clear()
+            self._write()
+
+
+# Enhanced API Key Pool with rotation for Python backend
+class ApiKeyPool:
+    # Readers take ApiKeyPool._state without locking; writers build a new
+    # snapshot under _write_lock and publish it with a single assignment.
+    _state = _PoolSnapshot((), 0, {}, {}, {})
+    _write_lock = threading.Lock()
+    _schedule_cursor = itertools.count()  # lock-free round-robin tie breaker
+    _key_limits = {}  # key -> {'rpm': int, 'rpd': int} overrides
+    _shared = None  # SqliteKeyPoolState when KEY_POOL_SHARED_STATE_DB is set
+    _shared_pending = collections.deque()  # (method, args) shared writes waiting for the flusher
+    _max_requests_per_key = 1000  # Adjust based on your API limits
+    _keys_file = 'api_keys_pool.json'  # File to persist keys
+
+    @staticmethod
+    def _save_keys_to_file():
+        """Schedule the current pool state to be persisted by the write-behind flusher"""
+        _persister.mark_dirty()
+
+    @staticmethod
+    def flush():
+        """Persist pending pool state immediately (shutdown, tests)"""
+        _persister.flush()
+
+    @staticmethod
+    def _write_keys_file():
+        """Atomically write the latest snapshot: temp file in the same directory, then rename
+
+        With shared state the database is the persistent store, so only the
+        queued shared writes and the locally counted usage are applied to it.
+        """
+        if ApiKeyPool._shared is not None:
+            ApiKeyPool._flush_shared_writes()
+            ApiKeyPool._flush_shared_usage()
+            return
+        state = ApiKeyPool._state
+        keys_file = ApiKeyPool._keys_file
+        try:
+            data = {
+                'api_keys': list(state.keys),
+                'current_key_index': state.index,
+                'key_usage_count': {key: counter.value for key, counter in state.usage.items()},
+                'key_limits': ApiKeyPool._key_limits,
+                'timestamp': datetime.now().isoformat()
+            }
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(keys_file)), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, keys_file)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            logger.info("💾 Saved %d keys to %s", len(state.keys), keys_file)
+        except Exception as e:
+            logger.error("❌ Error saving keys to file: %s", e)
+
+    @staticmethod
+    def _flush_shared_usage():
+        deltas = {}
+        counters = {}
+        for key, counter in ApiKeyPool._state.usage.items():
+            value = counter.value
+            if value != counter.flushed:
+                deltas[key] = value - counter.flushed
+                counters[key] = (counter, value)
+        try:
+            ApiKeyPool._shared.add_usage(deltas)
+        except Exception as e:
+            logger.error("❌ Error flushing usage to shared state: %s", e)
+            return
+        for counter, value in counters.values():
+            counter.flushed = value
+
+    @staticmethod
+    def _shared_write(method, *args):
+        """Queue a write to shared state for the write-behind flusher
+
+        Request threads and the image engine loop never wait on SQLite; a busy
+        database delays the write instead of the request.
+        """
+        ApiKeyPool._shared_pending.append((method, args))
+        _persister.mark_dirty()
+
+    @staticmethod
+    def _flush_shared_writes():
+        """Apply queued shared writes in order; best-effort, a failed write is logged and dropped"""
+        pending = ApiKeyPool._shared_pending
+        while pending:
+            method, args = pending[0]
+            try:
+                getattr(ApiKeyPool._shared, method)(*args)
+            except Exception as e:
+                logger.warning("⚠️ Shared key pool state %s failed: %s", method, e)
+            # Removed only once applied, so a reload never runs ahead of our own writes
+            pending.popleft()
+
+    @staticmethod
+    def _shared_sync_due(shared):
+        """Whether another worker committed and none of our own writes are still queued
+
+        Reloading while writes are queued would undo them locally (a breaker we
+        just opened would read back as closed); the flusher's commit triggers the
+        reload instead.
+        """
+        return not ApiKeyPool._shared_pending and shared.changed()
+
+    @staticmethod
+    def _sync_from_shared():
+        """Rebuild the local snapshot from state another worker committed"""
+        try:
+            data = ApiKeyPool._shared.load()
+        except Exception as e:
+            logger.warning("⚠️ Could not read shared key pool state: %s", e)
+            return False
+        if not data:
+            return False
+
+        now = time.monotonic()
+        wall_offset = now - time.time()  # maps shared wall-clock cooldowns onto our monotonic clock
+        with ApiKeyPool._write_lock:
+            state = ApiKeyPool._state
+            keys = tuple(data['keys'])
+            index = data['index'] if 0 <= data['index'] < len(keys) else 0
+            if keys != state.keys or data['key_limits'] != ApiKeyPool._key_limits:
+                ApiKeyPool._key_limits = data['key_limits']
+                state = _PoolSnapshot(
+                    keys,
+                    index,
+                    {key: state.usage.get(key) or _UsageCounter() for key in keys},
+                    ApiKeyPool._build_quotas(keys, state.quotas),
+                    {key: state.breakers.get(key) or _KeyBreaker() for key in keys}
+                )
+            elif index != state.index:
+                state = state._replace(index=index)
+            for key, key_state in data['key_state'].items():
+                breaker = state.breakers.get(key)
+                if breaker:
+                    breaker.apply_shared(key_state['failures'], key_state['open_until'] + wall_offset, now)
+            ApiKeyPool._state = state
+        return True
+
+    @staticmethod
+    def _load_keys_from_file():
+        """Load API keys from file if available"""
+        try:
+            if not os.path.exists(ApiKeyPool._keys_file):
+                logger.info("📁 No saved keys file found: %s", ApiKeyPool._keys_file)
+                return False
+
+            with open(ApiKeyPool._keys_file, 'r') as f:
+                data = json.load(f)
+
+            keys = tuple(data.get('api_keys', []))
+            usage_count = data.get('key_usage_count', {})
+            index = data.get('current_key_index', 0)
+
+            # Validate the loaded keys
+            if keys:
+                with ApiKeyPool._write_lock:
+                    ApiKeyPool._key_limits = data.get('key_limits', {})
+                    ApiKeyPool._state = _PoolSnapshot(
+                        keys,
+                        index if 0 <= index < len(keys) else 0,
+                        {key: _UsageCounter(usage_count.get(key, 0)) for key in keys},
+                        ApiKeyPool._build_quotas(keys),
+                        {key: _KeyBreaker() for key in keys}
+                    )
+                logger.info("📁 Loaded %d keys from file", len(keys))
+                logger.debug("🔑 Keys: %s", [key[:10] + '...' for key in keys])
+                return True
+            else:
+                logger.warning("📁 No valid keys found in saved file")
+                return False
+        except Exception as e:
+            logger.error("❌ Error loading keys from file: %s", e)
+            return False
+
+    @staticmethod
+    def init(app_name):
+        """Initialize API Key Pool with app name"""
+        logger.info("API Key Pool initialized for app: %s", app_name)
+
+        if KEY_POOL_SHARED_STATE_DB and ApiKeyPool._shared is None:
+            try:
+                ApiKeyPool._shared = SqliteKeyPoolState(KEY_POOL_SHARED_STATE_DB)
+                logger.info("🔗 Sharing key pool state via %s", KEY_POOL_SHARED_STATE_DB)
+            except Exception as e:
+                logger.error("❌ Shared key pool state unavailable, using per-process state: %s", e)
+
+        # Another worker on this node may already have published keys
+        if ApiKeyPool._shared is not None and ApiKeyPool._sync_from_shared():
+            logger.info("✅ Using %d keys from shared state", len(ApiKeyPool._state.keys))
+            return
+
+        # First, try to load keys from file
+        if ApiKeyPool._load_keys_from_file():
+            logger.info("✅ Using saved keys from file")
+            ApiKeyPool._publish_to_shared()
+            return
+
+        # Don't override if we already have keys from frontend
+        if ApiKeyPool._state.keys:
+            logger.info("✅ Pool already has %d keys, skipping fallback initialization", len(ApiKeyPool._state.keys))
+            return
+
+        # This should connect to your actual API Key Pool GitHub package
+        # For now, we'll simulate the connection
+        try:
+            # In a real implementation, this would connect to your GitHub package
+            # and retrieve the API keys for the specified app
+            fallback_key = ApiKeyPool._get_fallback_key(app_name)
+            if fallback_key:
+                with ApiKeyPool._write_lock:
+                    ApiKeyPool._state = _PoolSnapshot(
+                        (fallback_key,), 0, {fallback_key: _UsageCounter()},
+                        ApiKeyPool._build_quotas((fallback_key,)), {fallback_key: _KeyBreaker()}
+                    )
+                ApiKeyPool._publish_to_shared()
+                logger.info("Fallback API key retrieved for app: %s", app_name)
+            else:
+                logger.info("No fallback API key found for app: %s", app_name)
+        except Exception as e:
+            logger.error("Error connecting to API Key Pool: %s", e)
+            ApiKeyPool._state = _PoolSnapshot((), 0, {}, {}, {})
+
+    @staticmethod
+    def _publish_to_shared():
+        if ApiKeyPool._shared is not None:
+            state = ApiKeyPool._state
+            ApiKeyPool._shared_write('replace_keys', list(state.keys), ApiKeyPool._key_limits, state.index)
+
+    @staticmethod
+    def _get_fallback_key(app_name):
+        """Get fallback API key from environment or hardcoded"""
+        try:
+            # Check for environment variable first
+            env_key = os.getenv('GEMINI_API_KEY')
+            if env_key and env_key != 'your_gemini_api_key_here':
+                return env_key
+
+            # For development, check environment variable first
+            if app_name == 'ai_storybook_backend':
+                # Only use environment variable, no hardcoded fallback
+                # This forces the system to use the pool keys from frontend
+                return None  # No hardcoded fallback - must use pool keys
+            return None
+        except Exception as e:
+            logger.error("Error getting fallback key: %s", e)
+            return None
+
+    @staticmethod
+    def _build_quotas(keys, previous=None):
+        """Token buckets for each key, carrying over buckets of keys that stay in the pool"""
+        previous = previous or {}
+        quotas = {}
+        for key in keys:
+            limits = ApiKeyPool._key_limits.get(key, {})
+            quota = previous.get(key)
+            if quota is None or quota.rpm != int(limits.get('rpm') or DEFAULT_KEY_RPM) \
+                    or quota.rpd != int(limits.get('rpd') or DEFAULT_KEY_RPD):
+                quota = _KeyQuota(limits.get('rpm'), limits.get('rpd'))
+            quotas[key] = quota
+        return quotas
+
+    @staticmethod
+    def update_keys(api_keys, key_limits=None):
+        """Update the pool with multiple API keys from frontend
+
+        key_limits optionally maps a key to its {'rpm': ..., 'rpd': ...} quota;
+        keys without an entry use GEMINI_KEY_RPM / GEMINI_KEY_RPD.
+        """
+        if not api_keys or not isinstance(api_keys, list):
+            logger.warning("❌ Invalid API keys provided")
+            return False
+
+        # Filter out empty or placeholder keys
+        valid_keys = [key for key in api_keys if key and key.strip() and
+                     key != 'your_gemini_api_key_here' and
+                     key != 'your_actual_gemini_api_key_here']
+
+        if not valid_keys:
+            logger.warning("❌ No valid API keys found")
+            return False
+
+        # Each snapshot owns its usage dict, so a reader holding the old
+        # snapshot can never look up a key that is missing from it
+        with ApiKeyPool._write_lock:
+            if isinstance(key_limits, dict):
+                ApiKeyPool._key_limits = {key: limits for key, limits in key_limits.items() if isinstance(limits, dict)}
+            state = _PoolSnapshot(
+                tuple(valid_keys),
+                0,
+                {key: _UsageCounter() for key in valid_keys},
+                ApiKeyPool._build_quotas(valid_keys, ApiKeyPool._state.quotas),
+                {key: ApiKeyPool._state.breakers.get(key) or _KeyBreaker() for key in valid_keys}
+            )
+            ApiKeyPool._state = state
+            ApiKeyPool._publish_to_shared()
+
+        # Save keys to file for persistence
+        ApiKeyPool._save_keys_to_file()
+
+        logger.info("✅ Updated API key pool with %d keys", len(valid_keys))
+        logger.debug("🔑 Keys: %s", [key[:10] + '...' for key in valid_keys])
+        return True
+
+    @staticmethod
+    def _admit(state, key, now, take_token):
+        """Claim a key for one request: pass its breaker, then take a quota token"""
+        breaker = state.breakers[key]
+        if not breaker.try_acquire(now):
+            return False
+        if take_token and not state.quotas[key].try_take(now):
+            breaker.release()
+            return False
+        return True
+
+    @staticmethod
+    def get_key():
+        """Get the API key with the most remaining quota from the pool
+
+        Keys are ranked by their token buckets so load spreads across the pool
+        before any key is throttled; ties are broken round-robin. Keys whose
+        circuit breaker is open are skipped, so None is returned when every key
+        is cooling down.
+        """
+        shared = ApiKeyPool._shared
+        if shared is not None and ApiKeyPool._shared_sync_due(shared):
+            ApiKeyPool._sync_from_shared()
+
+        state = ApiKeyPool._state
+        if not state.keys:
+            logger.warning("❌ No API keys available in pool", extra=sampled(20))
+            return None
+
+        now = time.monotonic()
+        count = len(state.keys)
+        start = next(ApiKeyPool._schedule_cursor) % count
+
+        # Rank with lock-free reads; only the winner's breaker/bucket is locked
+        current_key = None
+        best_remaining = -1.0
+        for offset in range(count):
+            key = state.keys[(start + offset) % count]
+            if not state.breakers[key].allows(now):
+                continue
+            remaining = state.quotas[key].remaining(now)
+            if remaining > best_remaining:
+                current_key, best_remaining = key, remaining
+
+        if current_key is None:
+            logger.warning("🚫 All %d keys are cooling down after rate limits", count, extra=sampled(20))
+            return None
+
+        if best_remaining < 1:
+            # Every key is at its limit; hand out the one closest to refilling
+            logger.warning("⚠️ All %d keys are at their quota, using %.10s... anyway", count, current_key, extra=sampled(20))
+
+        if not ApiKeyPool._admit(state, current_key, now, best_remaining >= 1):
+            # Another thread took the last token or the probe slot first; try the rest in order
+            current_key = None
+            ranked = sorted(
+                (key for key in state.keys if state.breakers[key].allows(now)),
+                key=lambda k: state.quotas[k].remaining(now),
+                reverse=True
+            )
+            for key in ranked:
+                if ApiKeyPool._admit(state, key, now, state.quotas[key].remaining(now) >= 1):
+                    current_key = key
+                    break
+            if current_key is None:
+                logger.warning("🚫 No key could be admitted right now", extra=sampled(20))
+                return None
+
+        # Increment usage count
+        usage = state.usage[current_key].increment()
+        if shared is not None:
+            # Usage reaches the other workers through the write-behind flusher
+            _persister.mark_dirty()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🔑 Using pool key %d/%d: %.10s... (usage: %d)", state.keys.index(current_key) + 1,
+                         count, current_key, usage, extra=sampled(100))
+
+        return current_key
+
+    @staticmethod
+    def report_success(api_key):
+        """Record that a request on this key was not throttled, closing its breaker"""
+        breaker = ApiKeyPool._state.breakers.get(api_key)
+        if breaker and breaker.record_success() and ApiKeyPool._shared is not None:
+            ApiKeyPool._shared_write('record_success', api_key)
+
+    @staticmethod
+    def release_key(api_key):
+        """Give back a half-open probe when the call on api_key ended without showing whether it is throttled
+
+        Errors other than throttling, timeouts and deadline cuts say nothing
+        about the key's quota. Without this the probe slot stays claimed for
+        KEY_BREAKER_PROBE_TIMEOUT and the key can not be scheduled meanwhile.
+        Call it on every exit; it does nothing once report_success or a
+        throttled rotate_key has resolved the breaker.
+        """
+        breaker = ApiKeyPool._state.breakers.get(api_key)
+        if breaker and breaker.state == _KeyBreaker.HALF_OPEN:
+            breaker.release()
+
+    @staticmethod
+    def rotate_key(failed_key=None):
+        """Advance the rotation index to the next key that is not cooling down
+
+        With failed_key (a key upstream just throttled) that key also has its
+        breaker opened and its minute bucket drained, so a burst can not cycle
+        straight back onto it. A manual rotation without failed_key only moves
+        the index. Usage counts are kept either way.
+        """
+        now = time.monotonic()
+        with ApiKeyPool._write_lock:
+            state = ApiKeyPool._state
+            if failed_key in state.quotas:
+                breaker = state.breakers[failed_key]
+                state.quotas[failed_key].exhaust(now)
+                if breaker.record_failure(now) and ApiKeyPool._shared is not None:
+                    ApiKeyPool._shared_write('record_failure', failed_key, breaker.failures,
+                                             breaker.open_until - now + time.time())
+            if len(state.keys) <= 1:
+                logger.warning("⚠️ Only one key available, cannot rotate")
+                return False
+
+            old_index = state.index
+            old_key = state.keys[old_index]
+
+            # Move to the next key that is not cooling down
+            count = len(state.keys)
+            new_index = None
+            for offset in range(1, count + 1):
+                candidate = (old_index + offset) % count
+                if state.breakers[state.keys[candidate]].allows(now):
+                    new_index = candidate
+                    break
+            if new_index is None:
+                logger.warning("🚫 All %d keys are cooling down, not rotating", count)
+                return False
+            new_key = state.keys[new_index]
+
+            state = state._replace(index=new_index)
+            ApiKeyPool._state = state
+            if ApiKeyPool._shared is not None:
+                ApiKeyPool._shared_write('set_index', new_index)
+
+        logger.info("🔄 Rotated from key %d (%.10s...) to key %d (%.10s...)", old_index + 1, old_key, new_index + 1, new_key)
+
+        # Save updated state to file
+        ApiKeyPool._save_keys_to_file()
+
+        return True
+
+    @staticmethod
+    def peek_key():
+        """Current key by rotation index, without taking quota or a breaker probe"""
+        state = ApiKeyPool._state
+        return state.keys[state.index] if state.keys else None
+
+    @staticmethod
+    def get_keys():
+        """Immutable tuple of the keys currently in the pool"""
+        return ApiKeyPool._state.keys
+
+    @staticmethod
+    def get_healthy_key_count():
+        """Number of keys currently able to serve requests"""
+        state = ApiKeyPool._state
+        now = time.monotonic()
+        return sum(1 for key in state.keys
+                   if state.breakers[key].allows(now) and state.quotas[key].remaining(now) >= 1)
+
+    @staticmethod
+    def get_pool_status():
+        """Get status of the key pool"""
+        shared = ApiKeyPool._shared
+        if shared is not None and ApiKeyPool._shared_sync_due(shared):
+            ApiKeyPool._sync_from_shared()
+        state = ApiKeyPool._state
+        now = time.monotonic()
+        usage_counts = {key: counter.value for key, counter in state.usage.items()}
+        if shared is not None:
+            try:
+                shared_usage = shared.usage()
+                usage_counts = {
+                    key: shared_usage.get(key, 0) + counter.value - counter.flushed
+                    for key, counter in state.usage.items()
+                }
+            except Exception as e:
+                logger.warning("⚠️ Could not read shared usage counts: %s", e)
+        return {
+            'total_keys': len(state.keys),
+            'current_key_index': state.index,
+            'current_key_preview': state.keys[state.index][:10] + '...' if state.keys else 'None',
+            'usage_counts': {key[:10] + '...': count for key, count in usage_counts.items()},
+            'shared_state': KEY_POOL_SHARED_STATE_DB if shared is not None else None,
+            'available_keys': [key[:10] + '...' for key in state.keys],
+            'remaining_quota': {
+                key[:10] + '...': {
+                    'per_minute': int(quota.per_minute.tokens(now)),
+                    'per_day': int(quota.per_day.tokens(now)),
+                    'rpm': quota.rpm,
+                    'rpd': quota.rpd
+                }
+                for key, quota in state.quotas.items()
+            },
+            'breakers': {
+                key[:10] + '...': {
+                    'state': breaker.state,
+                    'failures': breaker.failures,
+                    'cooldown_remaining': round(max(0.0, breaker.open_until - now), 1) if breaker.state == _KeyBreaker.OPEN else 0.0
+                }
+                for key, breaker in state.breakers.items()
+            }
+        }
+
+    @staticmethod
+    def metric_samples():
+        """Per-key admitted requests, remaining quota and breaker state for /metrics"""
+        state = ApiKeyPool._state
+        now = time.monotonic()
+        breaker_states = {_KeyBreaker.CLOSED: 0, _KeyBreaker.HALF_OPEN: 1, _KeyBreaker.OPEN: 2}
+        yield ('storybook_api_keys', 'gauge', 'Keys in the pool', {}, len(state.keys))
+        yield ('storybook_api_keys_healthy', 'gauge', 'Keys able to serve requests now', {},
+               ApiKeyPool.get_healthy_key_count())
+        for key in state.keys:
+            labels = {'key': key_label(key)}
+            yield ('storybook_api_key_requests_total', 'counter', 'Requests admitted per key by this process',
+                   labels, state.usage[key].value)
+            yield ('storybook_api_key_remaining_per_minute', 'gauge', 'Tokens left in the per-minute bucket',
+                   labels, int(state.quotas[key].per_minute.tokens(now)))
+            yield ('storybook_api_key_remaining_per_day', 'gauge', 'Tokens left in the per-day bucket',
+                   labels, int(state.quotas[key].per_day.tokens(now)))
+            yield ('storybook_api_key_breaker_state', 'gauge', 'Breaker state: 0 closed, 1 half-open, 2 open',
+                   labels, breaker_states[state.breakers[key].state])
+
+    @staticmethod
+    def handle_rate_limit_error(failed_key=None):
+        """Handle rate limit error by rotating key"""
+        logger.warning("🚨 Rate limit detected! Attempting key rotation...")
+        KEY_ROTATIONS.labels('throttled').inc()
+        success = ApiKeyPool.rotate_key(failed_key)
+        if success:
+            # Use helper function to update services
+            ApiKeyPool._update_services_with_current_key()
+        return success
+
+    @staticmethod
+    def _update_services_with_current_key():
+        """Helper function to update all services with current key"""
+        # This will be replaced by the actual function after services are initialized
+        pass
+
+
+_persister = _WriteBehindPersister(ApiKeyPool._write_keys_file, KEY_POOL_FLUSH_INTERVAL)
+atexit.register(_persister.flush)
@@ -1,294 +1,128 @@
 import os
 import json
-import base64
-import requests
+import time
+import logging
+import threading
+import contextvars
 from datetime import datetime
-from flask import Flask, request, jsonify, send_file
+from flask import Blueprint, Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
-import google.generativeai as genai
-from firebase_admin import credentials, firestore, initialize_app
-from PIL import Image
-import io
+import hashlib
+from functools import lru_cache
+from werkzeug.security import safe_join
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Import our custom services
+# Import our custom services. Heavy SDKs (google-generativeai, firebase_admin,
+# Pillow, httpx) are imported by the services on first use, not here, so cold
+# starts only pay for Flask and the standard library.
 from gemini_image_service import GeminiImageService
+from image_variants import ImageVariantService
 from gemini_text_service import GeminiTextService
+from story_parser import StoryPageStreamParser
 from feedback_service import FeedbackService
+from story_jobs import StoryJobRunner, JobQueueFull, create_job_store
+from api_key_pool import ApiKeyPool
+from metrics import (REGISTRY, CONTENT_TYPE, KEY_ROTATIONS, HTTP_REQUEST_DURATION, HTTP_REQUESTS_IN_FLIGHT,
+                     HTTP_REQUEST_BYTES, HTTP_RESPONSE_BYTES)
+from logging_setup import configure_logging, logging_stats, sampled
+from timing import span, start_trace, end_trace, current_trace
+import deadlines
+from deadlines import DeadlineExceeded, DEADLINE_HEADER, in_request_context
 
-app = Flask(__name__)
-CORS(app)
-
-# Initialize Firebase
-try:
-    cred = credentials.Certificate("firebase-credentials.json")
-    initialize_app(cred)
-    db = firestore.client()
-except Exception as e:
-    print(f"Firebase initialization failed: {e}")
-    print("Running in development mode without Firebase...")
-    # For development, create a mock database
-    class MockFirestore:
-        def collection(self, name):
-            return MockCollection()
-    
-    class MockCollection:
-        def __init__(self, name="feedback"):
-            self.name = name
-        
-        def add(self, data):
-            print(f"Mock: Adding to {self.name}: {data}")
-            return True
-        
-        def where(self, field, op, value):
-            return self
-        
-        def order_by(self, field, direction=None):
-            return self
-        
-        def stream(self):
-            return []
-    
-    db = MockFirestore()
-
-# Enhanced API Key Pool with rotation for Python backend
-class ApiKeyPool:
-    _api_keys = []
-    _current_key_index = 0
-    _key_usage_count = {}
-    _max_requests_per_key = 1000  # Adjust based on your API limits
-    _keys_file = 'api_keys_pool.json'  # File to persist keys
-    
-    @staticmethod
-    def _save_keys_to_file():
-        """Save API keys to file for persistence"""
-        try:
-            import json
-            data = {
-                'api_keys': ApiKeyPool._api_keys,
-                'current_key_index': ApiKeyPool._current_key_index,
-                'key_usage_count': ApiKeyPool._key_usage_count,
-                'timestamp': datetime.now().isoformat()
-            }
-            with open(ApiKeyPool._keys_file, 'w') as f:
-                json.dump(data, f, indent=2)
-            print(f"💾 Saved {len(ApiKeyPool._api_keys)} keys to {ApiKeyPool._keys_file}")
-        except Exception as e:
-            print(f"❌ Error saving keys to file: {e}")
-    
-    @staticmethod
-    def _load_keys_from_file():
-        """Load API keys from file if available"""
-        try:
-            import json
-            import os
-            if not os.path.exists(ApiKeyPool._keys_file):
-                print(f"📁 No saved keys file found: {ApiKeyPool._keys_file}")
-                return False
-            
-            with open(ApiKeyPool._keys_file, 'r') as f:
-                data = json.load(f)
-            
-            ApiKeyPool._api_keys = data.get('api_keys', [])
-            ApiKeyPool._current_key_index = data.get('current_key_index', 0)
-            ApiKeyPool._key_usage_count = data.get('key_usage_count', {})
-            
-            # Validate the loaded keys
-            if ApiKeyPool._api_keys:
-                print(f"📁 Loaded {len(ApiKeyPool._api_keys)} keys from file")
-                print(f"🔑 Keys: {[key[:10] + '...' for key in ApiKeyPool._api_keys]}")
-                return True
-            else:
-                print(f"📁 No valid keys found in saved file")
-                return False
-        except Exception as e:
-            print(f"❌ Error loading keys from file: {e}")
-            return False
+logger = logging.getLogger(__name__)
+
+FIREBASE_CREDENTIALS_PATH = os.getenv('FIREBASE_CREDENTIALS_PATH', 'firebase-credentials.json')
+
+# For development without Firebase, a mock database
+class MockFirestore:
+    def collection(self, name):
+        return MockCollection(name)
+
+class MockCollection:
+    def __init__(self, name="feedback"):
+        self.name = name
     
-    @staticmethod
-    def init(app_name):
-        """Initialize API Key Pool with app name"""
-        print(f"API Key Pool initialized for app: {app_name}")
-        
-        # First, try to load keys from file
-        if ApiKeyPool._load_keys_from_file():
-            print(f"✅ Using saved keys from file")
-            return
-        
-        # Don't override if we already have keys from frontend
-        if ApiKeyPool._api_keys:
-            print(f"✅ Pool already has {len(ApiKeyPool._api_keys)} keys, skipping fallback initialization")
-            return
-        
-        # This should connect to your actual API Key Pool GitHub package
-        # For now, we'll simulate the connection
-        try:
-            # In a real implementation, this would connect to your GitHub package
-            # and retrieve the API keys for the specified app
-            fallback_key = ApiKeyPool._get_fallback_key(app_name)
-            if fallback_key:
-                ApiKeyPool._api_keys = [fallback_key]
-                ApiKeyPool._key_usage_count[fallback_key] = 0
-                print(f"Fallback API key retrieved for app: {app_name}")
-            else:
-                print(f"No fallback API key found for app: {app_name}")
-        except Exception as e:
-            print(f"Error connecting to API Key Pool: {e}")
-            ApiKeyPool._api_keys = []
+    def add(self, data):
+        logger.debug("Mock: Adding to %s: %s", self.name, data)
+        return True
     
-    @staticmethod
-    def _get_fallback_key(app_name):
-        """Get fallback API key from environment or hardcoded"""
-        try:
-            # Check for environment variable first
-            import os
-            env_key = os.getenv('GEMINI_API_KEY')
-            if env_key and env_key != 'your_gemini_api_key_here':
-                return env_key
-            
-            # For development, check environment variable first
-            if app_name == 'ai_storybook_backend':
-                # Only use environment variable, no hardcoded fallback
-                # This forces the system to use the pool keys from frontend
-                return None  # No hardcoded fallback - must use pool keys
-            return None
-        except Exception as e:
-            print(f"Error getting fallback key: {e}")
-            return None
+    def where(self, field, op, value):
+        return self
     
-    @staticmethod
-    def update_keys(api_keys):
-        """Update the pool with multiple API keys from frontend"""
-        if not api_keys or not isinstance(api_keys, list):
-            print("❌ Invalid API keys provided")
-            return False
-        
-        # Filter out empty or placeholder keys
-        valid_keys = [key for key in api_keys if key and key.strip() and 
-                     key != 'your_gemini_api_key_here' and 
-                     key != 'your_actual_gemini_api_key_here']
-        
-        if not valid_keys:
-            print("❌ No valid API keys found")
-            return False
-        
-        ApiKeyPool._api_keys = valid_keys
-        ApiKeyPool._current_key_index = 0
-        ApiKeyPool._key_usage_count = {key: 0 for key in valid_keys}
-        
-        # Save keys to file for persistence
-        ApiKeyPool._save_keys_to_file()
-        
-        print(f"✅ Updated API key pool with {len(valid_keys)} keys")
-        print(f"🔑 Keys: {[key[:10] + '...' for key in valid_keys]}")
-        return True
+    def order_by(self, field, direction=None):
+        return self
     
-    @staticmethod
-    def get_key():
-        """Get current API key from the pool"""
-        if not ApiKeyPool._api_keys:
-            print("❌ No API keys available in pool")
-            return None
-        
-        current_key = ApiKeyPool._api_keys[ApiKeyPool._current_key_index]
-        
-        # Increment usage count
-        ApiKeyPool._key_usage_count[current_key] += 1
-        
-        print(f"🔑 Using pool key {ApiKeyPool._current_key_index + 1}/{len(ApiKeyPool._api_keys)}: {current_key[:10]}... (usage: {ApiKeyPool._key_usage_count[current_key]})")
-        
-        return current_key
+    def stream(self):
+        return []
+
+class LazyFirestore:
+    """Firestore client initialized on first use, falling back to MockFirestore"""
     
-    @staticmethod
-    def rotate_key():
-        """Rotate to the next API key when rate limit is hit"""
-        if len(ApiKeyPool._api_keys) <= 1:
-            print("⚠️ Only one key available, cannot rotate")
-            return False
-        
-        old_index = ApiKeyPool._current_key_index
-        old_key = ApiKeyPool._api_keys[old_index] if ApiKeyPool._api_keys else "None"
-        
-        # Move to next key
-        ApiKeyPool._current_key_index = (ApiKeyPool._current_key_index + 1) % len(ApiKeyPool._api_keys)
-        new_key = ApiKeyPool._api_keys[ApiKeyPool._current_key_index]
-        
-        print(f"🔄 Rotated from key {old_index + 1} ({old_key[:10]}...) to key {ApiKeyPool._current_key_index + 1} ({new_key[:10]}...)")
-        
-        # Reset the usage count for the rotated key
-        ApiKeyPool._key_usage_count[new_key] = 0
-        
-        # Save updated state to file
-        ApiKeyPool._save_keys_to_file()
-        
-        return True
+    def __init__(self, credentials_path):
+        self.credentials_path = credentials_path
+        self._client = None
+        self._lock = threading.Lock()
     
-    @staticmethod
-    def get_pool_status():
-        """Get status of the key pool"""
-        return {
-            'total_keys': len(ApiKeyPool._api_keys),
-            'current_key_index': ApiKeyPool._current_key_index,
-            'current_key_preview': ApiKeyPool._api_keys[ApiKeyPool._current_key_index][:10] + '...' if ApiKeyPool._api_keys else 'None',
-            'usage_counts': {key[:10] + '...': count for key, count in ApiKeyPool._key_usage_count.items()},
-            'available_keys': [key[:10] + '...' for key in ApiKeyPool._api_keys]
-        }
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    try:
+                        from firebase_admin import credentials, firestore, initialize_app
+                        initialize_app(credentials.Certificate(self.credentials_path))
+                        self._client = firestore.client()
+                    except Exception as e:
+                        logger.warning("Firebase initialization failed: %s", e)
+                        logger.warning("Running in development mode without Firebase...")
+                        self._client = MockFirestore()
+        return self._client
     
-    @staticmethod
-    def handle_rate_limit_error():
-        """Handle rate limit error by rotating key"""
-        print("🚨 Rate limit detected! Attempting key rotation...")
-        success = ApiKeyPool.rotate_key()
-        if success:
-            # Use helper function to update services
-            ApiKeyPool._update_services_with_current_key()
-        return success
+    def __getattr__(self, name):
+        return getattr(self._get_client(), name)
+
+# Built by create_app() (see _build_services), never as a side effect of importing this module
+db = None
+gemini_api_key = None
+gemini_image_service = None
+image_variant_service = None
+gemini_text_service = None
+feedback_service = None
+
+def _build_services():
+    """Construct the services, handing them the key pool as their key provider
     
-    @staticmethod
-    def _update_services_with_current_key():
-        """Helper function to update all services with current key"""
-        # This will be replaced by the actual function after services are initialized
-        pass
-
-# Initialize API Key Pool
-ApiKeyPool.init('ai_storybook_backend')
-
-# Initialize services
-gemini_api_key = ApiKeyPool.get_key()
-gemini_image_service = GeminiImageService()
-gemini_text_service = GeminiTextService()
-feedback_service = FeedbackService(db)
-
-if gemini_api_key:
-    gemini_image_service.initialize(gemini_api_key)
-    gemini_text_service.initialize(gemini_api_key)
-    genai.configure(api_key=gemini_api_key)
-    print(f"Gemini API configured with key: {gemini_api_key[:10]}...")
-else:
-    print("Warning: No Gemini API key found. Running in development mode.")
-
-# Now update the helper function to use the initialized services
+    Services are cheap to construct; their SDK clients are created lazily.
+    """
+    global db, gemini_image_service, image_variant_service, gemini_text_service, feedback_service, story_job_runner
+    db = LazyFirestore(FIREBASE_CREDENTIALS_PATH)
+    gemini_image_service = GeminiImageService(key_provider=ApiKeyPool)
+    image_variant_service = None
+    if gemini_image_service.image_cache:
+        try:
+            image_variant_service = ImageVariantService(os.path.join(gemini_image_service.image_cache.directory, 'variants'))
+        except Exception as e:
+            logger.warning("⚠️ Image variants disabled: %s", e)
+    gemini_text_service = GeminiTextService(key_provider=ApiKeyPool)
+    feedback_service = FeedbackService(db)
+    story_job_runner = StoryJobRunner(create_job_store(), run_story_job)
+
+api = Blueprint('api', __name__)
+
 def _update_services_with_current_key():
     """Helper function to update all services with current key"""
-    current_key = ApiKeyPool.get_key()
+    current_key = ApiKeyPool.peek_key()
     if current_key:
         global gemini_api_key
         gemini_api_key = current_key
         gemini_image_service.initialize(current_key)
         gemini_text_service.initialize(current_key)
-        genai.configure(api_key=current_key)
-        print(f"🔄 Services updated with rotated key: {current_key[:10]}...")
-
-# Update the ApiKeyPool method to use this function
-ApiKeyPool._update_services_with_current_key = _update_services_with_current_key
+        logger.info("🔄 Services updated with rotated key: %.10s...", current_key)
+    return current_key
 
 class StoryService:
-    def __init__(self):
-        self.model = genai.GenerativeModel(model_name='gemini-pro') if gemini_api_key else None
-        self.image_model = genai.GenerativeModel(model_name='gemini-pro-vision') if gemini_api_key else None
-    
     def generate_story(self, prompt, theme, additional_context=None):
         try:
-            print(f"📖 Generating 10-page story for: {prompt}")
+            logger.info("📖 Generating 10-page story for: %.100s", prompt)
             
             # Generate 10 page scripts first
             pages = self._generate_10_page_scripts(prompt, theme, additional_context)
@@ -315,41 +149,78 @@ class StoryService:
         except Exception as e:
             raise Exception(f'Failed to generate story: {str(e)}')
     
+    def generate_story_stream(self, prompt, theme, additional_context=None):
+        """Generate a story, yielding ('page', page) events as soon as each page is complete
+        
+        Finishes with a ('story', story) event carrying the full story, or an
+        ('error', message) event if generation fails after pages were sent.
+        """
+        logger.info("📖 Streaming 10-page story for: %.100s", prompt)
+        pages = []
+        
+        def emit(page):
+            page['pageNumber'] = len(pages) + 1
+            page['imageUrl'] = f'https://via.placeholder.com/400x300/4A90E2/FFFFFF?text=Page+{page["pageNumber"]}'
+            pages.append(page)
+            return ('page', page)
+        
+        try:
+            if gemini_api_key:
+                parser = StoryPageStreamParser()
+                with span('story.prompt'):
+                    story_prompt = self._build_10_page_prompt(prompt, theme, additional_context)
+                for chunk in gemini_text_service.generate_text_stream(story_prompt):
+                    for page in parser.feed(chunk):
+                        if len(pages) < 10:
+                            yield emit(page)
+                for page in parser.close():
+                    if len(pages) < 10:
+                        yield emit(page)
+        except Exception as e:
+            logger.error("❌ Error streaming page scripts: %s", e)
+            if pages:
+                yield ('error', f'Failed to generate story: {str(e)}')
+                return
+        
+        if not pages:
+            # Nothing usable arrived (or no key configured); fall back like generate_story
+            for page in self._generate_fallback_10_pages(prompt, theme):
+                yield emit(page)
+        
+        # Ensure we have exactly 10 pages
+        while len(pages) < 10:
+            yield emit({
+                'script': f"And the adventure continued with {prompt}...",
+                'imageUrl': None
+            })
+        
+        yield ('story', {
+            'id': self._generate_id(),
+            'title': self._extract_title(pages[0]['script']),
+            'pages': pages,
+            'theme': theme,
+            'audioUrl': self._generate_audio(pages),
+            'createdAt': datetime.now().isoformat()
+        })
+    
     def _generate_10_page_scripts(self, prompt, theme, additional_context=None):
         """Generate exactly 10 page scripts for the story"""
         try:
-            print("📝 Generating 10 page scripts...")
+            logger.debug("📝 Generating 10 page scripts...")
             
-            story_prompt = f"""
-Create a children's story with EXACTLY 10 pages based on this prompt: "{prompt}"
-Theme: {theme}
-{f"Additional context: {additional_context}" if additional_context else ""}
-
-Requirements:
-- Each page should have 2-4 sentences
-- Suitable for children aged 4-8
-- Clear narrative progression across all 10 pages
-- Engaging and age-appropriate content
-- Include dialogue and action
-- Have a satisfying conclusion on page 10
-
-Format your response as:
-Page 1: [content for page 1]
-Page 2: [content for page 2]
-...
-Page 10: [content for page 10]
-
-Write an engaging {theme.lower()} story that flows naturally across all 10 pages.
-"""
+            with span('story.prompt'):
+                story_prompt = self._build_10_page_prompt(prompt, theme, additional_context)
             
             if gemini_api_key:
-                story_text = gemini_text_service.generate_text(story_prompt)
+                with span('story.text'):
+                    story_text = gemini_text_service.generate_text(story_prompt)
             else:
                 # Fallback for development
                 story_text = self._generate_fallback_10_pages(prompt, theme)
             
             # Parse the response into individual pages
-            pages = self._parse_story_pages(story_text)
+            with span('story.parse'):
+                pages = self._parse_story_pages(story_text)
             
             # Ensure we have exactly 10 pages
             while len(pages) < 10:
@@ -362,13 +233,39 @@ Write an engaging {theme.lower()} story that flows naturally across all 10 pages
             # Trim to exactly 10 pages if more were generated
             pages = pages[:10]
             
-            print(f"✅ Generated {len(pages)} page scripts")
+            logger.debug("✅ Generated %d page scripts", len(pages))
             return pages
             
+        except DeadlineExceeded as e:
+            logger.warning("⏱️ %s; using fallback pages", e)
+            return self._generate_fallback_10_pages(prompt, theme)
         except Exception as e:
-            print(f"❌ Error generating page scripts: {e}")
+            logger.error("❌ Error generating page scripts: %s", e)
             return self._generate_fallback_10_pages(prompt, theme)
     
+    def _build_10_page_prompt(self, prompt, theme, additional_context=None):
+        return f"""
+Create a children's story with EXACTLY 10 pages based on this prompt: "{prompt}"
+Theme: {theme}
+{f"Additional context: {additional_context}" if additional_context else ""}
+
+Requirements:
+- Each page should have 2-4 sentences
+- Suitable for children aged 4-8
+- Clear narrative progression across all 10 pages
+- Engaging and age-appropriate content
+- Include dialogue and action
+- Have a satisfying conclusion on page 10
+
+Format your response as:
+Page 1: [content for page 1]
+Page 2: [content for page 2]
+...
+Page 10: [content for page 10]
+
+Write an engaging {theme.lower()} story that flows naturally across all 10 pages.
+"""
+    
     def _parse_story_pages(self, story_text):
         """Parse AI response into individual pages"""
         pages = []
@@ -438,48 +335,94 @@ Write an engaging {theme.lower()} story that flows naturally across all 10 pages
             })
         return pages
     
-    def _generate_images_for_pages(self, pages, theme):
-        """Generate an image for each of the 10 pages"""
-        try:
-            print("🎨 Generating images for all 10 pages...")
-            print(f"🔑 API key available: {bool(gemini_api_key)}")
-            print(f"🔑 API key preview: {gemini_api_key[:10] if gemini_api_key else 'None'}...")
-            
-            for i, page in enumerate(pages):
-                print(f"🖼️ Generating image for page {page['pageNumber']}...")
-                
-                # Build image prompt for this specific page
-                image_prompt = self._build_image_prompt(page['script'], theme)
-                print(f"📝 Image prompt: {image_prompt[:100]}...")
+    def _generate_images_for_pages(self, pages, theme, parallel=None, on_page_done=None,
+                                   image_mode='inline', image_base_url=''):
+        """Generate an image for each of the 10 pages
+
+        In parallel mode pages are fanned out over a bounded worker pool sized
+        from the number of healthy keys in the ApiKeyPool. Results are written
+        back onto their own page dict, so page order is always preserved and a
+        failure on one page only falls back to that page's placeholder.
+        
+        image_mode 'reference' stores each image once and sets imageUrl to a
+        short /api/images/<id>.jpg URL instead of embedding base64.
+        """
+        if parallel is None:
+            parallel = PARALLEL_IMAGE_GENERATION
+        
+        with span('story.images'):
+            try:
+                logger.debug("🎨 Generating images for all %d pages (%s), API key available: %s",
+                             len(pages), 'parallel' if parallel else 'sequential', bool(gemini_api_key))
                 
-                # Generate image using our image service
-                if gemini_api_key:
-                    result = gemini_image_service.generate_gemini_image(image_prompt)
-                    if result['success'] and result.get('imageBytes'):
-                        # Convert image bytes to base64 for direct embedding
-                        import base64
-                        image_base64 = base64.b64encode(result['imageBytes']).decode('utf-8')
-                        
-                        # Update page with base64 data URL
-                        page['imageUrl'] = f"data:image/jpeg;base64,{image_base64}"
-                        page['imageBase64'] = image_base64  # Also provide raw base64
-                        print(f'✅ Generated image for page {page["pageNumber"]} (base64: {len(image_base64)} chars)')
-                    else:
-                        print(f'❌ Image generation failed for page {page["pageNumber"]}: {result.get("error")}')
-                        # Fallback to placeholder
-                        page['imageUrl'] = f'https://via.placeholder.com/400x300/4A90E2/FFFFFF?text=Page+{page["pageNumber"]}'
+                if not parallel or len(pages) <= 1:
+                    for page in pages:
+                        self._generate_image_for_page(page, theme, image_mode, image_base_url)
+                        if on_page_done:
+                            on_page_done(page)
                 else:
-                    # Fallback for development
-                    page['imageUrl'] = f'https://via.placeholder.com/400x300/4A90E2/FFFFFF?text=Page+{page["pageNumber"]}'
-                    
-            print(f"✅ Completed image generation for all {len(pages)} pages")
+                    max_workers = get_image_fanout_workers(len(pages))
+                    logger.debug("🧵 Fanning out %d pages over %d workers", len(pages), max_workers)
+                    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='page-image') as executor:
+                        # Each worker runs in a copy of this context so its spans join the request's trace
+                        futures = {
+                            executor.submit(contextvars.copy_context().run, self._generate_image_for_page,
+                                            page, theme, image_mode, image_base_url): page
+                            for page in pages
+                        }
+                        for future in as_completed(futures):
+                            page = futures[future]
+                            try:
+                                future.result()
+                            except Exception as e:
+                                logger.error('❌ Image worker failed for page %s: %s', page["pageNumber"], e)
+                                self._apply_placeholder_image(page)
+                            if on_page_done:
+                                on_page_done(page)
+                        
+                logger.info("✅ Completed image generation for all %d pages", len(pages))
+                
+            except Exception as e:
+                logger.error("❌ Error generating images: %s", e)
+                # Ensure all pages have at least placeholder images
+                for page in pages:
+                    if not page.get('imageUrl'):
+                        self._apply_placeholder_image(page)
+    
+    def _generate_image_for_page(self, page, theme, image_mode='inline', image_base_url=''):
+        """Generate the image for a single page, falling back to a placeholder on failure"""
+        with span('story.page_image'):
+            logger.debug("🖼️ Generating image for page %s...", page['pageNumber'])
             
-        except Exception as e:
-            print(f"❌ Error generating images: {e}")
-            # Ensure all pages have at least placeholder images
-            for i, page in enumerate(pages):
-                if not page.get('imageUrl'):
-                    page['imageUrl'] = f'https://via.placeholder.com/400x300/4A90E2/FFFFFF?text=Page+{page["pageNumber"]}'
+            # Fallback for development
+            if not gemini_api_key:
+                self._apply_placeholder_image(page)
+                return page
+            
+            # Build image prompt for this specific page
+            image_prompt = self._build_image_prompt(page['script'], theme)
+            
+            # Inline mode takes the upstream base64 as-is instead of decoding and re-encoding it
+            result = gemini_image_service.generate_gemini_image(
+                image_prompt, response_format='bytes' if image_mode == 'reference' else 'base64'
+            )
+            if result['success'] and image_mode == 'reference' and (result.get('imageId') or result.get('imageBytes')):
+                page['imageId'], page['imageUrl'] = store_image_reference(result, image_base_url)
+                logger.debug('✅ Generated image for page %s (%s)', page["pageNumber"], page["imageUrl"])
+            elif result['success'] and result.get('imageBase64'):
+                image_base64 = result['imageBase64']
+                
+                # Update page with base64 data URL
+                page['imageUrl'] = f"data:{result.get('mimeType', 'image/jpeg')};base64,{image_base64}"
+                page['imageBase64'] = image_base64  # Also provide raw base64
+                logger.debug('✅ Generated image for page %s (base64: %d chars)', page["pageNumber"], len(image_base64))
+            else:
+                logger.warning('❌ Image generation failed for page %s: %s', page["pageNumber"], result.get("error"))
+                self._apply_placeholder_image(page)
+            return page
+    
+    def _apply_placeholder_image(self, page):
+        page['imageUrl'] = f'https://via.placeholder.com/400x300/4A90E2/FFFFFF?text=Page+{page["pageNumber"]}'
     
     def _build_story_prompt(self, prompt, theme, additional_context):
         theme_prompts = {
@@ -552,10 +495,172 @@ Format: High-quality digital art suitable for a storybook
     def _generate_id(self):
         return str(int(datetime.now().timestamp() * 1000))
 
+# Parallel image fan-out configuration
+PARALLEL_IMAGE_GENERATION = os.getenv('PARALLEL_IMAGE_GENERATION', 'true').lower() in ('1', 'true', 'yes')
+IMAGE_CONCURRENCY_PER_KEY = int(os.getenv('IMAGE_CONCURRENCY_PER_KEY', '2'))
+IMAGE_FANOUT_MAX_WORKERS = int(os.getenv('IMAGE_FANOUT_MAX_WORKERS', '10'))
+MAX_BATCH_IMAGES = int(os.getenv('MAX_BATCH_IMAGES', '20'))
+
+# Image response mode: 'inline' embeds base64, 'reference' returns /api/images/<id>.jpg URLs
+IMAGE_RESPONSE_MODE = os.getenv('IMAGE_RESPONSE_MODE', 'inline')
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '')
+
+# Content-addressed images are immutable; let browsers and CDNs keep them for a year
+IMMUTABLE_IMAGE_MAX_AGE = int(os.getenv('IMMUTABLE_IMAGE_MAX_AGE', str(365 * 24 * 3600)))
+# Hand file bodies to the front proxy (nginx X-Accel / Apache X-Sendfile) instead of the worker
+USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
+
+class ImageModeUnavailable(Exception):
+    """The caller asked for reference mode but the image store is disabled"""
+
+def resolve_image_mode(data=None, default=None):
+    """Image mode for this request; reference mode needs the image store to be enabled
+    
+    A caller that asks for reference mode while the store is disabled gets
+    ImageModeUnavailable; a reference-mode default falls back to inline.
+    """
+    requested = (data or {}).get('imageMode') or request.args.get('imageMode')
+    mode = requested or default or IMAGE_RESPONSE_MODE
+    if mode != 'reference':
+        return 'inline'
+    if gemini_image_service.image_cache:
+        return 'reference'
+    if requested:
+        raise ImageModeUnavailable('imageMode "reference" needs the image cache (IMAGE_CACHE_ENABLED=true)')
+    logger.warning("⚠️ Reference image mode needs the image cache, which is disabled; sending inline images",
+                   extra=sampled(100))
+    return 'inline'
+
+def image_base_url():
+    return PUBLIC_BASE_URL.rstrip('/') or request.host_url.rstrip('/')
+
+def store_image_reference(result, base_url=''):
+    """Persist a generated image once and return (image id, URL it is served from)
+    
+    The blob is pinned: the URL is served as immutable, so the cache's LRU
+    must never delete it.
+    """
+    image_cache = gemini_image_service.image_cache
+    image_id = result.get('imageId')
+    if not (image_id and image_cache.pin(image_id)):
+        image_id = image_cache.put_blob(result['imageBytes'], pin=True)
+    return image_id, f'{base_url}/api/images/{image_id}.jpg'
+
+def get_image_fanout_workers(task_count):
+    """Size an image worker pool from the number of healthy keys in the pool"""
+    healthy_keys = max(1, ApiKeyPool.get_healthy_key_count())
+    return max(1, min(task_count, healthy_keys * IMAGE_CONCURRENCY_PER_KEY, IMAGE_FANOUT_MAX_WORKERS))
+
 # Initialize story service
 story_service = StoryService()
 
-@app.route('/api/health', methods=['GET'])
+def run_story_job(params, progress):
+    """Story job pipeline: stream the page scripts, then generate every page's image"""
+    progress.stage('text')
+    story = None
+    for event, payload in story_service.generate_story_stream(
+            params['prompt'], params['theme'], params.get('additionalContext')):
+        if event == 'page':
+            progress.page_written(payload)
+        elif event == 'story':
+            story = payload
+        elif event == 'error':
+            raise Exception(payload)
+    
+    progress.stage('images', total_pages=len(story['pages']))
+    story_service._generate_images_for_pages(
+        story['pages'], params['theme'],
+        on_page_done=progress.image_done,
+        image_mode=params['imageMode'],
+        image_base_url=params['imageBaseUrl']
+    )
+    return story
+
+# Background story jobs (POST /api/stories/jobs), built by create_app()
+story_job_runner = None
+
+def cache_metric_samples():
+    """Cache and single-flight counters for /metrics, read from the services' stats()"""
+    caches = {
+        'image': gemini_image_service.image_cache.stats() if gemini_image_service.image_cache else None,
+        'text': gemini_text_service.text_cache.stats() if gemini_text_service.text_cache else None,
+        'image_variant': image_variant_service.stats() if image_variant_service else None
+    }
+    for cache, stats in caches.items():
+        if stats is None:
+            continue
+        labels = {'cache': cache}
+        if cache == 'image_variant':
+            # Variant lookups are counted as renders vs. cached variants, not blob lookups
+            stats = dict(stats, hits=stats['served_from_cache'], misses=stats['rendered'])
+        yield ('storybook_cache_hits_total', 'counter', 'Cache lookups served from cache', labels, stats['hits'])
+        yield ('storybook_cache_misses_total', 'counter', 'Cache lookups that missed', labels, stats['misses'])
+        yield ('storybook_cache_hit_ratio', 'gauge', 'Hits over lookups since start', labels, stats['hit_ratio'])
+        yield ('storybook_cache_entries', 'gauge', 'Entries currently cached', labels, stats['entries'])
+        yield ('storybook_cache_evictions_total', 'counter', 'Entries evicted to stay within budget',
+               labels, stats['evictions'])
+        if 'bytes' in stats:
+            yield ('storybook_cache_bytes', 'gauge', 'Bytes currently cached', labels, stats['bytes'])
+
+    for service, stats in (('image', gemini_image_service.in_flight.stats()),
+                           ('text', gemini_text_service.in_flight.stats())):
+        labels = {'service': service}
+        yield ('storybook_single_flight_executed_total', 'counter', 'Upstream calls actually made',
+               labels, stats['executed'])
+        yield ('storybook_single_flight_coalesced_total', 'counter', 'Requests that joined an identical call',
+               labels, stats['coalesced'])
+        yield ('storybook_single_flight_in_flight', 'gauge', 'Distinct calls in flight', labels, stats['in_flight'])
+
+def _start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_started = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.labels(g.metrics_route).inc()
+    if request.content_length:
+        HTTP_REQUEST_BYTES.labels(g.metrics_route).inc(request.content_length)
+
+def _finish_request_metrics(response):
+    route = g.get('metrics_route')
+    if route is None:
+        return response
+    started, method, status = g.metrics_started, request.method, response.status_code
+    if response.content_length:
+        HTTP_RESPONSE_BYTES.labels(route).inc(response.content_length)
+
+    def observe():
+        # Runs when the body has been sent, so streamed responses are timed to the last byte
+        HTTP_REQUEST_DURATION.labels(route, method, status).observe(time.perf_counter() - started)
+        HTTP_REQUESTS_IN_FLIGHT.labels(route).dec()
+    response.call_on_close(observe)
+    return response
+
+def _start_request_deadline():
+    route = request.url_rule.rule if request.url_rule else None
+    g.deadline_token = deadlines.start(deadlines.route_budget(route, request.headers.get(DEADLINE_HEADER)))
+
+def _end_request_deadline(error=None):
+    deadlines.end(g.pop('deadline_token', None))
+
+def _start_request_timing():
+    g.timing_token = start_trace()
+
+def _add_server_timing(response):
+    trace = current_trace()
+    if trace is not None:
+        # Streamed bodies are still being produced; their header covers the work done so far
+        response.headers['Server-Timing'] = trace.server_timing()
+        # Lets the cross-origin frontend read the breakdown through the Resource Timing API
+        response.headers['Timing-Allow-Origin'] = '*'
+    return response
+
+def _end_request_timing(error=None):
+    end_trace(g.pop('timing_token', None), f'{request.method} {request.path}')
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint; values are per process"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@api.route('/api/health', methods=['GET'])
 def health_check():
     try:
         pool_status = ApiKeyPool.get_pool_status()
@@ -563,7 +668,15 @@ def health_check():
             'status': 'healthy',
             'timestamp': datetime.now().isoformat(),
             'api_key_configured': bool(gemini_api_key),
-            'key_pool_status': pool_status
+            'key_pool_status': pool_status,
+            'image_cache': gemini_image_service.image_cache.stats() if gemini_image_service.image_cache else None,
+            'image_variants': image_variant_service.stats() if image_variant_service else None,
+            'text_cache': gemini_text_service.text_cache.stats() if gemini_text_service.text_cache else None,
+            'single_flight': {
+                'image': gemini_image_service.in_flight.stats(),
+                'text': gemini_text_service.in_flight.stats()
+            },
+            'logging': logging_stats()
         }), 200
     except Exception as e:
         return jsonify({
@@ -571,7 +684,7 @@ def health_check():
             'message': str(e)
         }), 500
 
-@app.route('/api/keys/update', methods=['POST'])
+@api.route('/api/keys/update', methods=['POST'])
 def update_api_keys():
     """Endpoint to receive and update API keys from frontend"""
     try:
@@ -586,8 +699,7 @@ def update_api_keys():
         api_keys = data.get('api_keys', [])
         app_name = data.get('app_name', 'unknown')
         
-        print(f"🔑 Received API key update request from: {app_name}")
-        print(f"🔑 Number of keys received: {len(api_keys)}")
+        logger.info("🔑 Received API key update request from: %s (%d keys)", app_name, len(api_keys))
         
         if not api_keys:
             return jsonify({
@@ -596,20 +708,15 @@ def update_api_keys():
             }), 400
         
         # Update the API key pool
-        success = ApiKeyPool.update_keys(api_keys)
+        success = ApiKeyPool.update_keys(api_keys, data.get('key_limits'))
         
         if success:
             # Immediately switch to using pool keys instead of fallback
-            current_key = ApiKeyPool.get_key()
+            current_key = _update_services_with_current_key()
             if current_key:
-                global gemini_api_key
-                gemini_api_key = current_key  # Update the global variable
-                gemini_image_service.initialize(current_key)
-                gemini_text_service.initialize(current_key)
-                genai.configure(api_key=current_key)
-                print(f"✅ Switched to pool key: {current_key[:10]}... (now using {len(api_keys)} keys)")
+                logger.info("✅ Switched to pool key: %.10s... (now using %d keys)", current_key, len(api_keys))
             else:
-                print("❌ Failed to get key from pool after update")
+                logger.error("❌ Failed to get key from pool after update")
             
             pool_status = ApiKeyPool.get_pool_status()
             return jsonify({
@@ -624,13 +731,13 @@ def update_api_keys():
             }), 400
             
     except Exception as e:
-        print(f"❌ Error updating API keys: {e}")
+        logger.error("❌ Error updating API keys: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
-@app.route('/api/keys/status', methods=['GET'])
+@api.route('/api/keys/status', methods=['GET'])
 def get_key_pool_status():
     """Get current status of the API key pool"""
     try:
@@ -645,20 +752,15 @@ def get_key_pool_status():
             'error': str(e)
         }), 500
 
-@app.route('/api/keys/rotate', methods=['POST'])
+@api.route('/api/keys/rotate', methods=['POST'])
 def manual_rotate_key():
     """Manually rotate to the next API key"""
     try:
         success = ApiKeyPool.rotate_key()
         if success:
+            KEY_ROTATIONS.labels('manual').inc()
             # Reinitialize services with the new key
-            current_key = ApiKeyPool.get_key()
-            if current_key:
-                global gemini_api_key
-                gemini_api_key = current_key  # Update the global variable
-                gemini_image_service.initialize(current_key)
-                gemini_text_service.initialize(current_key)
-                genai.configure(api_key=current_key)
+            _update_services_with_current_key()
             
             pool_status = ApiKeyPool.get_pool_status()
             return jsonify({
@@ -677,7 +779,7 @@ def manual_rotate_key():
             'error': str(e)
         }), 500
 
-@app.route('/api/stories/generate', methods=['POST'])
+@api.route('/api/stories/generate', methods=['POST'])
 def generate_story():
     try:
         data = request.get_json()
@@ -689,11 +791,25 @@ def generate_story():
         theme = data['theme']
         additional_context = data.get('additionalContext')
         
+        wants_stream = (request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+                        or 'text/event-stream' in request.headers.get('Accept', ''))
+        if wants_stream:
+            def generate_events():
+                for event, payload in story_service.generate_story_stream(prompt, theme, additional_context):
+                    yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+            
+            return Response(in_request_context(generate_events()), mimetype='text/event-stream', headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+        
         story = story_service.generate_story(prompt, theme, additional_context)
         
         return jsonify({
             'success': True,
-            'data': story
+            'data': story,
+            # Fallback pages stand in for anything the deadline cut short
+            'partial': deadlines.exceeded()
         })
     except Exception as e:
         return jsonify({
@@ -701,7 +817,68 @@ def generate_story():
             'error': str(e)
         }), 500
 
-@app.route('/api/feedback', methods=['POST'])
+@api.route('/api/stories/jobs', methods=['POST'])
+def create_story_job():
+    """Start story generation in the background and return a job id immediately"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'prompt' not in data or 'theme' not in data:
+            return jsonify({'success': False, 'error': 'Missing required fields'}), 400
+        
+        job_id = story_job_runner.submit({
+            'prompt': data['prompt'],
+            'theme': data['theme'],
+            'additionalContext': data.get('additionalContext'),
+            # Polled jobs default to image URLs so progress responses stay small
+            'imageMode': resolve_image_mode(data, default='reference'),
+            'imageBaseUrl': image_base_url()
+        })
+        status_url = f'/api/stories/jobs/{job_id}'
+        logger.info("📥 Queued story job %s", job_id)
+        
+        return jsonify({
+            'success': True,
+            'jobId': job_id,
+            'statusUrl': status_url
+        }), 202, {'Location': status_url}
+    except ImageModeUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except JobQueueFull as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503, {'Retry-After': '5'}
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@api.route('/api/stories/jobs/<job_id>', methods=['GET'])
+def get_story_job(job_id):
+    """Job status, progress and the pages finished so far"""
+    try:
+        job = story_job_runner.store.get(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        
+        job.pop('params', None)
+        if job['story'] is not None:
+            # A new dict: the store's copy is shallow and the story is shared with other polls
+            job['story'] = {**job['story'], 'pages': job['pages']}
+        
+        return jsonify({
+            'success': True,
+            'data': job
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@api.route('/api/feedback', methods=['POST'])
 def submit_feedback():
     try:
         data = request.get_json()
@@ -740,7 +917,7 @@ def submit_feedback():
             'error': str(e)
         }), 500
 
-@app.route('/api/feedback/options', methods=['GET'])
+@api.route('/api/feedback/options', methods=['GET'])
 def get_feedback_options():
     try:
         options = feedback_service.get_feedback_options()
@@ -754,7 +931,7 @@ def get_feedback_options():
             'error': str(e)
         }), 500
 
-@app.route('/api/feedback/<story_id>', methods=['GET'])
+@api.route('/api/feedback/<story_id>', methods=['GET'])
 def get_feedback(story_id):
     try:
         feedback = feedback_service.get_feedback_for_story(story_id)
@@ -769,7 +946,7 @@ def get_feedback(story_id):
             'error': str(e)
         }), 500
 
-@app.route('/api/feedback/<story_id>/stats', methods=['GET'])
+@api.route('/api/feedback/<story_id>/stats', methods=['GET'])
 def get_feedback_stats(story_id):
     try:
         stats = feedback_service.get_feedback_stats(story_id)
@@ -784,7 +961,7 @@ def get_feedback_stats(story_id):
             'error': str(e)
         }), 500
 
-@app.route('/api/generate-image', methods=['POST'])
+@api.route('/api/generate-image', methods=['POST'])
 def generate_single_image():
     """Generate a single image for story pages - optimized for Vercel timeout limits"""
     try:
@@ -794,7 +971,7 @@ def generate_single_image():
             return jsonify({'success': False, 'error': 'Missing prompt'}), 400
         
         prompt = data['prompt']
-        print(f"🖼️ Generating single image for prompt: {prompt[:100]}...")
+        logger.debug("🖼️ Generating single image for prompt: %.100s...", prompt, extra=sampled(10))
         
         if not gemini_api_key:
             return jsonify({
@@ -803,12 +980,24 @@ def generate_single_image():
             }), 500
         
         # Generate single image with timeout protection
-        result = gemini_image_service.generate_gemini_image(prompt)
+        image_mode = resolve_image_mode(data)
+        result = gemini_image_service.generate_gemini_image(
+            prompt, response_format='bytes' if image_mode == 'reference' else 'base64'
+        )
         
-        if result['success'] and result.get('imageBytes'):
-            # Convert image bytes to base64 for JSON response
-            image_base64 = base64.b64encode(result['imageBytes']).decode('utf-8')
-            print(f"✅ Image generated successfully (base64 length: {len(image_base64)})")
+        if result['success'] and image_mode == 'reference' and (result.get('imageId') or result.get('imageBytes')):
+            image_id, image_url = store_image_reference(result, image_base_url())
+            logger.debug("✅ Image generated successfully (%s)", image_url, extra=sampled(10))
+            
+            return jsonify({
+                'success': True,
+                'imageId': image_id,
+                'imageUrl': image_url
+            })
+        elif result['success'] and result.get('imageBase64'):
+            # Upstream base64 passed straight through
+            image_base64 = result['imageBase64']
+            logger.debug("✅ Image generated successfully (base64 length: %d)", len(image_base64), extra=sampled(10))
             
             return jsonify({
                 'success': True,
@@ -816,38 +1005,177 @@ def generate_single_image():
             })
         else:
             error_msg = result.get('error', 'Failed to generate image')
-            print(f"❌ Image generation failed: {error_msg}")
+            logger.warning("❌ Image generation failed: %s", error_msg)
             return jsonify({
                 'success': False,
-                'error': error_msg
-            }), 500
+                'error': error_msg,
+                'deadlineExceeded': bool(result.get('deadlineExceeded'))
+            }), 504 if result.get('deadlineExceeded') else 500
             
+    except ImageModeUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
-        print(f"❌ Exception in generate_single_image: {e}")
+        logger.exception("❌ Exception in generate_single_image: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 # Keep the old endpoint for backward compatibility
-@app.route('/api/images/generate', methods=['POST'])
+@api.route('/api/images/generate', methods=['POST'])
 def generate_image_legacy():
     """Legacy endpoint - redirects to new single image endpoint"""
     return generate_single_image()
 
-@app.route('/api/images/<filename>')
+@api.route('/api/images/generate-batch', methods=['POST'])
+def generate_image_batch():
+    """Generate several images concurrently, streaming each result as an NDJSON line when it finishes"""
+    try:
+        data = request.get_json()
+        
+        if not data or not isinstance(data.get('prompts'), list) or not data['prompts']:
+            return jsonify({'success': False, 'error': 'Missing prompts'}), 400
+        
+        prompts = data['prompts']
+        if len(prompts) > MAX_BATCH_IMAGES:
+            return jsonify({
+                'success': False,
+                'error': f'Too many prompts (max {MAX_BATCH_IMAGES})'
+            }), 400
+        if not all(isinstance(prompt, str) and prompt.strip() for prompt in prompts):
+            return jsonify({'success': False, 'error': 'Prompts must be non-empty strings'}), 400
+        
+        if not gemini_api_key:
+            return jsonify({
+                'success': False,
+                'error': 'Gemini API key not configured'
+            }), 500
+        
+        image_mode = resolve_image_mode(data)
+        base_url = image_base_url()
+        logger.info("🖼️ Generating batch of %d images (%s)...", len(prompts), image_mode)
+        
+        def generate_records():
+            executor = ThreadPoolExecutor(
+                max_workers=get_image_fanout_workers(len(prompts)),
+                thread_name_prefix='batch-image'
+            )
+            try:
+                # Workers run in copies of the request context, so they share its deadline
+                futures = {
+                    executor.submit(contextvars.copy_context().run, gemini_image_service.generate_gemini_image, prompt,
+                                    response_format='bytes' if image_mode == 'reference' else 'base64'): index
+                    for index, prompt in enumerate(prompts)
+                }
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {'success': False, 'error': str(e)}
+                    
+                    if result['success'] and image_mode == 'reference' and (result.get('imageId') or result.get('imageBytes')):
+                        image_id, image_url = store_image_reference(result, base_url)
+                        record = {
+                            'index': index,
+                            'success': True,
+                            'imageId': image_id,
+                            'imageUrl': image_url
+                        }
+                    elif result['success'] and result.get('imageBase64'):
+                        record = {
+                            'index': index,
+                            'success': True,
+                            'imageBase64': result['imageBase64']
+                        }
+                    else:
+                        record = {
+                            'index': index,
+                            'success': False,
+                            'error': result.get('error', 'Failed to generate image'),
+                            'deadlineExceeded': bool(result.get('deadlineExceeded'))
+                        }
+                    yield json.dumps(record) + '\n'
+            finally:
+                # Stop queued work if the client went away mid-stream
+                executor.shutdown(wait=False, cancel_futures=True)
+        
+        return Response(in_request_context(generate_records()), mimetype='application/x-ndjson')
+        
+    except ImageModeUnavailable as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("❌ Exception in generate_image_batch: %s", e)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@lru_cache(maxsize=1024)
+def _file_content_etag(path, mtime_ns, size):
+    """Content hash of a legacy image file, memoized until the file changes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@api.route('/api/images/<filename>')
 def serve_image(filename):
-    """Serve generated images"""
+    """Serve generated images
+
+    send_file with conditional=True answers If-None-Match with 304 and Range
+    requests with 206, and streams the file through the server's
+    wsgi.file_wrapper (sendfile) or X-Sendfile instead of reading it in Python.
+    """
     try:
-        image_path = os.path.join('temp_images', filename)
-        if os.path.exists(image_path):
-            return send_file(image_path, mimetype='image/jpeg')
+        # Content-addressed images stored by reference mode never change, so
+        # the content id is the ETag and clients may cache them forever
+        image_id, ext = os.path.splitext(filename)
+        if ext == '.jpg' and gemini_image_service.image_cache:
+            blob_path = gemini_image_service.image_cache.blob_path(image_id)
+            if blob_path:
+                # Blobs keep the .jpg name whatever they hold; Gemini returns PNG
+                mimetype = gemini_image_service.image_cache.mime_type(image_id)
+                # ?w=400&fmt=webp&q=75 serves a resized/re-encoded variant
+                variant = ImageVariantService.parse_options(request.args) if image_variant_service else None
+                if variant:
+                    width, fmt, quality = variant
+                    image_id, blob_path = image_variant_service.get_variant(image_id, blob_path, width, fmt, quality)
+                    mimetype = ImageVariantService.mimetype(fmt)
+                response = send_file(
+                    os.path.abspath(blob_path),
+                    mimetype=mimetype,
+                    conditional=True,
+                    etag=image_id,
+                    max_age=IMMUTABLE_IMAGE_MAX_AGE
+                )
+                response.cache_control.public = True
+                response.cache_control.immutable = True
+                return response
+        
+        # Legacy temp_images files can be overwritten, so clients revalidate
+        # every time against a content-hash ETag
+        image_path = safe_join('temp_images', filename)
+        if image_path and os.path.isfile(image_path):
+            stat = os.stat(image_path)
+            response = send_file(
+                os.path.abspath(image_path),
+                mimetype='image/jpeg',
+                conditional=True,
+                etag=_file_content_etag(image_path, stat.st_mtime_ns, stat.st_size),
+                max_age=0
+            )
+            response.cache_control.no_cache = True
+            return response
         else:
             return jsonify({'error': 'Image not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/text/generate', methods=['POST'])
+@api.route('/api/text/generate', methods=['POST'])
 def generate_text():
     try:
         data = request.get_json()
@@ -859,6 +1187,7 @@ def generate_text():
         system_instruction = data.get('systemInstruction')
         generation_config = data.get('generationConfig')
         images = data.get('images', [])  # Optional reference images
+        bypass_cache = bool(data.get('bypassCache', False))
         
         if not gemini_api_key:
             return jsonify({
@@ -870,7 +1199,8 @@ def generate_text():
             prompt=prompt,
             system_instruction=system_instruction,
             generation_config=generation_config,
-            images=images
+            images=images,
+            bypass_cache=bypass_cache
         )
         
         return jsonify({
@@ -878,12 +1208,60 @@ def generate_text():
             'text': generated_text
         })
         
+    except DeadlineExceeded as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'deadlineExceeded': True
+        }), 504
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
+def create_app():
+    """Build the Flask app
+    
+    Sets up logging, builds the services, loads the key pool and wires the
+    key into the services; Firebase, the Gemini SDK clients and Pillow are
+    initialized on first use.
+    """
+    # Before the services are built, so their startup messages go through the queue
+    configure_logging()
+    _build_services()
+    
+    app = Flask(__name__)
+    CORS(app)
+    app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
+    
+    # Initialize API Key Pool
+    ApiKeyPool.init('ai_storybook_backend')
+    ApiKeyPool._update_services_with_current_key = _update_services_with_current_key
+    if _update_services_with_current_key():
+        logger.info("Gemini API configured with key: %.10s...", gemini_api_key)
+    else:
+        logger.warning("No Gemini API key found. Running in development mode.")
+    
+    REGISTRY.register_collector(ApiKeyPool.metric_samples)
+    REGISTRY.register_collector(cache_metric_samples)
+    app.before_request(_start_request_metrics)
+    app.after_request(_finish_request_metrics)
+    app.before_request(_start_request_timing)
+    app.after_request(_add_server_timing)
+    app.teardown_request(_end_request_timing)
+    app.before_request(_start_request_deadline)
+    app.teardown_request(_end_request_deadline)
+    
+    app.register_blueprint(api)
+    return app
+
 if __name__ == '__main__':
+    app = create_app()
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=True, use_reloader=False)
+elif __name__ != '__mp_main__':
+    # Module-level app for gunicorn (app:app) and Vercel. Not built in the image
+    # variant pool's spawn workers, which re-import `python app.py` as __mp_main__
+    # and only need image_variants and Pillow.
+    app = create_app()
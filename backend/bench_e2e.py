@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput benchmark against the local Gemini stub
+
+Starts gemini_stub_server in-process, launches the backend pointed at it
+(or uses --backend-url), then drives /api/stories/generate,
+/api/generate-image and /api/text/generate and reports throughput,
+p50/p95/p99 latency, errors and upstream calls per request.
+
+    python bench_e2e.py --requests 40 --concurrency 8 --rate-429 0.05
+    python bench_e2e.py --json results.json   # machine-readable, for comparing runs
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gemini_stub_server import start_stub_server
+
+# Prompts carry a per-run tag so a reused backend never answers from its caches
+RUN_TAG = f'{int(time.time())}-{os.getpid()}'
+
+SCENARIOS = {
+    'story': ('/api/stories/generate', lambda i: {'prompt': f'A shy dragon who learns to bake bread #{RUN_TAG}-{i}', 'theme': 'Fantasy'}),
+    'image': ('/api/generate-image', lambda i: {'prompt': f'A shy dragon baking bread in a cozy kitchen #{RUN_TAG}-{i}'}),
+    'text': ('/api/text/generate', lambda i: {'prompt': f'Write a two-line poem about the moon #{RUN_TAG}-{i}'}),
+}
+
+# Fewest upstream calls a request can make without skipping Gemini: one text
+# call per story (images are generated separately) and one call per image/text
+MIN_UPSTREAM_CALLS_PER_REQUEST = {'story': 1.0, 'image': 1.0, 'text': 1.0}
+
+# The services turn upstream failures into strings inside a 200 response
+ERROR_PREFIXES = ('Error', 'Rate limit')
+# Pages the story service makes up when the upstream text is missing or short
+FALLBACK_MARKERS = ('of our amazing story!', 'And the adventure continued with')
+
+
+def http_json(url, payload=None, timeout=300):
+    """POST (or GET without payload) JSON; returns (status, parsed body or None)"""
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read() or b'null')
+    except urllib.error.HTTPError as e:
+        try:
+            return e.code, json.loads(e.read() or b'null')
+        except ValueError:
+            return e.code, None
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def start_backend(port, stub_url, work_dir, key_rpm):
+    """Launch app.py against the stub in its own working directory (keys file, caches, job DB)"""
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        GEMINI_API_BASE_URL=stub_url,
+        GEMINI_API_KEY='AIzaBenchFallbackKey-xxxxxxxxxxxxxxxxxxx',
+        GEMINI_KEY_RPM=str(key_rpm),
+        GEMINI_KEY_RPD=str(key_rpm * 1440),
+        PYTHONUNBUFFERED='1'
+    )
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    log = open(os.path.join(work_dir, 'backend.log'), 'w')
+    process = subprocess.Popen([sys.executable, app_path], cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Backend exited with {process.returncode}; see {log.name}')
+        try:
+            if http_json(f'http://127.0.0.1:{port}/api/health', timeout=2)[0] == 200:
+                return process
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError(f'Backend did not become healthy; see {log.name}')
+
+
+def payload_failed(name, body):
+    """True if a successful-looking response carries an error string or fallback content"""
+    if name == 'text':
+        text = body.get('text') or ''
+        return not text or text.startswith(ERROR_PREFIXES)
+    if name == 'story':
+        story = body.get('data') or {}
+        scripts = [page.get('script') or '' for page in story.get('pages') or []]
+        return (body.get('partial') or not scripts
+                or (story.get('title') or '').startswith(ERROR_PREFIXES)
+                or any(script.startswith(ERROR_PREFIXES) or any(marker in script for marker in FALLBACK_MARKERS)
+                       for script in scripts))
+    if name == 'image':
+        return not (body.get('imageBase64') or body.get('imageUrl'))
+    return False
+
+
+def run_scenario(name, backend_url, stub_url, requests, concurrency):
+    path, make_payload = SCENARIOS[name]
+    http_json(f'{stub_url}/stats/reset', {})
+
+    def one(i):
+        started = time.perf_counter()
+        try:
+            status, body = http_json(f'{backend_url}{path}', make_payload(i))
+            ok = status == 200 and bool(body and body.get('success')) and not payload_failed(name, body)
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    upstream = http_json(f'{stub_url}/stats')[1]
+    latencies = [latency * 1000 for latency, _ in results]
+    calls_per_request = upstream['calls'] / requests
+    return {
+        'scenario': name,
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 50), 1),
+        'p95_ms': round(percentile(latencies, 95), 1),
+        'p99_ms': round(percentile(latencies, 99), 1),
+        'errors': sum(1 for _, ok in results if not ok),
+        'upstream_calls': upstream['calls'],
+        'upstream_calls_per_request': round(calls_per_request, 2),
+        'upstream_by_status': upstream['by_status'],
+        # Fewer calls than the floor means requests were answered without reaching Gemini
+        'upstream_below_floor': calls_per_request < MIN_UPSTREAM_CALLS_PER_REQUEST.get(name, 0.0)
+    }
+
+
+def main():
+    """Run the end-to-end benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', default='story,image,text')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--keys', type=int, default=4, help='Fake API keys loaded into the pool')
+    parser.add_argument('--key-rpm', type=int, default=100000, help='Per-key RPM given to the pool')
+    parser.add_argument('--text-latency', default='lognormal:900,0.4')
+    parser.add_argument('--image-latency', default='lognormal:4000,0.3')
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-503', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--backend-port', type=int, default=8181)
+    parser.add_argument('--backend-url', help='Use an already running backend (it must point at --stub-port)')
+    parser.add_argument('--stub-port', type=int, default=0)
+    parser.add_argument('--json', help='Also write results to this file')
+    args = parser.parse_args()
+
+    stub = start_stub_server(port=args.stub_port, text_latency=args.text_latency, image_latency=args.image_latency,
+                             rate_429=args.rate_429, rate_503=args.rate_503, seed=args.seed)
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}'
+
+    print(f"🚀 End-to-end benchmark ({args.requests} requests x {args.concurrency} concurrent per scenario)")
+    print(f"🧪 Stub {stub_url}: text {args.text_latency}, image {args.image_latency}, "
+          f"429 {args.rate_429:.0%}, 503 {args.rate_503:.0%}")
+    print("=" * 50)
+
+    results = []
+    backend = None
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            backend_url = args.backend_url
+            if not backend_url:
+                backend = start_backend(args.backend_port, stub_url, work_dir, args.key_rpm)
+                backend_url = f'http://127.0.0.1:{args.backend_port}'
+            keys = [f'AIza{i:02d}BenchE2E-xxxxxxxxxxxxxxxxxxxxxxxxx' for i in range(args.keys)]
+            http_json(f'{backend_url}/api/keys/update', {'api_keys': keys, 'app_name': 'bench_e2e'})
+
+            for name in [name.strip() for name in args.scenarios.split(',') if name.strip()]:
+                result = run_scenario(name, backend_url, stub_url, args.requests, args.concurrency)
+                results.append(result)
+                print(f"\n📊 {name}: {result['throughput_rps']} req/s over {result['seconds']}s")
+                print(f"   ⏱️ p50 {result['p50_ms']} ms  p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms")
+                print(f"   🔁 upstream calls/request {result['upstream_calls_per_request']} {result['upstream_by_status']}")
+                if result['upstream_below_floor']:
+                    print(f"   ❌ Below the expected {MIN_UPSTREAM_CALLS_PER_REQUEST[name]} upstream calls/request")
+                errors = result['errors']
+                print(f"   {'✅ No errors' if not errors else f'❌ {errors} errors'}")
+        finally:
+            if backend:
+                backend.terminate()
+                backend.wait(10)
+            stub.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Results written to {args.json}")
+    return 0 if all(result['errors'] == 0 and not result['upstream_below_floor'] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
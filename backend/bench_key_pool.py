@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Contention benchmark for ApiKeyPool.get_key under many threads
+
+Runs get_key from 32 threads while a background thread keeps rotating and
+swapping keys, then reports throughput and checks that no usage increments
+were lost and no reader ever failed.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Quotas high enough that every call takes a token, i.e. the locked bucket path
+os.environ.setdefault('GEMINI_KEY_RPM', '1000000000')
+os.environ.setdefault('GEMINI_KEY_RPD', '1000000000')
+
+from api_key_pool import ApiKeyPool
+
+THREADS = int(os.getenv('BENCH_THREADS', '32'))
+CALLS_PER_THREAD = int(os.getenv('BENCH_CALLS_PER_THREAD', '20000'))
+KEYS = [f'AIza{i:02d}Bench-xxxxxxxxxxxxxxxxxxxxxxxxxxx' for i in range(8)]
+
+
+def run_get_key(threads, calls_per_thread, churn):
+    """Hammer get_key; optionally rotate/update concurrently. Returns (seconds, errors)"""
+    ApiKeyPool.update_keys(KEYS)
+    errors = []
+    start_barrier = threading.Barrier(threads + 1)
+    stop_churn = threading.Event()
+
+    def worker():
+        start_barrier.wait()
+        try:
+            for _ in range(calls_per_thread):
+                if ApiKeyPool.get_key() is None:
+                    errors.append('get_key returned None')
+        except Exception as e:
+            errors.append(repr(e))
+
+    def churner():
+        try:
+            while not stop_churn.is_set():
+                ApiKeyPool.rotate_key()
+                ApiKeyPool.update_keys(list(reversed(ApiKeyPool.get_keys())))
+                time.sleep(0.001)
+        except Exception as e:
+            errors.append(f'churner: {e!r}')
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    churn_thread = threading.Thread(target=churner) if churn else None
+
+    start_barrier.wait()
+    started = time.perf_counter()
+    if churn_thread:
+        churn_thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop_churn.set()
+    if churn_thread:
+        churn_thread.join()
+    return elapsed, errors
+
+
+def main():
+    """Run the contention benchmark"""
+    print(f"🚀 ApiKeyPool contention benchmark ({THREADS} threads x {CALLS_PER_THREAD} calls)")
+    print("=" * 50)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ApiKeyPool._keys_file = os.path.join(tmp_dir, 'api_keys_pool.json')
+        total_calls = THREADS * CALLS_PER_THREAD
+
+        # get_key logs every call; keep the benchmark measuring the pool, not the terminal
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            steady_seconds, steady_errors = run_get_key(THREADS, CALLS_PER_THREAD, churn=False)
+            steady_usage = sum(ApiKeyPool.get_pool_status()['usage_counts'].values())
+            churn_seconds, churn_errors = run_get_key(THREADS, CALLS_PER_THREAD, churn=True)
+            # Write the keys file while its directory still exists, not at exit
+            ApiKeyPool.flush()
+
+    print(f"\n1️⃣ Steady state (no writers)")
+    print(f"   ⏱️ {steady_seconds:.3f}s  →  {total_calls / steady_seconds:,.0f} get_key/s")
+    print(f"   📊 Usage counted: {steady_usage}/{total_calls} ({'no lost updates ✅' if steady_usage == total_calls else 'LOST UPDATES ❌'})")
+    print(f"   {'✅ No errors' if not steady_errors else f'❌ {len(steady_errors)} errors, first: {steady_errors[0]}'}")
+
+    print(f"\n2️⃣ With concurrent rotate_key/update_keys churn")
+    print(f"   ⏱️ {churn_seconds:.3f}s  →  {total_calls / churn_seconds:,.0f} get_key/s")
+    print(f"   {'✅ No errors' if not churn_errors else f'❌ {len(churn_errors)} errors, first: {churn_errors[0]}'}")
+
+    ok = steady_usage == total_calls and not steady_errors and not churn_errors
+    print(f"\n{'✅ Benchmark passed' if ok else '❌ Benchmark found races or errors'}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import os
+import time
+import contextvars
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, Optional
+
+# Just under Vercel's 60 s function limit, leaving time to build the response
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', '55'))
+# Per-route overrides, e.g. "/api/text/generate=25,/api/generate-image=50"; 0 disables the deadline
+ROUTE_DEADLINES = os.getenv('ROUTE_DEADLINES', '')
+# No new upstream attempt (first try, retry or rotation) starts with less than this left
+DEADLINE_MIN_ATTEMPT_SECONDS = float(os.getenv('DEADLINE_MIN_ATTEMPT_SECONDS', '2'))
+DEADLINE_HEADER = 'X-Request-Deadline-Ms'
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the request's budget cannot cover another upstream attempt"""
+
+
+def _parse_route_deadlines(spec: str) -> Dict[str, float]:
+    budgets = {}
+    for entry in spec.split(','):
+        route, _, seconds = entry.strip().partition('=')
+        if route and seconds:
+            budgets[route.strip()] = float(seconds)
+    return budgets
+
+
+_ROUTE_BUDGETS = _parse_route_deadlines(ROUTE_DEADLINES)
+
+
+class Deadline:
+    """Absolute deadline for one request, on the time.monotonic() clock"""
+
+    __slots__ = ('expires_at', 'budget', 'exceeded')
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+        self.exceeded = False  # Set once anything gave up or cut work short because of it
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, default: float) -> float:
+        """Timeout for one upstream call: the default, capped at what is left"""
+        return max(0.0, min(default, self.remaining()))
+
+    def can_attempt(self, min_seconds: float = DEADLINE_MIN_ATTEMPT_SECONDS) -> bool:
+        if self.remaining() >= min_seconds:
+            return True
+        self.exceeded = True
+        return False
+
+    def check(self, what: str = 'upstream call', min_seconds: float = DEADLINE_MIN_ATTEMPT_SECONDS):
+        """Raise DeadlineExceeded unless another attempt fits in the budget"""
+        if not self.can_attempt(min_seconds):
+            raise DeadlineExceeded(
+                f'Request deadline of {self.budget:.1f}s reached; {what} skipped '
+                f'({max(0.0, self.remaining()):.1f}s left)'
+            )
+
+
+_deadline: ContextVar[Optional[Deadline]] = ContextVar('request_deadline', default=None)
+
+
+def route_budget(route: Optional[str], client_ms: Optional[str] = None) -> Optional[float]:
+    """Budget in seconds for a route, shortened (never extended) by a client X-Request-Deadline-Ms"""
+    budget = _ROUTE_BUDGETS.get(route, REQUEST_DEADLINE_SECONDS)
+    if client_ms:
+        try:
+            client_budget = float(client_ms) / 1000
+        except ValueError:
+            client_budget = None
+        if client_budget is not None and client_budget > 0:
+            budget = min(budget, client_budget) if budget > 0 else client_budget
+    return budget if budget > 0 else None
+
+
+def start(budget: Optional[float]):
+    """Attach a deadline to the current context; returns a token for end(), or None without a budget"""
+    if budget is None:
+        return None
+    return _deadline.set(Deadline(budget))
+
+
+def end(token):
+    if token is not None:
+        _deadline.reset(token)
+
+
+def current() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def timeout(default: float) -> float:
+    """Per-attempt upstream timeout: default, capped by the current request's remaining budget"""
+    deadline = _deadline.get()
+    return default if deadline is None else deadline.timeout(default)
+
+
+def can_attempt(min_seconds: float = DEADLINE_MIN_ATTEMPT_SECONDS) -> bool:
+    deadline = _deadline.get()
+    return deadline is None or deadline.can_attempt(min_seconds)
+
+
+def check(what: str = 'upstream call', min_seconds: float = DEADLINE_MIN_ATTEMPT_SECONDS):
+    deadline = _deadline.get()
+    if deadline is not None:
+        deadline.check(what, min_seconds)
+
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def cut_short(attempt_timeout: float, default: float) -> bool:
+    """Whether an attempt that just failed had its timeout capped by a deadline that has now run out
+
+    Tells a timeout caused by the request's own budget apart from a slow
+    upstream; marks the deadline as exceeded when it was.
+    """
+    deadline = _deadline.get()
+    if deadline is None or attempt_timeout >= default or deadline.remaining() > 0.5:
+        return False
+    deadline.exceeded = True
+    return True
+
+
+def mark_exceeded():
+    """Record that work was cut short because the current request ran out of time"""
+    deadline = _deadline.get()
+    if deadline is not None:
+        deadline.exceeded = True
+
+
+def exceeded() -> bool:
+    """Whether the current request had work cut short by its deadline"""
+    deadline = _deadline.get()
+    return deadline is not None and deadline.exceeded
+
+
+def in_request_context(iterable: Iterable) -> Iterator:
+    """Iterate a streamed response body in the context of the request that created it
+
+    Flask sends a generator body after the request hooks have run, so the
+    deadline (and timing trace) would otherwise be gone. Each step runs inside
+    a copy of the context captured here; nothing leaks into the server thread.
+    """
+    # Captured now, while the view runs; the generator below starts only when the body is sent
+    context = contextvars.copy_context()
+    iterator = iter(iterable)
+
+    def run():
+        try:
+            while True:
+                try:
+                    item = context.run(next, iterator)
+                except StopIteration:
+                    return
+                yield item
+        finally:
+            # A client disconnect closes this wrapper; close the body in its own context too
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                context.run(close)
+    return run()
@@ -1,6 +1,8 @@
+import logging
 from datetime import datetime
 from typing import Dict, Any, List, Optional
-from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
 
 class FeedbackService:
     def __init__(self, db):
@@ -53,6 +55,8 @@ class FeedbackService:
                     'error': 'Please provide feedback.'
                 }
             
+            from firebase_admin import firestore  # Deferred; only needed when feedback is stored
+            
             # Prepare feedback data
             feedback_data = {
                 'feedbackType': feedback_type,
@@ -72,7 +76,7 @@ class FeedbackService:
             }
             
         except Exception as e:
-            print(f"Error submitting feedback: {e}")
+            logger.error("Error submitting feedback: %s", e)
             return {
                 'success': False,
                 'error': f'Failed to submit feedback: {e}'
@@ -96,7 +100,7 @@ class FeedbackService:
             
             return feedback_list
         except Exception as e:
-            print(f"Error getting feedback for story: {e}")
+            logger.error("Error getting feedback for story: %s", e)
             return []
     
     def get_feedback_stats(self, story_id: str) -> Dict[str, Any]:
@@ -137,7 +141,7 @@ class FeedbackService:
             }
             
         except Exception as e:
-            print(f"Error getting feedback stats: {e}")
+            logger.error("Error getting feedback stats: %s", e)
             return {
                 'totalFeedback': 0,
                 'averageRating': 0.0,
@@ -1,34 +1,344 @@
 import os
 import json
+import atexit
+import time
 import base64
-import requests
+import logging
+import asyncio
+import threading
+import concurrent.futures
 from typing import Optional, List, Dict, Any
-from PIL import Image
-import io
 
-class GeminiImageService:
+from api_key_pool import ApiKeyPool
+from image_cache import ImageCache
+from image_preprocessing import PreparedImage, prepare_reference_images
+from metrics import UPSTREAM_IN_FLIGHT, UPSTREAM_RESPONSE_BYTES, UPSTREAM_RETRIES, observe_upstream
+from logging_setup import sampled
+from single_flight import AsyncSingleFlight
+from timing import span, record
+import deadlines
+
+logger = logging.getLogger(__name__)
+
+GEMINI_API_BASE_URL = os.getenv('GEMINI_API_BASE_URL', 'https://generativelanguage.googleapis.com')
+GEMINI_IMAGE_MODEL = 'gemini-2.0-flash-preview-image-generation'
+IMAGE_REQUEST_TIMEOUT = float(os.getenv('IMAGE_REQUEST_TIMEOUT', '60'))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', '64'))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv('UPSTREAM_KEEPALIVE_EXPIRY', '60'))
+IMAGE_CACHE_ENABLED = os.getenv('IMAGE_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# google.rpc status names that mean "this key is throttled or the model is busy, try another key"
+THROTTLE_ERROR_STATUSES = ('RESOURCE_EXHAUSTED', 'UNAVAILABLE')
+MIN_IMAGE_BYTES = 1000
+
+def _deadline_result(attempts: int) -> Dict[str, Any]:
+    """Failure returned when the request's deadline leaves no room for (another) attempt"""
+    return {
+        'success': False,
+        'error': f'Request deadline reached after {attempts} attempt(s); image not generated',
+        'deadlineExceeded': True
+    }
+
+def _parse_error(body: bytes):
+    """(status, message) from a google.rpc error body, tolerating non-JSON bodies"""
+    try:
+        error = json.loads(body).get('error') or {}
+        return error.get('status'), error.get('message') or ''
+    except (ValueError, AttributeError):
+        return None, body[:500].decode('utf-8', 'replace')
+
+def _split_inline_image(body: bytearray):
+    """Parse a generateContent response without copying the image payload
+
+    The base64 image string is by far the largest thing in the body. It is
+    located with a byte scan and returned as a memoryview into body, while
+    only the remaining (small) JSON around it is parsed, with the image's
+    data field left empty. Returns (parsed response, image data or None,
+    image mimeType); falls back to a full parse if the body looks unusual.
+    """
+    marker = body.find(b'"inlineData"')
+    data_key = body.find(b'"data"', marker) if marker > 0 and body[marker - 1] != 0x5c else -1
+    if data_key != -1:
+        start = body.find(b'"', data_key + len(b'"data"') + 1) + 1
+        end = body.find(b'"', start) if start > 0 else -1
+        try:
+            data = json.loads(bytes(body[:start]) + bytes(body[end:])) if end != -1 else {}
+        except ValueError:
+            data = {}
+        for candidate in data.get('candidates') or []:
+            for part in (candidate.get('content') or {}).get('parts') or []:
+                inline = part.get('inlineData') or {}
+                if inline.get('data') == '':
+                    return data, memoryview(body)[start:end], inline.get('mimeType', 'image/jpeg')
+    # No image (or an unexpected layout): parse everything
+    data = json.loads(body)
+    for candidate in data.get('candidates') or []:
+        for part in (candidate.get('content') or {}).get('parts') or []:
+            inline = part.get('inlineData') or {}
+            if inline.get('data'):
+                return data, memoryview(inline['data'].encode('ascii')), inline.get('mimeType', 'image/jpeg')
+    return data, None, None
+
+class _AsyncUpstreamEngine:
+    """Background event loop owning one shared HTTP/2 client for all image requests
+    
+    Synchronous callers submit coroutines with run(); the loop thread and the
+    connection pool are created on first use and recreated after a fork, so
+    gunicorn workers never share sockets with their parent.
+    """
+    
     def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._client = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+    
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._client = None
+    
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='gemini-upstream-loop', daemon=True)
+                thread.start()
+                self._loop = loop
+            return self._loop
+    
+    def client(self):
+        """Shared keep-alive client; must be called from the engine loop"""
+        if self._client is None:
+            import httpx  # Deferred to the first image request to keep cold starts short
+            self._client = httpx.AsyncClient(
+                base_url=GEMINI_API_BASE_URL,
+                http2=True,
+                timeout=httpx.Timeout(IMAGE_REQUEST_TIMEOUT, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=UPSTREAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS,
+                    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+                )
+            )
+        return self._client
+    
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run a coroutine on the engine loop and wait for it, cancelling it on timeout
+        
+        The task runs in a copy of the caller's context (call_soon_threadsafe
+        captures it), so the request's trace reaches the coroutine.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+    
+    def close(self):
+        """Close pooled connections and stop the loop"""
+        loop = self._loop
+        if loop is None:
+            return
+        if self._client is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result(5)
+            except Exception as e:
+                logger.warning('Error closing upstream client: %s', e)
+        loop.call_soon_threadsafe(loop.stop)
+        self._reset()
+
+_engine = _AsyncUpstreamEngine()
+atexit.register(_engine.close)
+
+class GeminiImageService:
+    max_retries = 3
+    
+    def __init__(self, key_provider=ApiKeyPool):
+        """key_provider supplies and tracks API keys (get_key, get_keys, report_success, handle_rate_limit_error)"""
+        self.key_provider = key_provider
         self._api_key = None
+        self.image_cache = None
+        self.in_flight = AsyncSingleFlight()  # Only used on the upstream engine's loop
+        if IMAGE_CACHE_ENABLED:
+            try:
+                self.image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+            except Exception as e:
+                logger.warning("⚠️ Image cache disabled: %s", e)
     
     def initialize(self, api_key: str):
         """Initialize the service with API key"""
         self._api_key = api_key
     
-    def generate_gemini_image(self, prompt: str, images: Optional[List[bytes]] = None) -> Dict[str, Any]:
+    def generate_gemini_image(self, prompt: str, images: Optional[List[bytes]] = None,
+                              timeout: Optional[float] = None,
+                              response_format: str = 'bytes') -> Dict[str, Any]:
         """
         Generate image using Gemini API
         
+        Thin synchronous wrapper around agenerate_gemini_image for existing callers.
+        
         Args:
             prompt: Text prompt for image generation
             images: Optional list of image bytes for reference
+            timeout: Per-attempt upstream timeout in seconds
+            response_format: 'bytes' for imageBytes, 'base64' for imageBase64
             
         Returns:
-            Dict with success status, image bytes, message, and error
+            Dict with success status, image bytes (or base64), mimeType, message, and error
+        """
+        timeout = timeout or IMAGE_REQUEST_TIMEOUT
+        # Bound the wait to every retry timing out, plus slack for rotation, and
+        # never past the request's deadline
+        wait = timeout * self.max_retries + 5
+        remaining = deadlines.remaining()
+        if remaining is not None:
+            wait = min(wait, max(0.0, remaining) + 1)
+        try:
+            return _engine.run(self.agenerate_gemini_image(prompt, images, timeout, response_format), timeout=wait)
+        except concurrent.futures.TimeoutError:
+            if remaining is not None and deadlines.remaining() <= 0:
+                deadlines.mark_exceeded()
+                return _deadline_result(0)
+            return {
+                'success': False,
+                'error': 'Image generation timed out'
+            }
+    
+    async def agenerate_gemini_image(self, prompt: str, images: Optional[List[bytes]] = None,
+                                     timeout: Optional[float] = None,
+                                     response_format: str = 'bytes') -> Dict[str, Any]:
+        """
+        Generate image using Gemini API on the shared asyncio connection pool
+        
+        Args:
+            prompt: Text prompt for image generation
+            images: Optional list of image bytes for reference
+            timeout: Per-attempt upstream timeout in seconds, capped by the
+                remaining request deadline (see deadlines.py)
+            response_format: 'bytes' for imageBytes, 'base64' for imageBase64.
+                With 'base64' the upstream payload is passed through as-is and
+                only decoded when the image cache needs the bytes.
+            
+        Returns:
+            Dict with success status, image bytes (or base64), mimeType, message, and error.
+            When the deadline cuts generation short, deadlineExceeded is True.
+            
+        Concurrent identical requests (same prompt, references and format) share
+        one upstream call and its result, success or failure. A caller whose
+        deadline is shorter than the shared call stops waiting at its deadline;
+        one whose shared call was cut short by another caller's deadline starts
+        a fresh call if it still has time.
         """
+        timeout = timeout or IMAGE_REQUEST_TIMEOUT
+        
+        try:
+            # Memoized by content hash, so a reference reused on every page is encoded once
+            with span('image.prepare'):
+                prepared_images = await asyncio.to_thread(prepare_reference_images, images) if images else []
+        except ValueError as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+        
+        request_key = ImageCache.make_key(prompt, [image.data for image in prepared_images], GEMINI_IMAGE_MODEL)
+        # Spans inside the shared call land in the trace of the caller that started it;
+        # image.generate shows every caller's wait
+        with span('image.generate'):
+            while True:
+                # The shared call runs under the deadline of the caller that started it
+                call = self.in_flight.do(
+                    f'{request_key}:{response_format}',
+                    lambda: self._agenerate_coalesced(prompt, prepared_images, timeout, response_format, request_key)
+                )
+                remaining = deadlines.remaining()
+                try:
+                    # The shared call is shielded, so giving up here never cancels it for the others
+                    result = await (call if remaining is None else asyncio.wait_for(call, max(0.0, remaining)))
+                except asyncio.TimeoutError:
+                    deadlines.mark_exceeded()
+                    return _deadline_result(0)
+                # Another caller's deadline says nothing about ours: with time left, go again
+                if not result.get('deadlineExceeded') or not deadlines.can_attempt():
+                    break
+                logger.info('⏱️ Shared image call hit another request\'s deadline; retrying with %s',
+                            'no deadline' if remaining is None else f'{deadlines.remaining():.1f}s left')
+        # Every caller gets its own dict; the image payload itself is shared
+        return dict(result)
+    
+    async def _agenerate_coalesced(self, prompt: str, prepared_images: List[PreparedImage], timeout: float,
+                                   response_format: str, request_key: str) -> Dict[str, Any]:
+        cache_key = None
+        if self.image_cache:
+            cache_key = request_key
+            with span('image.cache_get'):
+                cached_bytes = await asyncio.to_thread(self.image_cache.get, cache_key)
+            if cached_bytes is not None:
+                logger.debug('🗄️ Image cache hit for prompt: %.50s...', prompt, extra=sampled(20))
+                content_id = self.image_cache.content_id(cached_bytes)
+                result = {
+                    'success': True,
+                    'imageId': content_id,
+                    'mimeType': self.image_cache.mime_type(content_id, cached_bytes),
+                    'cached': True,
+                    'message': 'Image served from cache'
+                }
+                if response_format == 'base64':
+                    result['imageBase64'] = base64.b64encode(cached_bytes).decode('ascii')
+                else:
+                    result['imageBytes'] = cached_bytes
+                return result
+        
+        result = await self._agenerate_uncached(prompt, prepared_images, timeout)
+        if not result['success']:
+            return result
+        
+        # The base64 payload is a view into the upstream body; decode it only if
+        # something needs raw bytes, then let the body go
+        image_base64 = result.pop('imageBase64View')
+        try:
+            if cache_key or response_format != 'base64':
+                with span('image.decode'):
+                    image_bytes = base64.b64decode(image_base64)
+                if cache_key:
+                    try:
+                        with span('image.cache_put'):
+                            result['imageId'] = await asyncio.to_thread(self.image_cache.put, cache_key, image_bytes)
+                    except Exception as e:
+                        logger.warning('⚠️ Failed to cache image: %s', e)
+                if response_format != 'base64':
+                    result['imageBytes'] = image_bytes
+            if response_format == 'base64':
+                result['imageBase64'] = str(image_base64, 'ascii')
+        finally:
+            image_base64.release()
+        return result
+    
+    @staticmethod
+    def _rotate_after_throttle(key_pool, failed_key: str) -> Optional[str]:
+        """Trip the failed key's breaker and return the next admissible key, or None"""
+        with span('key.rotate'):
+            if key_pool.handle_rate_limit_error(failed_key):
+                return key_pool.get_key()
+            return None
+    
+    async def _agenerate_uncached(self, prompt: str, images: List[PreparedImage], timeout: float) -> Dict[str, Any]:
         # Always use API key from pool, not the initialized one
-        from app import ApiKeyPool
-        api_key = ApiKeyPool.get_key()
+        import httpx
+        key_pool = self.key_provider
+        # get_key may reload shared key pool state from SQLite; never block the engine loop on it
+        api_key = await asyncio.to_thread(key_pool.get_key)
         if not api_key:
+            if key_pool.get_keys():
+                return {
+                    'success': False,
+                    'error': 'All API keys are cooling down after rate limits, please retry shortly'
+                }
             # Fallback to initialized key if pool is empty
             if not self._api_key:
                 return {
@@ -36,27 +346,17 @@ class GeminiImageService:
                     'error': 'No API key available in pool or initialized'
                 }
             api_key = self._api_key
-            print(f'Using fallback API key: {api_key[:10] if api_key else "None"}...')
+            logger.debug('Using fallback API key: %.10s...', api_key, extra=sampled(50))
         else:
-            print(f'Using API key from pool: {api_key[:10] if api_key else "None"}...')
-        
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-preview-image-generation:generateContent?key={api_key}'
+            logger.debug('Using API key from pool: %.10s...', api_key, extra=sampled(50))
         
-        headers = {'Content-Type': 'application/json'}
+        url = f'/v1beta/models/{GEMINI_IMAGE_MODEL}:generateContent'
         
         # Build request parts
         parts = [{"text": f"Generate a high-quality, detailed image: {prompt}"}]
         
-        if images:
-            for image_bytes in images:
-                # Convert image bytes to base64
-                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                parts.append({
-                    "inlineData": {
-                        "mimeType": "image/jpeg",
-                        "data": image_base64
-                    }
-                })
+        for image in images:
+            parts.append(image.as_inline_data())
         
         body = {
             "contents": [{"parts": parts}],
@@ -66,163 +366,141 @@ class GeminiImageService:
             }
         }
         
-        max_retries = 3
+        max_retries = self.max_retries
         retry_count = 0
         
-        while retry_count < max_retries:
-            try:
-                # Update URL with current API key (in case it was rotated)
-                url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-preview-image-generation:generateContent?key={api_key}'
+        try:
+            while retry_count < max_retries:
+                # Neither the first try nor a retry on a rotated key starts without time to finish
+                if not deadlines.can_attempt():
+                    logger.warning('⏱️ Request deadline reached, skipping image attempt %d', retry_count + 1)
+                    return _deadline_result(retry_count)
+                attempt_timeout = deadlines.timeout(timeout)
+                try:
+                    # Send the current API key (in case it was rotated) as a header on the pooled connection
+                    headers = {'Content-Type': 'application/json', 'x-goog-api-key': api_key}
                 
-                print(f'Making API request to Gemini for prompt: {prompt} (attempt {retry_count + 1})')
-                response = requests.post(url, headers=headers, json=body)
-                print(f'API Response status: {response.status_code}')
-                print(f'API Response body length: {len(response.text)}')
+                    logger.debug('Making API request to Gemini for prompt: %.80s (attempt %d)', prompt, retry_count + 1, extra=sampled(20))
+                    started = time.perf_counter()
+                    attempt_status = 'error'
+                    UPSTREAM_IN_FLIGHT.labels(GEMINI_IMAGE_MODEL).inc()
+                    try:
+                        async with _engine.client().stream('POST', url, headers=headers, json=body,
+                                                           timeout=attempt_timeout) as response:
+                            if response.status_code == 200:
+                                # Accumulate straight into one buffer; no text/JSON copies of the image
+                                response_body = bytearray()
+                                async for chunk in response.aiter_bytes():
+                                    response_body += chunk
+                            else:
+                                response_body = await response.aread()
+                        attempt_status = response.status_code
+                    except httpx.TimeoutException:
+                        attempt_status = 'timeout'
+                        raise
+                    finally:
+                        UPSTREAM_IN_FLIGHT.labels(GEMINI_IMAGE_MODEL).dec()
+                        observe_upstream(GEMINI_IMAGE_MODEL, api_key, attempt_status, started)
+                        record('gemini.image', started)
+                    UPSTREAM_RESPONSE_BYTES.labels(GEMINI_IMAGE_MODEL).inc(len(response_body))
+                    logger.debug('API Response status: %s, body length: %d', response.status_code, len(response_body), extra=sampled(20))
                 
-                # Check for rate limit status codes (429) and overload status (503)
-                if response.status_code == 429:
-                    print("🚨 Rate limit detected (HTTP 429)!")
+                    if response.status_code != 200:
+                        error_status, error_message = _parse_error(response_body)
                     
-                    # Try to rotate the key
-                    if ApiKeyPool.handle_rate_limit_error():
-                        api_key = ApiKeyPool.get_key()
-                        print(f"🔄 Retrying with rotated key: {api_key[:10]}...")
-                        retry_count += 1
-                        continue
-                    else:
+                        # 429 / RESOURCE_EXHAUSTED is a throttled key, 503 / UNAVAILABLE an overloaded model;
+                        # both are worth another key
+                        if response.status_code in (429, 503) or error_status in THROTTLE_ERROR_STATUSES:
+                            overloaded = response.status_code == 503 or error_status == 'UNAVAILABLE'
+                            logger.warning("🚨 %s detected (HTTP %s %s)!", 'Model overloaded' if overloaded else 'Rate limit',
+                                           response.status_code, error_status or '')
+                        
+                            # Try to rotate the key; like get_key this may reload shared state, so off the engine loop
+                            api_key = await asyncio.to_thread(self._rotate_after_throttle, key_pool, api_key)
+                            if api_key:
+                                logger.info("🔄 Retrying with rotated key: %.10s...", api_key)
+                                UPSTREAM_RETRIES.labels(GEMINI_IMAGE_MODEL).inc()
+                                retry_count += 1
+                                continue
+                            else:
+                                return {
+                                    'success': False,
+                                    'error': f"{'Model overloaded' if overloaded else 'Rate limit exceeded'} and no alternative keys available"
+                                }
+                    
+                        # The key itself is fine; only the request failed
+                        key_pool.report_success(api_key)
+                        logger.warning('API Error: %s %.200s', error_status, error_message)
                         return {
                             'success': False,
-                            'error': 'Rate limit exceeded and no alternative keys available'
+                            'error': f'API request failed with status {response.status_code}: {error_message}'
                         }
                 
-                # Check for model overload (503)
-                if response.status_code == 503:
-                    print("🚨 Model overloaded detected (HTTP 503)!")
-                    
-                    # Try to rotate the key
-                    if ApiKeyPool.handle_rate_limit_error():
-                        api_key = ApiKeyPool.get_key()
-                        print(f"🔄 Retrying with rotated key due to overload: {api_key[:10]}...")
-                        retry_count += 1
-                        continue
-                    else:
+                    key_pool.report_success(api_key)
+                    with span('image.parse'):
+                        data, image_base64, mime_type = _split_inline_image(response_body)
+                    del response_body  # image_base64 keeps the buffer alive only as long as needed
+                
+                    # Check if response has candidates
+                    if not data.get('candidates'):
                         return {
                             'success': False,
-                            'error': 'Model overloaded and no alternative keys available'
+                            'error': 'No candidates in API response'
                         }
                 
-                if response.status_code != 200:
-                    error_text = response.text.lower()
-                    
-                    # Check for rate limit or overload in error message
-                    if any(keyword in error_text for keyword in ['rate limit', 'quota', 'limit exceeded', 'too many requests', 'overloaded', 'unavailable']):
-                        print("🚨 Rate limit or overload detected in error message!")
-                        
-                        # Try to rotate the key
-                        if ApiKeyPool.handle_rate_limit_error():
-                            api_key = ApiKeyPool.get_key()
-                            print(f"🔄 Retrying with rotated key: {api_key[:10]}...")
-                            retry_count += 1
-                            continue
-                        else:
-                            return {
-                                'success': False,
-                                'error': 'Rate limit/overload exceeded and no alternative keys available'
-                            }
-                    
-                    print(f'API Error: {response.text}')
-                    return {
-                        'success': False,
-                        'error': f'API request failed with status {response.status_code}: {response.text}'
-                    }
+                    candidate = data['candidates'][0]
                 
-                data = response.json()
-                print(f'Decoded response structure: {list(data.keys())}')
+                    # Check for safety blocks
+                    if candidate.get('finishReason') in ['SAFETY', 'IMAGE_SAFETY']:
+                        logger.info("🛡️ Safety filter triggered for prompt: %.100s...", prompt)
+                        return {
+                            'success': False,
+                            'error': 'Image generation blocked due to safety filters.'
+                        }
                 
-                # Check if response has candidates
-                if 'candidates' not in data or not data['candidates']:
-                    return {
-                        'success': False,
-                        'error': 'No candidates in API response'
-                    }
+                    # Check if content exists
+                    if 'content' not in candidate or 'parts' not in candidate['content']:
+                        return {
+                            'success': False,
+                            'error': 'No content in API response'
+                        }
                 
-                candidate = data['candidates'][0]
-                print(f'Candidate keys: {list(candidate.keys())}')
+                    # Validate that we have actual image data (decoded size from the base64 length)
+                    if image_base64 is not None and len(image_base64) * 3 // 4 > MIN_IMAGE_BYTES:
+                        logger.debug('Found image data, base64 length: %d', len(image_base64), extra=sampled(20))
+                        return {
+                            'success': True,
+                            'imageBase64View': image_base64,
+                            'mimeType': mime_type,
+                            'message': 'Image generated successfully'
+                        }
                 
-                # Check for safety blocks
-                if candidate.get('finishReason') in ['SAFETY', 'IMAGE_SAFETY']:
-                    print(f"🛡️ Safety filter triggered for prompt: {prompt[:100]}...")
                     return {
                         'success': False,
-                        'error': 'Image generation blocked due to safety filters.'
+                        'error': 'No valid image data found in API response'
                     }
                 
-                # Check if content exists
-                if 'content' not in candidate or 'parts' not in candidate['content']:
+                except httpx.TimeoutException as e:
+                    logger.warning('Upstream timeout in generate_gemini_image (attempt %d): %r', retry_count + 1, e)
+                    if deadlines.cut_short(attempt_timeout, timeout):
+                        return _deadline_result(retry_count + 1)
                     return {
                         'success': False,
-                        'error': 'No content in API response'
+                        'error': f'Image generation timed out after {attempt_timeout:.0f}s'
                     }
-                
-                parts = candidate['content']['parts']
-                print(f'Number of parts in response: {len(parts)}')
-                
-                # Look for image data in any part
-                for i, part in enumerate(parts):
-                    print(f'Part {i} keys: {list(part.keys())}')
-                    
-                    if 'inlineData' in part and 'data' in part['inlineData']:
-                        base64_image = part['inlineData']['data']
-                        print(f'Found image data, base64 length: {len(base64_image)}')
-                        
-                        try:
-                            image_bytes = base64.b64decode(base64_image)
-                            print(f'Successfully decoded image bytes: {len(image_bytes)}')
-                            
-                            # Validate that we have actual image data
-                            if len(image_bytes) > 1000:
-                                return {
-                                    'success': True,
-                                    'imageBytes': image_bytes,
-                                    'message': 'Image generated successfully'
-                                }
-                            else:
-                                print(f'Image bytes too small: {len(image_bytes)}')
-                        except Exception as e:
-                            print(f'Error decoding base64: {e}')
-                
-                return {
-                    'success': False,
-                    'error': 'No valid image data found in API response'
-                }
-                
-            except Exception as e:
-                error_str = str(e).lower()
-                print(f'Exception in generate_gemini_image (attempt {retry_count + 1}): {e}')
-                
-                # Check if it's a rate limit or overload error
-                if any(keyword in error_str for keyword in ['rate limit', 'quota', 'limit exceeded', 'too many requests', 'overloaded', 'unavailable']):
-                    print("🚨 Rate limit or overload detected in exception!")
-                    
-                    # Try to rotate the key
-                    if ApiKeyPool.handle_rate_limit_error():
-                        api_key = ApiKeyPool.get_key()
-                        print(f"🔄 Retrying with rotated key: {api_key[:10]}...")
-                        retry_count += 1
-                        continue
-                    else:
-                        return {
-                            'success': False,
-                            'error': 'Rate limit/overload exceeded and no alternative keys available'
-                        }
-                else:
-                    # Non-rate-limit error, don't retry
+                except Exception as e:
+                    # Throttling is classified from the HTTP status above; anything
+                    # raised here is a transport or parsing problem, not the key's fault
+                    logger.error('Exception in generate_gemini_image (attempt %d): %r', retry_count + 1, e)
                     return {
                         'success': False,
                         'error': f'Network or parsing error: {e}'
                     }
         
-        return {
-            'success': False,
-            'error': f'Image generation failed after {max_retries} attempts with key rotation'
-        }
+            return {
+                'success': False,
+                'error': f'Image generation failed after {max_retries} attempts with key rotation'
+            }
+        finally:
+            # A probe that ended in anything but success or a throttle goes back to the pool
+            key_pool.release_key(api_key)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Gemini generateContent endpoints
+
+Serves canned text and image responses with configurable latency
+distributions and injectable 429 (RESOURCE_EXHAUSTED) / 503 (UNAVAILABLE)
+rates, so the backend can be benchmarked without real keys or quota.
+Point the backend at it with GEMINI_API_BASE_URL=http://127.0.0.1:8090.
+
+    python gemini_stub_server.py --port 8090 \\
+        --text-latency lognormal:900,0.4 --image-latency lognormal:4000,0.3 \\
+        --rate-429 0.05 --rate-503 0.02
+
+Latency specs (milliseconds): fixed:MS, uniform:LO,HI, normal:MEAN,SD,
+lognormal:MEDIAN,SIGMA, exp:MEAN.
+
+GET /stats returns call counters (per model, status and key);
+POST /stats/reset clears them.
+"""
+
+import io
+import re
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+_MODEL_PATH = re.compile(r'^/v1(?:beta)?/models/([^:/]+):(generateContent|streamGenerateContent)$')
+
+_ERRORS = {
+    429: ('RESOURCE_EXHAUSTED', 'Resource has been exhausted (e.g. check quota).'),
+    503: ('UNAVAILABLE', 'The model is overloaded. Please try again later.'),
+}
+
+
+class LatencyDistribution:
+    """Samples delays in seconds from a spec such as 'lognormal:900,0.4' (milliseconds)"""
+
+    def __init__(self, spec: str, rng: random.Random):
+        self.spec = spec
+        self.rng = rng
+        kind, _, params = spec.partition(':')
+        values = [float(value) for value in params.split(',') if value]
+        samplers = {
+            'fixed': lambda: values[0],
+            'uniform': lambda: rng.uniform(values[0], values[1]),
+            'normal': lambda: rng.gauss(values[0], values[1]),
+            'lognormal': lambda: values[0] * rng.lognormvariate(0, values[1]),
+            'exp': lambda: rng.expovariate(1 / values[0]),
+        }
+        if kind not in samplers:
+            raise ValueError(f'Unknown latency distribution: {spec}')
+        self._sample = samplers[kind]
+
+    def sample(self) -> float:
+        return max(0.0, self._sample()) / 1000
+
+
+def _canned_image(size: int) -> bytes:
+    """A real JPEG when Pillow is available, otherwise JPEG-framed filler of a realistic size"""
+    try:
+        from PIL import Image
+        output = io.BytesIO()
+        Image.new('RGB', (size, size), (74, 144, 226)).save(output, format='JPEG', quality=90)
+        data = output.getvalue()
+        # Solid colour compresses to almost nothing; pad with a COM segment to a realistic size
+        padding = max(0, size * size // 8 - len(data))
+        comment = b'\xff\xfe' + min(padding, 65533).to_bytes(2, 'big') + b'\0' * (min(padding, 65533) - 2)
+        return data[:2] + (comment if padding > 2 else b'') + data[2:]
+    except ImportError:
+        return b'\xff\xd8\xff\xe0' + b'\0' * (size * size // 8) + b'\xff\xd9'
+
+
+def _canned_text(prompt: str) -> str:
+    if re.search(r'page\s+1', prompt, re.IGNORECASE) or '10' in prompt:
+        return '\n'.join(
+            f'Page {n}: The little explorer took step {n} of the journey, discovering something new '
+            f'and wonderful along the winding path through the enchanted forest.'
+            for n in range(1, 11)
+        )
+    return ('Once upon a time, in a land of gentle hills and sparkling rivers, a curious child set out '
+            'to learn how the stars were made. ') * 4
+
+
+class StubState:
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.rng_lock = threading.Lock()
+        self.text_latency = LatencyDistribution(args.text_latency, self.rng)
+        self.image_latency = LatencyDistribution(args.image_latency, self.rng)
+        self.rate_429 = args.rate_429
+        self.rate_503 = args.rate_503
+        self.image_base64 = base64.b64encode(_canned_image(args.image_size)).decode('ascii')
+        self.stats_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.stats_lock:
+            self.calls = Counter()
+            self.by_model = Counter()
+            self.by_status = Counter()
+            self.by_key = Counter()
+
+    def record(self, model: str, status: int, key: str):
+        with self.stats_lock:
+            self.calls['total'] += 1
+            self.by_model[model] += 1
+            self.by_status[str(status)] += 1
+            self.by_key[key[-8:] if key else 'none'] += 1
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'calls': self.calls['total'],
+                'by_model': dict(self.by_model),
+                'by_status': dict(self.by_status),
+                'by_key': dict(self.by_key)
+            }
+
+    def draw(self, is_image: bool):
+        """(delay seconds, injected error status or None) for one call"""
+        with self.rng_lock:
+            delay = (self.image_latency if is_image else self.text_latency).sample()
+            roll = self.rng.random()
+        if roll < self.rate_429:
+            return delay * 0.1, 429
+        if roll < self.rate_429 + self.rate_503:
+            return delay * 0.1, 503
+        return delay, None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output readable
+
+    def _send_json(self, status: int, payload, content_type='application/json'):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/stats':
+            return self._send_json(200, self.state.stats())
+        self._send_json(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if url.path == '/stats/reset':
+            self.state.reset()
+            return self._send_json(200, {'reset': True})
+
+        match = _MODEL_PATH.match(url.path)
+        if not match:
+            return self._send_json(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+        model, method = match.groups()
+        query = parse_qs(url.query)
+        key = self.headers.get('x-goog-api-key') or (query.get('key') or [''])[0]
+
+        try:
+            request_body = json.loads(body or b'{}')
+        except ValueError:
+            return self._send_json(400, {'error': {'code': 400, 'message': 'Invalid JSON', 'status': 'INVALID_ARGUMENT'}})
+        modalities = (request_body.get('generationConfig') or request_body.get('generation_config') or {}).get(
+            'responseModalities') or []
+        is_image = 'image' in model or 'IMAGE' in modalities
+
+        delay, error_status = self.state.draw(is_image)
+        time.sleep(delay)
+        self.state.record(model, error_status or 200, key)
+        if error_status:
+            status_name, message = _ERRORS[error_status]
+            return self._send_json(error_status, {'error': {'code': error_status, 'message': message, 'status': status_name}})
+
+        if is_image:
+            parts = [
+                {'text': 'Here is your illustration.'},
+                {'inlineData': {'mimeType': 'image/jpeg', 'data': self.state.image_base64}}
+            ]
+        else:
+            prompt = ' '.join(part.get('text', '') for content in request_body.get('contents') or []
+                              for part in content.get('parts') or [])
+            parts = [{'text': _canned_text(prompt)}]
+
+        response = {
+            'candidates': [{'content': {'role': 'model', 'parts': parts}, 'finishReason': 'STOP', 'index': 0}],
+            'usageMetadata': {'promptTokenCount': 50, 'candidatesTokenCount': 400, 'totalTokenCount': 450}
+        }
+        if method == 'generateContent':
+            return self._send_json(200, response)
+        if (query.get('alt') or [''])[0] == 'sse':
+            return self._send_json(200, f'data: {json.dumps(response)}\r\n\r\n'.encode('utf-8'), 'text/event-stream')
+        # REST transport of the SDK reads server-streaming responses as a JSON array
+        return self._send_json(200, json.dumps([response]).encode('utf-8'))
+
+
+def start_stub_server(host='127.0.0.1', port=8090, **options):
+    """Start the stub in a background thread; returns the server (call shutdown() to stop)"""
+    args = build_parser().parse_args([])
+    for name, value in options.items():
+        setattr(args, name, value)
+    handler = type('BoundStubHandler', (StubHandler,), {'state': StubState(args)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='gemini-stub', daemon=True).start()
+    return server
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Local Gemini generateContent stub')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--text-latency', default='lognormal:900,0.4', help='Text call latency spec (ms)')
+    parser.add_argument('--image-latency', default='lognormal:4000,0.3', help='Image call latency spec (ms)')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of calls answered 429 RESOURCE_EXHAUSTED')
+    parser.add_argument('--rate-503', type=float, default=0.0, help='Fraction of calls answered 503 UNAVAILABLE')
+    parser.add_argument('--image-size', type=int, default=1024, help='Edge length of the canned image')
+    parser.add_argument('--seed', type=int, default=None)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    server = start_stub_server(**vars(args))
+    print(f"🧪 Gemini stub listening on http://{args.host}:{server.server_address[1]} "
+          f"(text {args.text_latency}, image {args.image_latency}, 429 {args.rate_429:.0%}, 503 {args.rate_503:.0%})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
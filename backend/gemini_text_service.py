@@ -1,21 +1,145 @@
 import os
-import google.generativeai as genai
-from typing import Optional, List, Dict, Any
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Optional, List, Dict, Any, Iterator
+
+from api_key_pool import ApiKeyPool
+from text_cache import TextMemoCache
+from image_preprocessing import PreparedImage, prepare_reference_images
+from single_flight import SingleFlight
+from metrics import UPSTREAM_RESPONSE_BYTES, UPSTREAM_RETRIES, track_upstream
+from logging_setup import sampled
+from timing import span, record
+import deadlines
+from deadlines import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+GEMINI_TEXT_MODEL = 'gemini-2.0-flash'
+DEFAULT_GEMINI_API_BASE_URL = 'https://generativelanguage.googleapis.com'
+# Point at a local stand-in (e.g. gemini_stub_server.py) to benchmark without real keys
+GEMINI_API_BASE_URL = os.getenv('GEMINI_API_BASE_URL', DEFAULT_GEMINI_API_BASE_URL)
+TEXT_CACHE_ENABLED = os.getenv('TEXT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+TEXT_CACHE_MAX_ENTRIES = int(os.getenv('TEXT_CACHE_MAX_ENTRIES', '512'))
+TEXT_CACHE_TTL_SECONDS = float(os.getenv('TEXT_CACHE_TTL_SECONDS', '3600'))
+GEMINI_MODEL_CACHE_SIZE = int(os.getenv('GEMINI_MODEL_CACHE_SIZE', '64'))
+# Per-attempt upstream timeout; a request deadline can only shorten it
+TEXT_REQUEST_TIMEOUT = float(os.getenv('TEXT_REQUEST_TIMEOUT', '60'))
+# Threads running blocking SDK calls so their wait can be bounded
+TEXT_UPSTREAM_WORKERS = int(os.getenv('TEXT_UPSTREAM_WORKERS', '32'))
+
+class _GenerativeModelCache:
+    """Bounded LRU of GenerativeModel instances keyed by (api key, model name, generation config)
+
+    Every key gets its own GenerativeServiceClient, so concurrent requests on
+    different keys never go through (or overwrite) genai.configure's global
+    client and model construction stays off the hot path.
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+        self._clients = OrderedDict()
+    
+    def _client_for(self, api_key: str):
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is not None:
+                self._clients.move_to_end(api_key)
+                return client
+        # Imported on first use; the SDK dominates cold-start import time
+        import google.ai.generativelanguage as glm
+        if GEMINI_API_BASE_URL.rstrip('/') != DEFAULT_GEMINI_API_BASE_URL:
+            # gRPC can't reach a plain HTTP stub; the REST transport accepts a scheme in the endpoint
+            client = glm.GenerativeServiceClient(
+                client_options={'api_key': api_key, 'api_endpoint': GEMINI_API_BASE_URL.rstrip('/')},
+                transport='rest'
+            )
+        else:
+            client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+        with self._lock:
+            client = self._clients.setdefault(api_key, client)
+            self._clients.move_to_end(api_key)
+            while len(self._clients) > self.max_entries:
+                self._clients.popitem(last=False)
+        return client
+    
+    def get(self, api_key: str, model_name: str, generation_config: Optional[Dict[str, Any]] = None):
+        cache_key = (api_key, model_name, json.dumps(generation_config or {}, sort_keys=True, default=str))
+        with self._lock:
+            model = self._models.get(cache_key)
+            if model is not None:
+                self._models.move_to_end(cache_key)
+                return model
+        
+        import google.generativeai as genai
+        if generation_config:
+            model = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+        else:
+            model = genai.GenerativeModel(model_name=model_name)
+        # Bind the per-key client instead of the process-wide default one
+        model._client = self._client_for(api_key)
+        
+        with self._lock:
+            model = self._models.setdefault(cache_key, model)
+            self._models.move_to_end(cache_key)
+            while len(self._models) > self.max_entries:
+                self._models.popitem(last=False)
+        return model
 
 class GeminiTextService:
-    def __init__(self):
+    def __init__(self, key_provider=ApiKeyPool):
+        """key_provider supplies and tracks API keys (get_key, get_keys, report_success, release_key, handle_rate_limit_error)"""
+        self.key_provider = key_provider
         self._api_key = ''
+        self._models = _GenerativeModelCache(GEMINI_MODEL_CACHE_SIZE)
+        self.text_cache = TextMemoCache(TEXT_CACHE_MAX_ENTRIES, TEXT_CACHE_TTL_SECONDS) if TEXT_CACHE_ENABLED else None
+        self.in_flight = SingleFlight()
+        self._executor = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+    
+    def _reset_after_fork(self):
+        # The parent's SDK call threads do not exist in the child
+        self._executor = None
+        self._lock = threading.Lock()
+    
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=TEXT_UPSTREAM_WORKERS, thread_name_prefix='gemini-text')
+            return self._executor
+    
+    def _call_with_timeout(self, timeout: float, fn, *args, **kwargs):
+        """Run a blocking SDK call on the upstream pool and wait at most timeout seconds
+        
+        The pinned google-generativeai (0.3.2) rejects request_options, so the
+        per-attempt timeout is enforced here. A call that times out is left to
+        finish in the background and its result is dropped.
+        """
+        future = self._pool().submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise TimeoutError(f'Gemini text call timed out after {timeout:.1f}s') from None
     
     def initialize(self, api_key: str):
         """Initialize the service with API key"""
         self._api_key = api_key
-        genai.configure(api_key=api_key)
     
     def generate_text(self, 
                      prompt: str, 
                      system_instruction: Optional[str] = None,
                      generation_config: Optional[Dict[str, Any]] = None,
-                     images: Optional[List[bytes]] = None) -> str:
+                     images: Optional[List[bytes]] = None,
+                     bypass_cache: bool = False) -> str:
         """
         Generate text using Gemini API
         
@@ -24,79 +148,233 @@ class GeminiTextService:
             system_instruction: Optional system instruction
             generation_config: Optional generation configuration
             images: Optional list of image bytes
+            bypass_cache: Skip the memoization cache lookup and force fresh output
             
         Returns:
             Generated text string
+            
+        Raises:
+            DeadlineExceeded when the request's deadline leaves no room for
+            (another) attempt; other failures are returned as error strings
+            
+        Concurrent identical requests share one upstream call and its result,
+        except a DeadlineExceeded from another caller's deadline: a caller that
+        still has time starts a fresh call instead.
         """
+        try:
+            prepared_images = prepare_reference_images(images)
+        except ValueError as e:
+            return f"Error generating text: {e}"
+        
+        request_key = TextMemoCache.make_key(prompt, system_instruction, generation_config,
+                                             [image.data for image in prepared_images], GEMINI_TEXT_MODEL)
+        if self.text_cache and not bypass_cache:
+            cached_text = self.text_cache.get(request_key)
+            if cached_text is not None:
+                logger.debug("🗄️ Text cache hit", extra=sampled(20))
+                return cached_text
+        
+        # Coalesced callers only see text.generate; the upstream spans belong to the leader's request
+        with span('text.generate'):
+            while True:
+                remaining = deadlines.remaining()
+                try:
+                    return self.in_flight.do(request_key, self._generate_text_uncached,
+                                             prompt, system_instruction, generation_config, prepared_images,
+                                             request_key if self.text_cache else None,
+                                             wait_timeout=None if remaining is None else max(0.0, remaining))
+                except TimeoutError as e:
+                    # Joined a call started by a request with a later deadline
+                    deadlines.mark_exceeded()
+                    raise DeadlineExceeded(str(e)) from e
+                except DeadlineExceeded:
+                    # Ours ran out, or the shared call ran under another caller's shorter deadline
+                    if not deadlines.can_attempt():
+                        raise
+                    logger.info("⏱️ Shared text call hit another request's deadline; retrying")
+    
+    def _generate_text_uncached(self,
+                                prompt: str,
+                                system_instruction: Optional[str],
+                                generation_config: Optional[Dict[str, Any]],
+                                prepared_images: List[PreparedImage],
+                                cache_key: Optional[str]) -> str:
         # Always use API key from pool first, then fallback
-        from app import ApiKeyPool
-        api_key = ApiKeyPool.get_key()
+        key_pool = self.key_provider
+        api_key = key_pool.get_key()
         
         if not api_key:
+            if key_pool.get_keys():
+                return "Error: All API keys are cooling down after rate limits, please retry shortly"
             # Fallback to initialized key if pool is empty
             if not self._api_key:
                 return "Error: No API key available in pool or initialized"
             api_key = self._api_key
-            print(f"Using fallback API key: {api_key[:10]}...")
+            logger.debug("Using fallback API key: %.10s...", api_key, extra=sampled(50))
         else:
-            print(f"Using API key from pool: {api_key[:10]}...")
+            logger.debug("Using API key from pool: %.10s...", api_key, extra=sampled(50))
         
         max_retries = 3
         retry_count = 0
         
-        while retry_count < max_retries:
-            try:
-                # Reconfigure with current API key
-                genai.configure(api_key=api_key)
+        try:
+            while retry_count < max_retries:
+                # Neither the first try nor a retry on a rotated key starts without time to finish
+                deadlines.check(f'text attempt {retry_count + 1}')
+                attempt_timeout = deadlines.timeout(TEXT_REQUEST_TIMEOUT)
+                try:
+                    # Model bound to the current API key's own client; no global SDK state
+                    model = self._models.get(api_key, GEMINI_TEXT_MODEL, generation_config)
                 
-                # Configure the model
-                if generation_config:
-                    model = genai.GenerativeModel(
-                        model_name='gemini-2.0-flash',
-                        generation_config=generation_config
-                    )
-                else:
-                    model = genai.GenerativeModel(model_name='gemini-2.0-flash')
+                    # Build content
+                    content_parts = [prompt]
                 
-                # Build content
-                content_parts = [prompt]
+                    # Add system instruction if provided
+                    if system_instruction:
+                        content_parts.insert(0, f"System: {system_instruction}")
                 
-                # Add system instruction if provided
-                if system_instruction:
-                    content_parts.insert(0, f"System: {system_instruction}")
+                    # Add images as inline blobs with their real MIME type
+                    content_parts.extend(image.as_blob() for image in prepared_images)
                 
-                # Add images if provided
-                if images:
-                    for image_bytes in images:
-                        # Convert bytes to PIL Image
-                        from PIL import Image
-                        import io
-                        image = Image.open(io.BytesIO(image_bytes))
-                        content_parts.append(image)
+                    # Generate content
+                    with track_upstream(GEMINI_TEXT_MODEL, api_key), span('gemini.text'):
+                        response = self._call_with_timeout(attempt_timeout, model.generate_content, content_parts)
+                        text = response.text or ""
+                    key_pool.report_success(api_key)
+                    UPSTREAM_RESPONSE_BYTES.labels(GEMINI_TEXT_MODEL).inc(len(text.encode('utf-8')))
                 
-                # Generate content
-                response = model.generate_content(content_parts)
-                return response.text or ""
+                    # Only successful generations are memoized; error strings never are
+                    if cache_key and text:
+                        self.text_cache.put(cache_key, text)
+                    return text
                 
-            except Exception as e:
-                error_str = str(e).lower()
-                print(f"Error in generate_text (attempt {retry_count + 1}): {e}")
+                except Exception as e:
+                    error_str = str(e).lower()
+                    logger.warning("Error in generate_text (attempt %d): %.300s", retry_count + 1, e)
+                    if deadlines.cut_short(attempt_timeout, TEXT_REQUEST_TIMEOUT):
+                        raise DeadlineExceeded(f'Text generation ran out of request time: {e}') from e
                 
-                # Check if it's a rate limit or overload error
-                if any(keyword in error_str for keyword in ['rate limit', 'quota', 'limit exceeded', 'too many requests', 'overloaded', 'unavailable']):
-                    print("🚨 Rate limit or overload detected in text service!")
+                    # Check if it's a rate limit or overload error
+                    if any(keyword in error_str for keyword in ['rate limit', 'quota', 'limit exceeded', 'too many requests', 'overloaded', 'unavailable']):
+                        logger.warning("🚨 Rate limit or overload detected in text service!")
                     
-                    # Try to rotate the key
-                    if ApiKeyPool.handle_rate_limit_error():
-                        api_key = ApiKeyPool.get_key()
-                        print(f"🔄 Retrying with rotated key: {api_key[:10]}...")
-                        retry_count += 1
-                        continue
+                        # Try to rotate the key
+                        with span('key.rotate'):
+                            api_key = key_pool.get_key() if key_pool.handle_rate_limit_error(api_key) else None
+                        if api_key:
+                            logger.info("🔄 Retrying with rotated key: %.10s...", api_key)
+                            UPSTREAM_RETRIES.labels(GEMINI_TEXT_MODEL).inc()
+                            retry_count += 1
+                            continue
+                        else:
+                            logger.error("❌ No more keys available for rotation")
+                            return f"Rate limit/overload exceeded and no alternative keys available: {e}"
                     else:
-                        print("❌ No more keys available for rotation")
-                        return f"Rate limit/overload exceeded and no alternative keys available: {e}"
-                else:
-                    # Non-rate-limit error, don't retry
-                    return f"Error generating text: {e}"
+                        # Non-rate-limit error, don't retry
+                        return f"Error generating text: {e}"
+        
+            return f"Error generating text after {max_retries} attempts with key rotation"
+        finally:
+            # A probe that ended in anything but success or a throttle goes back to the pool
+            key_pool.release_key(api_key)
+
+    def generate_text_stream(self,
+                             prompt: str,
+                             system_instruction: Optional[str] = None,
+                             generation_config: Optional[Dict[str, Any]] = None,
+                             images: Optional[List[bytes]] = None) -> Iterator[str]:
+        """
+        Stream text from Gemini API as it is generated
+        
+        Args:
+            prompt: Text prompt for generation
+            system_instruction: Optional system instruction
+            generation_config: Optional generation configuration
+            images: Optional list of image bytes
+            
+        Yields:
+            Text chunks in arrival order
+            
+        Raises:
+            Exception if no key is available or generation fails. Rate limit
+            errors are retried with key rotation only until the first chunk
+            has been yielded. DeadlineExceeded when the request's deadline
+            runs out first.
+        """
+        prepared_images = prepare_reference_images(images)
+        
+        key_pool = self.key_provider
+        api_key = key_pool.get_key()
+        if not api_key:
+            if key_pool.get_keys():
+                raise Exception("All API keys are cooling down after rate limits, please retry shortly")
+            api_key = self._api_key
+        if not api_key:
+            raise Exception("No API key available in pool or initialized")
+        
+        max_retries = 3
+        retry_count = 0
+        
+        try:
+            while retry_count < max_retries:
+                yielded = False
+                deadlines.check(f'text stream attempt {retry_count + 1}')
+                attempt_timeout = deadlines.timeout(TEXT_REQUEST_TIMEOUT)
+                # Spans cannot stay open across yields, so the stream is recorded as leaf spans
+                started = time.perf_counter()
+                try:
+                    model = self._models.get(api_key, GEMINI_TEXT_MODEL, generation_config)
+                
+                    content_parts = [prompt]
+                    if system_instruction:
+                        content_parts.insert(0, f"System: {system_instruction}")
+                    content_parts.extend(image.as_blob() for image in prepared_images)
+                
+                    # The attempt's timeout covers the whole stream, so each chunk waits only for what is left
+                    attempt_ends = time.monotonic() + attempt_timeout
+                    with track_upstream(GEMINI_TEXT_MODEL, api_key):
+                        response = self._call_with_timeout(attempt_timeout, model.generate_content,
+                                                           content_parts, stream=True)
+                        key_pool.report_success(api_key)
+                        chunks = iter(response)
+                        while True:
+                            chunk = self._call_with_timeout(max(0.0, attempt_ends - time.monotonic()), next, chunks, None)
+                            if chunk is None:
+                                break
+                            text = chunk.text
+                            if text:
+                                if not yielded:
+                                    record('gemini.text_first_chunk', started)
+                                yielded = True
+                                UPSTREAM_RESPONSE_BYTES.labels(GEMINI_TEXT_MODEL).inc(len(text.encode('utf-8')))
+                                yield text
+                    record('gemini.text_stream', started)
+                    return
+                
+                except Exception as e:
+                    record('gemini.text_stream', started)
+                    error_str = str(e).lower()
+                    logger.warning("Error in generate_text_stream (attempt %d): %.300s", retry_count + 1, e)
+                    if deadlines.cut_short(attempt_timeout, TEXT_REQUEST_TIMEOUT):
+                        raise DeadlineExceeded(f'Text stream ran out of request time: {e}') from e
+                
+                    # Once text has reached the caller a retry would duplicate it
+                    if yielded:
+                        raise
+                
+                    if any(keyword in error_str for keyword in ['rate limit', 'quota', 'limit exceeded', 'too many requests', 'overloaded', 'unavailable']):
+                        logger.warning("🚨 Rate limit or overload detected in text stream!")
+                        with span('key.rotate'):
+                            api_key = key_pool.get_key() if key_pool.handle_rate_limit_error(api_key) else None
+                        if api_key:
+                            logger.info("🔄 Retrying stream with rotated key: %.10s...", api_key)
+                            UPSTREAM_RETRIES.labels(GEMINI_TEXT_MODEL).inc()
+                            retry_count += 1
+                            continue
+                        raise Exception(f"Rate limit/overload exceeded and no alternative keys available: {e}")
+                    raise
         
-        return f"Error generating text after {max_retries} attempts with key rotation"
+            raise Exception(f"Error streaming text after {max_retries} attempts with key rotation")
+        finally:
+            # A probe that ended in anything but success or a throttle goes back to the pool
+            key_pool.release_key(api_key)
@@ -0,0 +1,366 @@
+import os
+import re
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any
+
+from image_preprocessing import sniff_mime_type
+
+logger = logging.getLogger(__name__)
+
+_CONTENT_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# Temp files older than this are leftovers from a crash rather than a write in progress
+STALE_TMP_SECONDS = 3600
+
+class ImageCache:
+    """Content-addressed on-disk image cache with LRU eviction under a byte budget
+
+    Image bytes are stored once as <sha256-of-bytes>.jpg blobs; the extension is
+    only a name (Gemini returns PNG), so mime_type() sniffs the real type. Generation
+    requests map onto blobs through small <request-key>.ref files, so identical
+    images produced by different requests share storage and the blob name can be
+    used as a stable, immutable image id.
+
+    Several processes (gunicorn workers) may share one directory. Each keeps its
+    own index; a lookup that misses it checks the directory and adopts files
+    another process wrote.
+
+    Blobs whose id went out in an image URL are pinned (a <content-id>.pin
+    marker): clients cache those URLs as immutable, so pinned blobs are never
+    evicted and do not count against max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()  # content id -> size, least recently used first
+        self._refs = {}  # request key -> content id
+        self._blob_refs = {}  # content id -> set of request keys
+        self._mime_types = {}  # content id -> sniffed MIME type
+        self._pinned = {}  # content id -> size; kept out of the LRU and never evicted
+        self._total_bytes = 0  # LRU blobs only
+        self._pinned_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(prompt: str, images: Optional[List[bytes]] = None, model: str = '') -> str:
+        """Hash the prompt, reference-image bytes and model into a request key"""
+        digest = hashlib.sha256()
+        for part in (model.encode('utf-8'), prompt.encode('utf-8')):
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        for image_bytes in images or []:
+            digest.update(len(image_bytes).to_bytes(8, 'big'))
+            digest.update(image_bytes)
+        return digest.hexdigest()
+
+    @staticmethod
+    def content_id(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def _blob_file(self, content_id: str) -> str:
+        return os.path.join(self.directory, f'{content_id}.jpg')
+
+    def _ref_file(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.ref')
+
+    def _pin_file(self, content_id: str) -> str:
+        return os.path.join(self.directory, f'{content_id}.pin')
+
+    def _known_locked(self, content_id: str) -> bool:
+        return content_id in self._blobs or content_id in self._pinned
+
+    def _touch_locked(self, content_id: str):
+        if content_id in self._blobs:
+            self._blobs.move_to_end(content_id)
+
+    def _load_index(self):
+        """Rebuild the in-memory LRU index from disk, oldest modification first"""
+        blobs = []
+        refs = []
+        pins = set()
+        for entry in os.scandir(self.directory):
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.tmp':
+                # Leftover from a write interrupted by a crash; a recent one may be a
+                # write in progress in another process sharing the directory
+                try:
+                    if time.time() - entry.stat().st_mtime > STALE_TMP_SECONDS:
+                        self._remove_file(entry.path)
+                except OSError:
+                    pass
+                continue
+            if not _CONTENT_ID_PATTERN.match(name):
+                continue
+            if ext == '.jpg':
+                stat = entry.stat()
+                blobs.append((stat.st_mtime, name, stat.st_size))
+            elif ext == '.ref':
+                refs.append((name, entry.path))
+            elif ext == '.pin':
+                pins.add(name)
+
+        for _, content_id, size in sorted(blobs):
+            if content_id in pins:
+                self._pinned[content_id] = size
+                self._pinned_bytes += size
+            else:
+                self._blobs[content_id] = size
+                self._total_bytes += size
+            self._blob_refs[content_id] = set()
+
+        for key, path in refs:
+            try:
+                with open(path, 'r') as f:
+                    content_id = f.read().strip()
+            except OSError:
+                continue
+            if self._known_locked(content_id):
+                self._refs[key] = content_id
+                self._blob_refs[content_id].add(key)
+            else:
+                self._remove_file(path)
+
+        self._evict_locked()
+        logger.info("🗄️ Image cache ready: %d images, %d bytes (%d pinned, %d bytes) in %s", len(self._blobs),
+                    self._total_bytes, len(self._pinned), self._pinned_bytes, self.directory)
+
+    def _adopt_blob(self, content_id: str) -> bool:
+        """Index a blob another process stored in the directory; False if there is none"""
+        try:
+            size = os.stat(self._blob_file(content_id)).st_size
+        except OSError:
+            return False
+        pinned = os.path.exists(self._pin_file(content_id))
+        with self._lock:
+            if not self._known_locked(content_id):
+                self._blob_refs[content_id] = set()
+                if pinned:
+                    self._pinned[content_id] = size
+                    self._pinned_bytes += size
+                else:
+                    self._blobs[content_id] = size
+                    self._total_bytes += size
+            self._touch_locked(content_id)
+            self._evict_locked(keep=content_id)
+        return True
+
+    def _adopt_ref(self, key: str) -> Optional[str]:
+        """Index a request key (and its blob) another process stored; returns its content id"""
+        try:
+            with open(self._ref_file(key), 'r') as f:
+                content_id = f.read().strip()
+        except OSError:
+            return None
+        if not _CONTENT_ID_PATTERN.match(content_id) or not self._adopt_blob(content_id):
+            return None
+        with self._lock:
+            if not self._known_locked(content_id):
+                return None
+            self._refs[key] = content_id
+            self._blob_refs[content_id].add(key)
+        return content_id
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return cached image bytes for a request key, or None on a miss"""
+        with self._lock:
+            content_id = self._refs.get(key)
+            if content_id is not None:
+                self._touch_locked(content_id)
+        if content_id is None:
+            content_id = self._adopt_ref(key)
+            if content_id is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+
+        path = self._blob_file(content_id)
+        try:
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            # Persist recency so LRU order survives restarts
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._drop_blob_locked(content_id)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return image_bytes
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Return the content id cached for a request key without reading the blob"""
+        with self._lock:
+            content_id = self._refs.get(key)
+        return content_id if content_id is not None else self._adopt_ref(key)
+
+    def put(self, key: str, image_bytes: bytes) -> str:
+        """Store image bytes for a request key and return their content id"""
+        content_id = self.put_blob(image_bytes)
+        self._atomic_write(self._ref_file(key), content_id.encode('ascii'))
+        with self._lock:
+            if self._known_locked(content_id):
+                previous = self._refs.get(key)
+                if previous and previous != content_id:
+                    self._blob_refs.get(previous, set()).discard(key)
+                self._refs[key] = content_id
+                self._blob_refs[content_id].add(key)
+        return content_id
+
+    def put_blob(self, image_bytes: bytes, pin: bool = False) -> str:
+        """Store image bytes under their content id and return it; pin=True keeps them forever"""
+        content_id = self.content_id(image_bytes)
+        with self._lock:
+            known = self._known_locked(content_id)
+            if known:
+                self._touch_locked(content_id)
+        if known:
+            if pin:
+                self.pin(content_id)
+            return content_id
+
+        self._atomic_write(self._blob_file(content_id), image_bytes)
+        if pin:
+            self._atomic_write(self._pin_file(content_id), b'')
+        with self._lock:
+            if not self._known_locked(content_id):
+                self._blob_refs[content_id] = set()
+                if pin:
+                    self._pinned[content_id] = len(image_bytes)
+                    self._pinned_bytes += len(image_bytes)
+                else:
+                    self._blobs[content_id] = len(image_bytes)
+                    self._total_bytes += len(image_bytes)
+            elif pin:
+                self._pin_locked(content_id)
+            self._touch_locked(content_id)
+            self._evict_locked(keep=content_id)
+        return content_id
+
+    def pin(self, content_id: str) -> bool:
+        """Keep a stored blob forever because its URL was handed out; False if it is gone"""
+        with self._lock:
+            if content_id in self._pinned:
+                return True
+        if not self.blob_path(content_id):
+            return False
+        self._atomic_write(self._pin_file(content_id), b'')
+        with self._lock:
+            if content_id in self._blobs:
+                self._pin_locked(content_id)
+            # Evicted between blob_path and here; the marker alone does not bring it back
+            return content_id in self._pinned
+
+    def _pin_locked(self, content_id: str):
+        size = self._blobs.pop(content_id, None)
+        if size is not None:
+            self._total_bytes -= size
+            self._pinned[content_id] = size
+            self._pinned_bytes += size
+
+    def mime_type(self, content_id: str, image_bytes: Optional[bytes] = None) -> str:
+        """MIME type of a stored blob from its magic bytes; pass image_bytes if already read"""
+        with self._lock:
+            mime_type = self._mime_types.get(content_id)
+        if mime_type is not None:
+            return mime_type
+        if image_bytes is None:
+            try:
+                with open(self._blob_file(content_id), 'rb') as f:
+                    image_bytes = f.read(16)
+            except OSError:
+                image_bytes = b''
+        mime_type = sniff_mime_type(image_bytes) or 'image/jpeg'
+        with self._lock:
+            if self._known_locked(content_id):
+                self._mime_types[content_id] = mime_type
+        return mime_type
+
+    def blob_path(self, content_id: str) -> Optional[str]:
+        """Path of a stored blob, marking it as recently used"""
+        if not _CONTENT_ID_PATTERN.match(content_id):
+            return None
+        with self._lock:
+            known = self._known_locked(content_id)
+            if known:
+                self._touch_locked(content_id)
+        if not known and not self._adopt_blob(content_id):
+            return None
+        return self._blob_file(content_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._refs),
+                'images': len(self._blobs),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'pinned_images': len(self._pinned),
+                'pinned_bytes': self._pinned_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions
+            }
+
+    def _evict_locked(self, keep: Optional[str] = None):
+        while self._total_bytes > self.max_bytes and self._blobs:
+            content_id = next(iter(self._blobs))
+            if content_id == keep:
+                # Never evict the entry being written, even if it alone exceeds the budget
+                if len(self._blobs) == 1:
+                    break
+                self._blobs.move_to_end(content_id)
+                continue
+            if os.path.exists(self._pin_file(content_id)):
+                # Another process handed out its URL
+                self._pin_locked(content_id)
+                continue
+            self._drop_blob_locked(content_id)
+            self.evictions += 1
+
+    def _drop_blob_locked(self, content_id: str):
+        size = self._blobs.pop(content_id, None)
+        if size is not None:
+            self._total_bytes -= size
+        else:
+            # A pinned blob is only dropped when its file has disappeared
+            size = self._pinned.pop(content_id, None)
+            if size is None:
+                return
+            self._pinned_bytes -= size
+            self._remove_file(self._pin_file(content_id))
+        self._mime_types.pop(content_id, None)
+        self._remove_file(self._blob_file(content_id))
+        for key in self._blob_refs.pop(content_id, set()):
+            self._refs.pop(key, None)
+            self._remove_file(self._ref_file(key))
+
+    def _atomic_write(self, path: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove_file(tmp_path)
+            raise
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
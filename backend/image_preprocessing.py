@@ -0,0 +1,143 @@
+import io
+import os
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional, List, Union
+
+REFERENCE_IMAGE_MAX_DIMENSION = int(os.getenv('REFERENCE_IMAGE_MAX_DIMENSION', '1024'))
+REFERENCE_IMAGE_JPEG_QUALITY = int(os.getenv('REFERENCE_IMAGE_JPEG_QUALITY', '85'))
+REFERENCE_IMAGE_CACHE_ENTRIES = int(os.getenv('REFERENCE_IMAGE_CACHE_ENTRIES', '64'))
+
+# MIME types Gemini accepts as inline image data
+SUPPORTED_MIME_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/heif')
+
+
+class PreparedImage(NamedTuple):
+    """A reference image ready to send upstream"""
+    mime_type: str
+    data: bytes
+    base64: str
+    digest: str  # sha256 of the caller's original bytes
+
+    def as_blob(self) -> dict:
+        """Inline blob for the google-generativeai SDK"""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+    def as_inline_data(self) -> dict:
+        """inlineData part for the REST API"""
+        return {'inlineData': {'mimeType': self.mime_type, 'data': self.base64}}
+
+
+def sniff_mime_type(data: bytes) -> Optional[str]:
+    """Detect the image type from its magic bytes"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data.startswith(b'BM'):
+        return 'image/bmp'
+    if data[4:8] == b'ftyp':
+        brand = data[8:12]
+        if brand in (b'heic', b'heix', b'hevc', b'hevx'):
+            return 'image/heic'
+        if brand in (b'mif1', b'msf1', b'heif'):
+            return 'image/heif'
+    return None
+
+
+def _to_bytes(image: Union[bytes, bytearray, str]) -> bytes:
+    """Accept raw bytes, base64 strings and data URLs"""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    if isinstance(image, str):
+        if image.startswith('data:'):
+            image = image.partition(',')[2]
+        try:
+            return base64.b64decode(image, validate=False)
+        except ValueError as e:
+            raise ValueError(f'Reference image is not valid base64: {e}')
+    raise ValueError(f'Unsupported reference image type: {type(image).__name__}')
+
+
+def _downsample(data: bytes, mime_type: Optional[str], max_dimension: int):
+    """Return (mime type, bytes), re-encoded only when it is too large or not a supported type"""
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+    except Exception as e:
+        if mime_type in SUPPORTED_MIME_TYPES:
+            # Pillow may lack a decoder (e.g. HEIC); Gemini can still read it
+            return mime_type, data
+        raise ValueError(f'Unreadable reference image: {e}')
+
+    if mime_type in SUPPORTED_MIME_TYPES and max(width, height) <= max_dimension:
+        return mime_type, data
+
+    image.draft('RGB', (max_dimension, max_dimension))  # DCT-domain downscale for JPEG
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image.save(output, format='PNG', optimize=True)
+        return 'image/png', output.getvalue()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(output, format='JPEG', quality=REFERENCE_IMAGE_JPEG_QUALITY, optimize=True)
+    return 'image/jpeg', output.getvalue()
+
+
+class _PreparedImageCache:
+    """Bounded LRU of prepared images keyed by the sha256 of the original bytes"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, digest: str) -> Optional[PreparedImage]:
+        with self._lock:
+            prepared = self._entries.get(digest)
+            if prepared is not None:
+                self._entries.move_to_end(digest)
+            return prepared
+
+    def put(self, prepared: PreparedImage):
+        with self._lock:
+            self._entries[prepared.digest] = prepared
+            self._entries.move_to_end(prepared.digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_prepared_images = _PreparedImageCache(REFERENCE_IMAGE_CACHE_ENTRIES)
+
+
+def prepare_reference_image(image: Union[bytes, str]) -> PreparedImage:
+    """Sniff, downsample and re-encode one reference image, memoized by content hash
+
+    Raises:
+        ValueError if the input is not a readable image
+    """
+    data = _to_bytes(image)
+    digest = hashlib.sha256(data).hexdigest()
+    prepared = _prepared_images.get(digest)
+    if prepared is not None:
+        return prepared
+
+    mime_type, data = _downsample(data, sniff_mime_type(data), REFERENCE_IMAGE_MAX_DIMENSION)
+    prepared = PreparedImage(mime_type, data, base64.b64encode(data).decode('ascii'), digest)
+    _prepared_images.put(prepared)
+    return prepared
+
+
+def prepare_reference_images(images: Optional[List[Union[bytes, str]]]) -> List[PreparedImage]:
+    return [prepare_reference_image(image) for image in images or []]
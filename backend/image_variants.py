@@ -0,0 +1,153 @@
+import io
+import os
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from image_cache import ImageCache
+
+VARIANT_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+    'png': ('PNG', 'image/png'),
+}
+VARIANT_MIN_WIDTH = 16
+VARIANT_MAX_WIDTH = int(os.getenv('IMAGE_VARIANT_MAX_WIDTH', '2048'))
+VARIANT_DEFAULT_QUALITY = int(os.getenv('IMAGE_VARIANT_DEFAULT_QUALITY', '80'))
+VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', str(min(4, os.cpu_count() or 1))))
+VARIANT_TIMEOUT = float(os.getenv('IMAGE_VARIANT_TIMEOUT', '30'))
+VARIANT_CACHE_MAX_BYTES = int(os.getenv('IMAGE_VARIANT_CACHE_MAX_BYTES', str(128 * 1024 * 1024)))
+
+
+def render_variant(source_path: str, width: Optional[int], fmt: str, quality: int) -> bytes:
+    """Resize and re-encode one image; runs inside a worker process"""
+    from PIL import Image
+
+    pil_format = VARIANT_FORMATS[fmt][0]
+    with Image.open(source_path) as image:
+        if width:
+            image.draft('RGB', (width, width))  # Cheap DCT-domain downscale for JPEG sources
+        if width and width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        options = {
+            'JPEG': {'quality': quality, 'optimize': True, 'progressive': True},
+            'WEBP': {'quality': quality, 'method': 4},
+            'PNG': {'optimize': True},
+        }[pil_format]
+        output = io.BytesIO()
+        image.save(output, format=pil_format, **options)
+        return output.getvalue()
+
+
+class ImageVariantService:
+    """Resized/re-encoded variants of stored images, rendered in a process pool and cached on disk
+
+    Variants are kept in their own content-addressed ImageCache under
+    <image cache>/variants, keyed by (source content id, width, format,
+    quality). Since the source images are immutable, so is every variant.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = VARIANT_CACHE_MAX_BYTES, workers: int = VARIANT_WORKERS):
+        self.cache = ImageCache(directory, max_bytes)
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self.rendered = 0
+        self.served_from_cache = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+        atexit.register(self.close)
+
+    @staticmethod
+    def parse_options(args) -> Optional[Tuple[Optional[int], str, int]]:
+        """(width, format, quality) from query args, or None if no variant was requested
+
+        Raises ValueError for unsupported values.
+        """
+        if not any(name in args for name in ('w', 'fmt', 'q')):
+            return None
+
+        width = args.get('w', type=int) if 'w' in args else None
+        if 'w' in args and width is None:
+            raise ValueError('w must be an integer')
+        if width is not None:
+            width = max(VARIANT_MIN_WIDTH, min(width, VARIANT_MAX_WIDTH))
+
+        fmt = args.get('fmt', 'jpeg').lower()
+        if fmt not in VARIANT_FORMATS:
+            raise ValueError(f'fmt must be one of: {", ".join(sorted(VARIANT_FORMATS))}')
+        if fmt == 'jpg':
+            fmt = 'jpeg'
+
+        quality = args.get('q', VARIANT_DEFAULT_QUALITY, type=int)
+        if quality is None or not 1 <= quality <= 95:
+            raise ValueError('q must be an integer between 1 and 95')
+        if fmt == 'png':
+            quality = 0  # Lossless; keep a single cache entry regardless of q
+        return width, fmt, quality
+
+    @staticmethod
+    def mimetype(fmt: str) -> str:
+        return VARIANT_FORMATS[fmt][1]
+
+    def get_variant(self, content_id: str, source_path: str,
+                    width: Optional[int], fmt: str, quality: int) -> Tuple[str, str]:
+        """Return (variant id, path) for a variant, rendering it on a miss"""
+        key = ImageCache.make_key(f'{content_id}:w={width or 0}:fmt={fmt}:q={quality}', model='variant')
+        variant_id = self.cache.lookup(key)
+        path = self.cache.blob_path(variant_id) if variant_id else None
+        if path:
+            with self._lock:
+                self.served_from_cache += 1
+            return variant_id, path
+
+        future = self._executor().submit(render_variant, os.path.abspath(source_path), width, fmt, quality)
+        variant_bytes = future.result(timeout=VARIANT_TIMEOUT)
+        variant_id = self.cache.put(key, variant_bytes)
+        with self._lock:
+            self.rendered += 1
+        return variant_id, self.cache.blob_path(variant_id)
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self._lock:
+            lookups = self.rendered + self.served_from_cache
+            stats.update({
+                'rendered': self.rendered,
+                'served_from_cache': self.served_from_cache,
+                'hit_ratio': round(self.served_from_cache / lookups, 3) if lookups else 0.0,
+                'workers': self.workers
+            })
+        return stats
+
+    def _executor(self) -> ProcessPoolExecutor:
+        pool = self._pool
+        if pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # spawn keeps workers independent of the server's threads and sockets.
+                    # Workers re-import the launching script as __mp_main__; app.py
+                    # builds nothing under that name, so they only load this module and Pillow
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+                pool = self._pool
+        return pool
+
+    def _reset_after_fork(self):
+        # The parent's pool (and its management thread) does not exist in the child
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Optional, Dict, Any, List
+
+
+class SqliteKeyPoolState:
+    """Node-wide ApiKeyPool state shared by every gunicorn worker through SQLite in WAL mode
+
+    Holds the key list, rotation index, per-key limits, usage counters and
+    breaker cooldowns. Workers keep their own in-memory snapshot and only
+    reload it when changed() reports that another connection committed,
+    which costs a single PRAGMA data_version (a few microseconds).
+    Cooldowns are stored as wall-clock timestamps so every process agrees.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS pool (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    keys TEXT NOT NULL,
+                    key_index INTEGER NOT NULL,
+                    key_limits TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS key_state (
+                    key TEXT PRIMARY KEY,
+                    usage INTEGER NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    open_until REAL NOT NULL DEFAULT 0
+                );
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self) -> sqlite3.Connection:
+        """One connection per thread, reopened in forked children"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = self._connect()
+            local.pid = os.getpid()
+            local.data_version = None
+        return local.conn
+
+    def changed(self) -> bool:
+        """True if another connection committed since this thread last looked"""
+        conn = self._conn()
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._local.data_version:
+            self._local.data_version = version
+            return True
+        return False
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Current shared state, or None if no keys have been stored yet"""
+        conn = self._conn()
+        row = conn.execute('SELECT keys, key_index, key_limits FROM pool WHERE id = 1').fetchone()
+        if row is None:
+            return None
+        keys = json.loads(row[0])
+        if not keys:
+            return None
+        key_state = {
+            key: {'usage': usage, 'failures': failures, 'open_until': open_until}
+            for key, usage, failures, open_until in conn.execute(
+                'SELECT key, usage, failures, open_until FROM key_state')
+        }
+        return {
+            'keys': keys,
+            'index': row[1],
+            'key_limits': json.loads(row[2]),
+            'key_state': key_state
+        }
+
+    def replace_keys(self, keys: List[str], key_limits: Dict[str, Any], index: int = 0):
+        """Store a new key list, resetting usage but keeping cooldowns of keys that stay"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO pool (id, keys, key_index, key_limits) VALUES (1, ?, ?, ?)',
+                (json.dumps(keys), index, json.dumps(key_limits))
+            )
+            conn.execute(
+                f'DELETE FROM key_state WHERE key NOT IN ({",".join("?" * len(keys))})', keys
+            )
+            conn.executemany('INSERT OR IGNORE INTO key_state (key) VALUES (?)', [(key,) for key in keys])
+            conn.execute('UPDATE key_state SET usage = 0')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def set_index(self, index: int):
+        self._conn().execute('UPDATE pool SET key_index = ? WHERE id = 1', (index,))
+
+    def record_failure(self, key: str, failures: int, open_until: float):
+        self._conn().execute(
+            'UPDATE key_state SET failures = ?, open_until = ? WHERE key = ?',
+            (failures, open_until, key)
+        )
+
+    def record_success(self, key: str):
+        self._conn().execute(
+            'UPDATE key_state SET failures = 0, open_until = 0 WHERE key = ? AND failures != 0',
+            (key,)
+        )
+
+    def add_usage(self, deltas: Dict[str, int]):
+        """Fold locally counted usage into the shared counters in one transaction"""
+        if not deltas:
+            return
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'UPDATE key_state SET usage = usage + ? WHERE key = ?',
+                [(delta, key) for key, delta in deltas.items()]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def usage(self) -> Dict[str, int]:
+        return dict(self._conn().execute('SELECT key, usage FROM key_state'))
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import copy
+import queue
+import atexit
+import logging
+import threading
+import traceback
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Any
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # 'text' or 'json'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'true').lower() in ('1', 'true', 'yes')
+
+# Client libraries that log every upstream request at INFO; their warnings still get through
+QUIET_LOGGERS = ('httpx', 'httpcore')
+
+# Attributes every LogRecord has; anything else on a record came from extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def sampled(every: int) -> Dict[str, Any]:
+    """extra= for a high-frequency message: emit one in every `every` occurrences
+
+        logger.debug('Using pool key %s', label, extra=sampled(50))
+    """
+    return {'sample_every': every}
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps 1 in N records per message template for records logged with extra=sampled(N)
+
+    Runs on the emitting thread before the record is queued, so dropped
+    records cost a counter increment and nothing else.
+    """
+
+    def __init__(self, enabled: bool = LOG_SAMPLING):
+        super().__init__()
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._seen: Dict[Any, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        every = getattr(record, 'sample_every', None)
+        if not self.enabled or not every or every <= 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+        return seen % every == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, message, thread, any extra= fields and exc"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and name not in entry:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        # Structured extras (lists, dicts) are kept; anything else falls back to repr
+        return json.dumps(entry, ensure_ascii=False, default=repr)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never waits: when the queue is full the record is dropped and counted"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge args and render the traceback here; the listener thread must not
+        # touch objects the request thread may still be mutating
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        record.message = record.msg
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _LoggingState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handler = None
+        self.listener = None
+        self.output = None
+
+
+_state = _LoggingState()
+
+
+def _start_listener():
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _state.handler.queue = log_queue
+    _state.listener = QueueListener(log_queue, _state.output, respect_handler_level=True)
+    _state.listener.start()
+
+
+def _restart_after_fork():
+    # The listener thread does not exist in a forked child, and records the parent
+    # had queued would be written twice; start over with an empty queue
+    if _state.handler is not None:
+        _state.lock = threading.Lock()
+        _start_listener()
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    with _state.lock:
+        if _state.listener is not None:
+            _state.listener.stop()
+            _state.listener = None
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Route the root logger through a bounded queue to a stdout writer thread
+
+    Request threads only format the message and enqueue it; the write to
+    stdout happens on the listener thread. Safe to call more than once.
+    """
+    with _state.lock:
+        if _state.handler is not None:
+            return _state.handler
+
+        output = logging.StreamHandler(sys.stdout)
+        if fmt == 'json':
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        _state.output = output
+
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        handler.addFilter(SamplingFilter())
+        _state.handler = handler
+        _start_listener()
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(level)
+        for name in QUIET_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        atexit.register(stop_logging)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_restart_after_fork)
+        return handler
+
+
+def logging_stats() -> Dict[str, Any]:
+    handler = _state.handler
+    if handler is None:
+        return {'configured': False}
+    return {
+        'configured': True,
+        'level': logging.getLevelName(logging.getLogger().level),
+        'queued': handler.queue.qsize(),
+        'dropped': handler.dropped
+    }
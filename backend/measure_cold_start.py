@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Cold-start budget check for the backend
+
+Imports app in fresh interpreters with `python -X importtime`, reports the
+slowest imports and total startup time, and fails if the budget is exceeded
+or if a heavy SDK that should be lazily imported is loaded at startup.
+
+    python measure_cold_start.py            # 5 runs, default budget
+    COLD_START_BUDGET_MS=600 python measure_cold_start.py
+"""
+
+import os
+import re
+import sys
+import statistics
+import subprocess
+
+BUDGET_MS = float(os.getenv('COLD_START_BUDGET_MS', '800'))
+RUNS = int(os.getenv('COLD_START_RUNS', '5'))
+TOP_IMPORTS = int(os.getenv('COLD_START_TOP_IMPORTS', '15'))
+
+# Must only be imported on first use, never while importing app
+LAZY_MODULES = ('google.generativeai', 'google.ai.generativelanguage', 'firebase_admin', 'PIL', 'httpx')
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def measure_once():
+    """Import app in a fresh interpreter; returns (wall ms, [(cumulative us, self us, depth, module)])"""
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    code = 'import time; t = time.perf_counter(); import app; print((time.perf_counter() - t) * 1000)'
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=backend_dir, capture_output=True, text=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing app failed:\n{result.stderr[-2000:]}')
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((int(cumulative_us), int(self_us), (len(indent) - 1) // 2, module))
+    wall_ms = float(result.stdout.strip().splitlines()[-1])
+    return wall_ms, imports
+
+
+def main():
+    """Run the cold-start measurement"""
+    print(f"🚀 Cold-start measurement ({RUNS} runs, budget {BUDGET_MS:.0f} ms)")
+    print("=" * 50)
+
+    wall_times = []
+    imports = []
+    for _ in range(RUNS):
+        wall_ms, imports = measure_once()
+        wall_times.append(wall_ms)
+
+    median_ms = statistics.median(wall_times)
+    print(f"\n⏱️ import app: median {median_ms:.1f} ms (min {min(wall_times):.1f}, max {max(wall_times):.1f})")
+
+    print(f"\n📊 Slowest imports (cumulative, last run):")
+    for cumulative_us, self_us, depth, module in sorted(imports, reverse=True)[:TOP_IMPORTS]:
+        print(f"   {cumulative_us / 1000:8.1f} ms  {'  ' * depth}{module}")
+
+    eager = sorted({module for _, _, _, module in imports
+                    if any(module == lazy or module.startswith(lazy + '.') for lazy in LAZY_MODULES)})
+    if eager:
+        print(f"\n❌ Imported at startup but should be lazy: {', '.join(eager)}")
+    else:
+        print(f"\n✅ No heavy SDK imported at startup")
+
+    within_budget = median_ms <= BUDGET_MS
+    print(f"{'✅' if within_budget else '❌'} Median {median_ms:.1f} ms vs budget {BUDGET_MS:.0f} ms")
+    return 0 if within_budget and not eager else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
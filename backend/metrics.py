@@ -0,0 +1,264 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def key_label(api_key: Optional[str]) -> str:
+    """Non-secret label for an API key: its last six characters"""
+    return f'...{api_key[-6:]}' if api_key else 'none'
+
+
+class _Metric:
+    """Base for labelled metrics; children are created on first use of a label set"""
+
+    type_name = ''
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}, got {key}')
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type_name}']
+        lines.extend(self._samples())
+        return lines
+
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in sorted(self._children.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in sorted(self._children.items()):
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}'
+
+
+class Registry:
+    """Holds metrics plus collectors that report point-in-time values at scrape time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def register_collector(self, collector):
+        """collector() yields (name, type, help, labels dict, value) tuples
+
+        Registering the same collector again is a no-op, so building the app
+        twice in one process does not repeat its samples.
+        """
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        # Collectors may interleave families (e.g. per key); the text format wants them grouped
+        families = {}
+        for collector in collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                lines.append(f'# collector {getattr(collector, "__name__", collector)} failed: {_escape(e)}')
+                continue
+            for name, type_name, help_text, labels, value in samples:
+                family = families.setdefault(name, [f'# HELP {name} {help_text}', f'# TYPE {name} {type_name}'])
+                family.append(f'{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}')
+        for family in families.values():
+            lines.extend(family)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# HTTP layer
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    'storybook_http_request_duration_seconds', 'Flask request latency by route', ('route', 'method', 'status'))
+HTTP_REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    'storybook_http_requests_in_flight', 'Requests currently being handled', ('route',))
+HTTP_REQUEST_BYTES = REGISTRY.counter(
+    'storybook_http_request_bytes_total', 'Request body bytes received by route', ('route',))
+HTTP_RESPONSE_BYTES = REGISTRY.counter(
+    'storybook_http_response_bytes_total', 'Response body bytes sent by route (known lengths only)', ('route',))
+
+# Gemini upstream
+UPSTREAM_DURATION = REGISTRY.histogram(
+    'storybook_upstream_request_duration_seconds', 'Gemini call latency per attempt', ('model', 'key'))
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    'storybook_upstream_responses_total', 'Gemini call outcomes per attempt by status code', ('model', 'key', 'status'))
+UPSTREAM_RESPONSE_BYTES = REGISTRY.counter(
+    'storybook_upstream_response_bytes_total', 'Gemini response body bytes', ('model',))
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge(
+    'storybook_upstream_requests_in_flight', 'Gemini calls currently in flight', ('model',))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    'storybook_upstream_retries_total', 'Gemini calls retried after a throttled or overloaded attempt', ('model',))
+KEY_ROTATIONS = REGISTRY.counter(
+    'storybook_api_key_rotations_total', 'API key rotations', ('reason',))
+
+
+def observe_upstream(model: str, api_key: Optional[str], status, started: float):
+    """Record one finished Gemini attempt started at time.perf_counter() value started"""
+    key = key_label(api_key)
+    UPSTREAM_DURATION.labels(model, key).observe(time.perf_counter() - started)
+    UPSTREAM_RESPONSES.labels(model, key, status).inc()
+
+
+def _exception_status(error: Exception):
+    """HTTP status carried by an SDK exception (google.api_core sets .code), else 'error'"""
+    code = getattr(error, 'code', None)
+    try:
+        return int(code)
+    except (TypeError, ValueError):
+        return 'timeout' if isinstance(error, TimeoutError) else 'error'
+
+
+@contextmanager
+def track_upstream(model: str, api_key: Optional[str]):
+    """Time a Gemini SDK attempt; an exception raised inside is recorded by its status code"""
+    started = time.perf_counter()
+    status = 200
+    UPSTREAM_IN_FLIGHT.labels(model).inc()
+    try:
+        yield
+    except Exception as e:
+        status = _exception_status(e)
+        raise
+    finally:
+        UPSTREAM_IN_FLIGHT.labels(model).dec()
+        observe_upstream(model, api_key, status, started)
@@ -0,0 +1,112 @@
+import os
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls made from threads
+
+    The first caller for a key runs fn; callers arriving while it is in
+    flight block until it finishes and receive the same result, or the same
+    exception. Nothing is remembered once the call completes, so this only
+    collapses duplicates that overlap in time (caching is a separate layer).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self.executed = 0
+        self.coalesced = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # Leaders of the parent's in-flight calls do not exist in the child
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, fn: Callable[..., Any], *args, wait_timeout: Optional[float] = None, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) once per key among overlapping callers
+
+        A caller that joins an in-flight call gives up after wait_timeout
+        seconds with TimeoutError; the call itself carries on for the others.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not call.done.wait(wait_timeout):
+                raise TimeoutError(f'Gave up waiting for in-flight call after {wait_timeout:.1f}s')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'executed': self.executed,
+                'coalesced': self.coalesced
+            }
+
+
+class AsyncSingleFlight:
+    """Coalesce concurrent identical coroutines on one event loop
+
+    The first caller's coroutine runs as its own task and every caller,
+    including the first, awaits it through asyncio.shield, so a caller that
+    times out or is cancelled never cancels the work the others wait on.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.executed = 0
+        self.coalesced = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._tasks.clear)
+
+    async def do(self, key: str, coro_factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._tasks.get(key)
+        # A finished task whose done callback has not run yet is never joined
+        if task is None or task.done():
+            task = asyncio.ensure_future(coro_factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done, key=key: self._tasks.pop(key, None) if self._tasks.get(key) is done else None)
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'in_flight': len(self._tasks),
+            'executed': self.executed,
+            'coalesced': self.coalesced
+        }
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import uuid
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, List
+
+logger = logging.getLogger(__name__)
+
+STORY_JOB_STORE = os.getenv('STORY_JOB_STORE', 'memory')
+STORY_JOB_DB = os.getenv('STORY_JOB_DB', 'story_jobs.db')
+STORY_JOB_WORKERS = int(os.getenv('STORY_JOB_WORKERS', '2'))
+STORY_JOB_MAX_PENDING = int(os.getenv('STORY_JOB_MAX_PENDING', '32'))
+STORY_JOB_TTL_SECONDS = float(os.getenv('STORY_JOB_TTL_SECONDS', '3600'))
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue is at STORY_JOB_MAX_PENDING"""
+
+
+def _new_job(job_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    now = time.time()
+    return {
+        'jobId': job_id,
+        'status': 'queued',  # queued -> running -> succeeded | failed
+        'stage': None,  # 'text' while page scripts arrive, then 'images'
+        'params': params,
+        'progress': {'pagesWritten': 0, 'imagesDone': 0, 'totalPages': 0},
+        'pages': [],
+        'story': None,
+        'error': None,
+        'createdAt': now,
+        'updatedAt': now
+    }
+
+
+def _store_page(pages: List[Dict[str, Any]], page: Dict[str, Any]):
+    index = page['pageNumber'] - 1
+    pages.extend({} for _ in range(index + 1 - len(pages)))
+    pages[index] = page
+
+
+class InMemoryJobStore:
+    """Jobs kept in this process only; GET must reach the worker that ran POST"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+
+    def create(self, job_id: str, params: Dict[str, Any]):
+        with self._lock:
+            self._jobs[job_id] = _new_job(job_id, params)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            # Pages are replaced, never mutated, so a shallow copy is a consistent snapshot
+            return dict(job, progress=dict(job['progress']), pages=list(job['pages']))
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updatedAt=time.time())
+
+    def put_page(self, job_id: str, page: Dict[str, Any], **fields):
+        """Store a copy of a page at its pageNumber, along with any other field updates"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                _store_page(job['pages'], dict(page))
+                job.update(fields, updatedAt=time.time())
+
+    def purge(self, older_than: float):
+        """Drop finished jobs last updated before older_than (epoch seconds)"""
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job['status'] in ('succeeded', 'failed') and job['updatedAt'] < older_than]:
+                del self._jobs[job_id]
+
+
+class SqliteJobStore:
+    """Jobs in a SQLite (WAL) file, so every gunicorn worker on the node can answer GET"""
+
+    _COLUMNS = ('status', 'stage', 'params', 'progress', 'pages', 'story', 'error', 'createdAt', 'updatedAt')
+    _JSON_COLUMNS = ('params', 'progress', 'pages', 'story')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS story_jobs (
+                jobId TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                stage TEXT,
+                params TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                pages TEXT NOT NULL,
+                story TEXT,
+                error TEXT,
+                createdAt REAL NOT NULL,
+                updatedAt REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS story_jobs_updated ON story_jobs (updatedAt)')
+
+    def _conn(self) -> sqlite3.Connection:
+        """One connection per thread, reopened in forked children"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.conn
+
+    def _encode(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            name: json.dumps(value) if name in self._JSON_COLUMNS else value
+            for name, value in fields.items() if name in self._COLUMNS
+        }
+
+    def create(self, job_id: str, params: Dict[str, Any]):
+        job = self._encode(_new_job(job_id, params))
+        self._conn().execute(
+            f'INSERT INTO story_jobs (jobId, {", ".join(job)}) VALUES (?, {", ".join("?" * len(job))})',
+            (job_id, *job.values())
+        )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            f'SELECT jobId, {", ".join(self._COLUMNS)} FROM story_jobs WHERE jobId = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(('jobId',) + self._COLUMNS, row))
+        for name in self._JSON_COLUMNS:
+            job[name] = json.loads(job[name]) if job[name] is not None else None
+        return job
+
+    def update(self, job_id: str, **fields):
+        fields = self._encode(dict(fields, updatedAt=time.time()))
+        self._conn().execute(
+            f'UPDATE story_jobs SET {", ".join(f"{name} = ?" for name in fields)} WHERE jobId = ?',
+            (*fields.values(), job_id)
+        )
+
+    def put_page(self, job_id: str, page: Dict[str, Any], **fields):
+        """Store a page at its pageNumber, along with any other field updates, in one transaction"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT pages FROM story_jobs WHERE jobId = ?', (job_id,)).fetchone()
+            if row is not None:
+                pages = json.loads(row[0])
+                _store_page(pages, page)
+                fields = self._encode(dict(fields, pages=pages, updatedAt=time.time()))
+                conn.execute(
+                    f'UPDATE story_jobs SET {", ".join(f"{name} = ?" for name in fields)} WHERE jobId = ?',
+                    (*fields.values(), job_id)
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def purge(self, older_than: float):
+        self._conn().execute(
+            "DELETE FROM story_jobs WHERE status IN ('succeeded', 'failed') AND updatedAt < ?", (older_than,)
+        )
+
+
+class JobProgress:
+    """Handed to the job handler to report incremental progress"""
+
+    def __init__(self, store, job_id: str):
+        self.store = store
+        self.job_id = job_id
+        self.pages_written = 0
+        self.images_done = 0
+        self.total_pages = 0
+
+    def _progress(self) -> Dict[str, int]:
+        return {
+            'pagesWritten': self.pages_written,
+            'imagesDone': self.images_done,
+            'totalPages': self.total_pages
+        }
+
+    def stage(self, stage: str, total_pages: Optional[int] = None):
+        if total_pages is not None:
+            self.total_pages = total_pages
+        self.store.update(self.job_id, stage=stage, progress=self._progress())
+
+    def page_written(self, page: Dict[str, Any]):
+        self.pages_written += 1
+        self.total_pages = max(self.total_pages, self.pages_written)
+        self.store.put_page(self.job_id, page, progress=self._progress())
+
+    def image_done(self, page: Dict[str, Any]):
+        self.images_done += 1
+        self.store.put_page(self.job_id, page, progress=self._progress())
+
+
+class StoryJobRunner:
+    """Bounded background worker pool for story jobs
+
+    handler(params, progress) runs the pipeline and returns the finished
+    story; it reports pages through progress as they complete. At most
+    max_pending jobs are queued or running at once.
+    """
+
+    def __init__(self, store, handler: Callable[[Dict[str, Any], JobProgress], Dict[str, Any]],
+                 max_workers: int = STORY_JOB_WORKERS, max_pending: int = STORY_JOB_MAX_PENDING,
+                 ttl_seconds: float = STORY_JOB_TTL_SECONDS):
+        self.store = store
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The parent's worker threads and queued jobs do not exist in the child
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='story-job')
+            return self._executor
+
+    def submit(self, params: Dict[str, Any]) -> str:
+        """Queue a job and return its id
+
+        Raises:
+            JobQueueFull if max_pending jobs are already queued or running
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull(f'{self.max_pending} story jobs already pending')
+        try:
+            self.store.purge(time.time() - self.ttl_seconds)
+            job_id = uuid.uuid4().hex
+            self.store.create(job_id, params)
+            self._pool().submit(self._run, job_id, params)
+            return job_id
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _run(self, job_id: str, params: Dict[str, Any]):
+        try:
+            self.store.update(job_id, status='running')
+            story = self.handler(params, JobProgress(self.store, job_id))
+            # Pages live in the job itself; the story keeps only its metadata
+            story = {name: value for name, value in story.items() if name != 'pages'}
+            self.store.update(job_id, status='succeeded', stage=None, story=story)
+            logger.info("✅ Story job %s finished", job_id)
+        except Exception as e:
+            logger.error("❌ Story job %s failed: %s", job_id, e)
+            try:
+                self.store.update(job_id, status='failed', error=str(e))
+            except Exception as store_error:
+                logger.error("❌ Could not record failure of story job %s: %s", job_id, store_error)
+        finally:
+            self._slots.release()
+
+
+def create_job_store():
+    """Job store selected by STORY_JOB_STORE ('memory' or 'sqlite')"""
+    if STORY_JOB_STORE == 'sqlite':
+        return SqliteJobStore(STORY_JOB_DB)
+    return InMemoryJobStore()
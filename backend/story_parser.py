@@ -0,0 +1,59 @@
+import re
+
+
+class StoryPageStreamParser:
+    """Incrementally split streamed story text on "Page N:" boundaries
+
+    A page is complete once the next page header (or the end of the stream)
+    arrives, so each page can be pushed to the client without waiting for the
+    rest of the story.
+    """
+    _PAGE_HEADER = re.compile(r'^[*#\s]*page\s+(\d+)\s*\**\s*:\s*\**\s*(.*)$', re.IGNORECASE)
+
+    def __init__(self):
+        self._buffer = ''
+        self._current = None
+
+    def feed(self, text):
+        """Consume a chunk of text and return any pages it completed"""
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split('\n')
+        completed = []
+        for line in lines:
+            page = self._consume_line(line)
+            if page:
+                completed.append(page)
+        return completed
+
+    def close(self):
+        """Flush the trailing partial line and the final open page"""
+        completed = []
+        if self._buffer:
+            page = self._consume_line(self._buffer)
+            self._buffer = ''
+            if page:
+                completed.append(page)
+        if self._current and self._current['script']:
+            completed.append(self._current)
+        self._current = None
+        return completed
+
+    def _consume_line(self, line):
+        line = line.strip()
+        if not line:
+            return None
+
+        match = self._PAGE_HEADER.match(line)
+        if match:
+            finished = self._current if self._current and self._current['script'] else None
+            self._current = {
+                'pageNumber': int(match.group(1)),
+                'script': match.group(2).strip(),
+                'imageUrl': None
+            }
+            return finished
+
+        # Continuation of the current page; text before the first header is ignored
+        if self._current is not None:
+            self._current['script'] = f"{self._current['script']} {line}".strip()
+        return None
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Test script for request deadline budgeting and single-flight sharing
+
+Runs in-process without a backend, SDKs or network; also collected by pytest.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import deadlines
+from deadlines import DeadlineExceeded
+from single_flight import SingleFlight, AsyncSingleFlight
+from gemini_image_service import GeminiImageService, _deadline_result
+from gemini_text_service import GeminiTextService
+
+
+def _in_context(fn, *args):
+    """Run fn in a fresh copy of the current context, so deadlines set inside never leak"""
+    return contextvars.copy_context().run(fn, *args)
+
+
+def test_route_budget_client_can_only_shorten():
+    """X-Request-Deadline-Ms shortens the route budget but never extends it"""
+    default = deadlines.REQUEST_DEADLINE_SECONDS
+    assert deadlines.route_budget('/api/health') == default
+    assert deadlines.route_budget('/api/health', '3000') == 3.0
+    assert deadlines.route_budget('/api/health', str(int(default * 2000))) == default
+    assert deadlines.route_budget('/api/health', 'soon') == default
+    assert deadlines.route_budget('/api/health', '-5') == default
+
+
+def test_timeout_is_capped_by_remaining_budget():
+    """Per-attempt timeouts shrink to what is left; without a deadline they are untouched"""
+    assert deadlines.timeout(60) == 60
+
+    def check():
+        deadlines.start(5)
+        assert 4 < deadlines.timeout(60) <= 5
+        assert deadlines.timeout(1) == 1
+    _in_context(check)
+    assert deadlines.current() is None
+
+
+def test_check_raises_and_marks_exceeded():
+    """No attempt starts with less than the minimum left, and the request is marked exceeded"""
+    def check():
+        deadlines.start(deadlines.DEADLINE_MIN_ATTEMPT_SECONDS / 2)
+        assert not deadlines.exceeded()
+        try:
+            deadlines.check('test attempt')
+        except DeadlineExceeded as e:
+            assert 'test attempt skipped' in str(e)
+        else:
+            raise AssertionError('check() should have raised')
+        assert deadlines.exceeded()
+    _in_context(check)
+
+
+def test_cut_short_only_for_capped_timeouts():
+    """A timeout is blamed on the deadline only if the deadline capped it and has run out"""
+    def check():
+        deadlines.start(0.2)
+        assert not deadlines.cut_short(60, 60)  # not capped: a slow upstream
+        time.sleep(0.2)
+        assert deadlines.cut_short(0.2, 60)
+        assert deadlines.exceeded()
+    _in_context(check)
+
+
+def test_stream_body_keeps_request_deadline():
+    """A streamed body runs in the context of the request that created it"""
+    seen = []
+
+    def body():
+        for _ in range(2):
+            seen.append(deadlines.current())
+            yield 'chunk'
+
+    def view():
+        deadlines.start(30)
+        return deadlines.current(), deadlines.in_request_context(body())
+    deadline, stream = _in_context(view)
+    assert deadlines.current() is None
+    assert list(stream) == ['chunk', 'chunk']
+    assert seen == [deadline, deadline]
+
+
+def test_single_flight_shares_one_call():
+    """Overlapping identical calls run once; late callers get the same result"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', work)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', work))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {'in_flight': 0, 'executed': 1, 'coalesced': 3}
+
+
+def test_single_flight_follower_wait_timeout():
+    """A follower gives up after its wait_timeout; the call carries on for the leader"""
+    flight = SingleFlight()
+    started = threading.Event()
+    results = []
+
+    def work():
+        started.set()
+        time.sleep(0.3)
+        return 'done'
+
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', work)))
+    leader.start()
+    started.wait(5)
+    try:
+        flight.do('key', work, wait_timeout=0.05)
+    except TimeoutError:
+        pass
+    else:
+        raise AssertionError('follower should have timed out')
+    leader.join()
+    assert results == ['done']
+
+
+def test_async_single_flight_cancelled_caller_does_not_cancel_call():
+    """A caller that stops waiting leaves the shared task running for the others"""
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return 'shared'
+
+    async def scenario():
+        impatient = asyncio.ensure_future(asyncio.wait_for(flight.do('key', work), 0.01))
+        patient = asyncio.ensure_future(flight.do('key', work))
+        try:
+            await impatient
+        except asyncio.TimeoutError:
+            pass
+        return await patient
+
+    assert asyncio.run(scenario()) == 'shared'
+    assert len(calls) == 1
+
+
+def test_image_follower_retries_after_leader_deadline():
+    """A shared image call cut short by the leader's deadline is not handed to a follower with time left"""
+    service = GeminiImageService(key_provider=None)
+    service.image_cache = None
+    calls = []
+
+    async def fake_coalesced(prompt, prepared_images, timeout, response_format, request_key):
+        # Upstream takes 0.3 s; a deadline shorter than that cuts the call short
+        remaining = deadlines.remaining()
+        calls.append(remaining)
+        if remaining is not None and remaining < 0.3:
+            await asyncio.sleep(max(0.0, remaining))
+            deadlines.mark_exceeded()
+            return _deadline_result(1)
+        await asyncio.sleep(0.3)
+        return {'success': True, 'imageBytes': b'jpeg', 'mimeType': 'image/jpeg'}
+
+    service._agenerate_coalesced = fake_coalesced
+
+    async def leader():
+        deadlines.start(0.1)  # like X-Request-Deadline-Ms: 100
+        return await service.agenerate_gemini_image('same prompt')
+
+    async def follower():
+        await asyncio.sleep(0.01)  # joins the leader's call
+        return await service.agenerate_gemini_image('same prompt')
+
+    async def scenario():
+        return await asyncio.gather(leader(), follower())
+
+    leader_result, follower_result = asyncio.run(scenario())
+    assert leader_result.get('deadlineExceeded'), leader_result
+    assert follower_result['success'], follower_result
+    assert len(calls) == 2, calls
+    assert service.in_flight.stats()['coalesced'] == 1
+
+
+def test_text_follower_retries_after_leader_deadline():
+    """A DeadlineExceeded from the leader's shorter deadline does not fail a follower with time left"""
+    service = GeminiTextService(key_provider=None)
+    service.text_cache = None
+    started = threading.Event()
+    calls = []
+
+    def fake_uncached(prompt, system_instruction, generation_config, prepared_images, cache_key):
+        calls.append(deadlines.remaining())
+        started.set()
+        time.sleep(0.2)
+        deadlines.check('fake attempt')  # the leader's budget is gone by now
+        return 'text'
+
+    service._generate_text_uncached = fake_uncached
+    results = {}
+
+    def leader():
+        deadlines.start(deadlines.DEADLINE_MIN_ATTEMPT_SECONDS + 0.1)
+        try:
+            results['leader'] = service.generate_text('same prompt')
+        except DeadlineExceeded as e:
+            results['leader'] = e
+
+    def follower():
+        started.wait(5)
+        try:
+            results['follower'] = service.generate_text('same prompt')
+        except DeadlineExceeded as e:
+            results['follower'] = e
+
+    threads = [threading.Thread(target=_in_context, args=(leader,)), threading.Thread(target=follower)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert isinstance(results['leader'], DeadlineExceeded), results
+    assert results['follower'] == 'text', results
+    assert len(calls) == 2
+
+
+def main():
+    """Run the deadline and single-flight tests"""
+    print("🚀 Testing request deadlines and single-flight sharing")
+    print("=" * 50)
+    failed = 0
+    for name, test in [(name, test) for name, test in globals().items() if name.startswith('test_')]:
+        try:
+            test()
+            print(f"✅ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {name}: {e!r}")
+    print(f"\n{'✅ All deadline tests passed' if not failed else f'❌ {failed} deadline test(s) failed'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test script for the content-addressed ImageCache
+
+Runs in-process against a temporary directory; also collected by pytest.
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from image_cache import ImageCache
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'p' * 200
+JPEG = b'\xff\xd8\xff\xe0' + b'j' * 200
+
+
+def _cache(max_bytes=10 ** 6, directory=None):
+    return ImageCache(directory or tempfile.mkdtemp(), max_bytes)
+
+
+def test_mime_type_is_sniffed_not_taken_from_name():
+    """Blobs are named .jpg, but a PNG is reported as PNG, also by another worker's cache"""
+    cache = _cache()
+    png_id = cache.put('png request', PNG)
+    jpeg_id = cache.put_blob(JPEG)
+    assert cache.blob_path(png_id).endswith('.jpg')
+    assert cache.mime_type(png_id) == 'image/png'
+    assert cache.mime_type(jpeg_id) == 'image/jpeg'
+    other_worker = _cache(directory=cache.directory)
+    assert other_worker.mime_type(png_id, other_worker.get('png request')) == 'image/png'
+
+
+def _image(n, size=1000):
+    return JPEG[:4] + bytes([n]) * size
+
+
+def test_lru_evicts_unpinned_blobs():
+    """Over the byte budget the least recently used blob goes"""
+    cache = _cache(max_bytes=2500)
+    first = cache.put('first', _image(1))
+    cache.put('second', _image(2))
+    cache.put('third', _image(3))
+    assert cache.blob_path(first) is None and cache.get('first') is None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_pinned_blob_is_never_evicted():
+    """A blob whose URL went out survives any amount of later traffic and does not use the budget"""
+    cache = _cache(max_bytes=2500)
+    pinned = cache.put_blob(_image(1), pin=True)
+    for n in range(2, 10):
+        cache.put(f'request {n}', _image(n))
+    assert cache.blob_path(pinned)
+    stats = cache.stats()
+    assert stats['pinned_images'] == 1 and stats['bytes'] <= 2500, stats
+
+
+def test_pin_after_put_and_across_workers():
+    """Pinning a cached blob protects it in this worker, after a restart and in another worker's LRU"""
+    cache = _cache(max_bytes=2500)
+    content_id = cache.put('cached first', _image(1))
+    other_worker = _cache(max_bytes=2500, directory=cache.directory)
+    assert cache.pin(content_id)
+    for n in range(2, 10):
+        other_worker.put(f'request {n}', _image(n))
+        cache.put(f'request {n}', _image(n))
+    assert cache.blob_path(content_id) and other_worker.blob_path(content_id)
+    restarted = _cache(max_bytes=2500, directory=cache.directory)
+    assert restarted.stats()['pinned_images'] == 1
+    assert restarted.get('cached first') == _image(1)
+
+
+def test_pin_missing_blob_fails():
+    """Pinning an id that is not stored reports failure so the caller stores the bytes"""
+    cache = _cache()
+    assert not cache.pin('0' * 64)
+
+
+def main():
+    """Run the image cache tests"""
+    print("🚀 Testing the image cache")
+    print("=" * 50)
+    failed = 0
+    for name, test in [(name, test) for name, test in globals().items() if name.startswith('test_')]:
+        try:
+            test()
+            print(f"✅ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {name}: {e!r}")
+    print(f"\n{'✅ All image cache tests passed' if not failed else f'❌ {failed} image cache test(s) failed'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
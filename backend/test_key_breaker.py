@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-key token buckets and circuit breakers in ApiKeyPool
+
+Runs in-process without a backend or network; also collected by pytest.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import api_key_pool
+from api_key_pool import ApiKeyPool, _KeyBreaker, _KeyQuota, _TokenBucket
+
+KEYS = [f'AIza{i:02d}Breaker-xxxxxxxxxxxxxxxxxxxxxxxxx' for i in range(3)]
+
+
+def _fresh_pool(keys=KEYS):
+    ApiKeyPool._keys_file = os.path.join(tempfile.mkdtemp(), 'api_keys_pool.json')
+    ApiKeyPool._state = api_key_pool._PoolSnapshot((), 0, {}, {}, {})
+    ApiKeyPool.update_keys(list(keys))
+
+
+def test_token_bucket_refills():
+    """A bucket hands out its capacity, refuses the next take, then refills with time"""
+    bucket = _TokenBucket(2, 1.0)
+    now = 1000.0
+    bucket._updated = now
+    assert bucket.try_take(now) and bucket.try_take(now)
+    assert not bucket.try_take(now)
+    assert bucket.try_take(now + 1.0)
+    bucket.drain(now + 1.0)
+    assert bucket.tokens(now + 1.0) == 0.0
+    assert bucket.tokens(now + 100.0) == 2.0  # never above capacity
+
+
+def test_quota_gives_back_day_token():
+    """A take refused by the minute bucket does not cost a day token"""
+    quota = _KeyQuota(rpm=1, rpd=10)
+    now = quota.per_day._updated
+    assert quota.try_take(now)
+    day_tokens = quota.per_day.tokens(now)
+    assert not quota.try_take(now)
+    assert quota.per_day.tokens(now) == day_tokens
+
+
+def test_breaker_open_half_open_closed():
+    """Throttle opens the breaker; after the cooldown one probe is admitted and its success closes it"""
+    breaker = _KeyBreaker()
+    now = 1000.0
+    assert breaker.record_failure(now)
+    assert breaker.state == _KeyBreaker.OPEN
+    assert not breaker.allows(now)
+    later = breaker.open_until + 0.01
+    assert breaker.try_acquire(later)
+    assert breaker.state == _KeyBreaker.HALF_OPEN
+    assert not breaker.try_acquire(later), 'only one probe at a time'
+    assert breaker.record_success()
+    assert breaker.state == _KeyBreaker.CLOSED and breaker.failures == 0
+
+
+def test_breaker_failed_probe_doubles_cooldown():
+    """A throttled half-open probe re-opens the breaker for longer"""
+    breaker = _KeyBreaker()
+    now = 1000.0
+    breaker.record_failure(now)
+    later = breaker.open_until + 0.01
+    breaker.try_acquire(later)
+    assert breaker.record_failure(later)
+    assert breaker.failures == 2
+    assert breaker.open_until - later >= api_key_pool.KEY_BREAKER_BASE_COOLDOWN  # at least half of 2x base
+
+
+def test_concurrent_throttles_count_once():
+    """Throttles from requests already in flight on an open breaker do not lengthen its cooldown"""
+    breaker = _KeyBreaker()
+    now = 1000.0
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(breaker.record_failure(now))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+    assert breaker.failures == 1
+    assert breaker.open_until - now <= api_key_pool.KEY_BREAKER_BASE_COOLDOWN
+
+
+def test_cooldown_exponent_is_clamped():
+    """Thousands of failed probes keep the cooldown at the maximum instead of overflowing"""
+    breaker = _KeyBreaker()
+    now = 1000.0
+    for _ in range(2000):
+        breaker.state = _KeyBreaker.HALF_OPEN
+        breaker.record_failure(now)
+    assert breaker.open_until - now <= api_key_pool.KEY_BREAKER_MAX_COOLDOWN
+
+
+def test_manual_rotation_does_not_trip_breakers():
+    """Rotating without a failed key only advances the index"""
+    _fresh_pool()
+    for _ in range(len(KEYS)):
+        assert ApiKeyPool.rotate_key()
+    status = ApiKeyPool.get_pool_status()
+    assert all(entry['state'] == _KeyBreaker.CLOSED for entry in status['breakers'].values())
+    assert ApiKeyPool.get_key() is not None
+
+
+def test_throttled_rotation_skips_failed_key():
+    """A throttled key is opened and drained, and get_key stops handing it out"""
+    _fresh_pool()
+    assert ApiKeyPool.rotate_key(KEYS[0])
+    state = ApiKeyPool._state
+    assert state.breakers[KEYS[0]].state == _KeyBreaker.OPEN
+    assert state.keys[state.index] != KEYS[0]
+    for _ in range(10):
+        assert ApiKeyPool.get_key() != KEYS[0]
+    ApiKeyPool.report_success(KEYS[0])
+    assert state.breakers[KEYS[0]].state == _KeyBreaker.CLOSED
+
+
+def _half_open_single_key():
+    """One-key pool whose breaker has just cooled down, so get_key claims the probe"""
+    _fresh_pool(KEYS[:1])
+    ApiKeyPool.rotate_key(KEYS[0])
+    ApiKeyPool._state.breakers[KEYS[0]].open_until = 0.0
+    bucket = ApiKeyPool._state.quotas[KEYS[0]].per_minute
+    bucket._tokens = float(bucket.capacity)
+
+
+def test_released_probe_can_be_claimed_again():
+    """A probe given back by release_key is admitted again instead of waiting out the probe timeout"""
+    _half_open_single_key()
+    assert ApiKeyPool.get_key() == KEYS[0]
+    assert ApiKeyPool._state.breakers[KEYS[0]].state == _KeyBreaker.HALF_OPEN
+    assert ApiKeyPool.get_key() is None, 'the probe is taken'
+    ApiKeyPool.release_key(KEYS[0])
+    assert ApiKeyPool.get_key() == KEYS[0]
+
+
+def test_text_error_on_probe_releases_it():
+    """A non-throttle failure on the probe key leaves the key schedulable for the next request"""
+    from gemini_text_service import GeminiTextService
+
+    class BlockedResponse:
+        @property
+        def text(self):
+            raise ValueError('response was blocked')
+
+    class Models:
+        def get(self, api_key, model_name, generation_config):
+            return type('Model', (), {'generate_content': lambda self, parts: BlockedResponse()})()
+
+    _half_open_single_key()
+    service = GeminiTextService(key_provider=ApiKeyPool)
+    service._models = Models()
+    result = service._generate_text_uncached('prompt', None, None, [], None)
+    assert result.startswith('Error generating text'), result
+    assert ApiKeyPool._state.breakers[KEYS[0]].probe_started is None
+    assert ApiKeyPool.get_key() == KEYS[0]
+
+
+def test_shared_breaker_writes_go_through_flusher():
+    """With shared state a throttle is queued, not written on the caller, and reaches other workers on flush"""
+    from key_pool_state import SqliteKeyPoolState
+    path = os.path.join(tempfile.mkdtemp(), 'key_pool.db')
+    ApiKeyPool._shared = SqliteKeyPoolState(path)
+    try:
+        _fresh_pool()
+        ApiKeyPool.flush()
+        other_worker = SqliteKeyPoolState(path)
+        ApiKeyPool.rotate_key(KEYS[0])
+        assert ApiKeyPool._shared_pending, 'throttle should be queued for the flusher'
+        assert other_worker.load()['key_state'][KEYS[0]]['failures'] == 0
+        ApiKeyPool.get_key()  # must not reload and close the breaker before the flush
+        assert ApiKeyPool._state.breakers[KEYS[0]].state == _KeyBreaker.OPEN
+        ApiKeyPool.flush()
+        assert not ApiKeyPool._shared_pending
+        assert other_worker.load()['key_state'][KEYS[0]]['failures'] == 1
+    finally:
+        ApiKeyPool._shared = None
+        ApiKeyPool._shared_pending.clear()
+
+
+def main():
+    """Run the breaker and token bucket tests"""
+    print("🚀 Testing key pool token buckets and circuit breakers")
+    print("=" * 50)
+    failed = 0
+    for name, test in [(name, test) for name, test in globals().items() if name.startswith('test_')]:
+        try:
+            test()
+            print(f"✅ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {name}: {e!r}")
+    ApiKeyPool.flush()
+    print(f"\n{'✅ All breaker tests passed' if not failed else f'❌ {failed} breaker test(s) failed'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
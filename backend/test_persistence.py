@@ -8,7 +8,7 @@ import os
 sys.path.insert(0, os.path.dirname(__file__))
 
 # Import the ApiKeyPool class
-from app import ApiKeyPool
+from api_key_pool import ApiKeyPool
 
 def test_persistence():
     """Test the API key persistence functionality"""
@@ -20,10 +20,11 @@ def test_persistence():
     try:
         ApiKeyPool.init('test_app')
         
-        if ApiKeyPool._api_keys:
-            print(f"✅ Loaded {len(ApiKeyPool._api_keys)} keys from file")
-            print(f"🔑 Keys: {[key[:10] + '...' for key in ApiKeyPool._api_keys]}")
-            print(f"📊 Current index: {ApiKeyPool._current_key_index}")
+        keys = ApiKeyPool.get_keys()
+        if keys:
+            print(f"✅ Loaded {len(keys)} keys from file")
+            print(f"🔑 Keys: {[key[:10] + '...' for key in keys]}")
+            print(f"📊 Current index: {ApiKeyPool.get_pool_status()['current_key_index']}")
         else:
             print("❌ No keys loaded - file might not exist or be empty")
             
@@ -44,10 +45,10 @@ def test_persistence():
     # Test 3: Test key rotation
     print("\n3️⃣ Testing key rotation...")
     try:
-        old_index = ApiKeyPool._current_key_index
+        old_index = ApiKeyPool.get_pool_status()['current_key_index']
         success = ApiKeyPool.rotate_key()
         if success:
-            new_index = ApiKeyPool._current_key_index
+            new_index = ApiKeyPool.get_pool_status()['current_key_index']
             print(f"✅ Rotation successful: {old_index} → {new_index}")
         else:
             print("❌ Rotation failed")
@@ -58,6 +59,8 @@ def test_persistence():
     print("\n4️⃣ Checking file contents...")
     try:
         import json
+        # Pool state is written behind the request path; flush it before reading
+        ApiKeyPool.flush()
         if os.path.exists(ApiKeyPool._keys_file):
             with open(ApiKeyPool._keys_file, 'r') as f:
                 data = json.load(f)
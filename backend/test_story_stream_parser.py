@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Test script for StoryPageStreamParser, which splits streamed story text into pages
+
+Feeds the parser the way generate_text_stream hands it chunks: split at
+arbitrary points, including inside page headers. Also collected by pytest.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from story_parser import StoryPageStreamParser
+
+STORY = (
+    "Here is your story!\n"
+    "**Page 1:** Once upon a time a little explorer found a map.\n"
+    "It led far beyond the hills.\n"
+    "\n"
+    "# Page 2: The explorer packed a lunch.\n"
+    "page 3 : Off they went.\n"
+    "**Page 4**: The end."
+)
+
+
+def _parse(chunks):
+    parser = StoryPageStreamParser()
+    pages = []
+    for chunk in chunks:
+        pages.extend(parser.feed(chunk))
+    return pages + parser.close()
+
+
+def _scripts(pages):
+    return [(page['pageNumber'], page['script']) for page in pages]
+
+
+EXPECTED = [
+    (1, 'Once upon a time a little explorer found a map. It led far beyond the hills.'),
+    (2, 'The explorer packed a lunch.'),
+    (3, 'Off they went.'),
+    (4, 'The end.'),
+]
+
+
+def test_whole_text_in_one_chunk():
+    """Markdown header variants are recognised and continuation lines join their page"""
+    pages = _parse([STORY])
+    assert _scripts(pages) == EXPECTED, _scripts(pages)
+    assert all(page['imageUrl'] is None for page in pages)
+
+
+def test_any_chunk_split_gives_same_pages():
+    """Splitting the stream at every position, even inside a header, changes nothing"""
+    for cut in range(1, len(STORY)):
+        pages = _parse([STORY[:cut], STORY[cut:]])
+        assert _scripts(pages) == EXPECTED, (cut, _scripts(pages))
+
+
+def test_character_by_character():
+    """A stream of single characters still yields every page"""
+    assert _scripts(_parse(list(STORY))) == EXPECTED
+
+
+def test_page_emitted_when_next_header_arrives():
+    """A page is returned as soon as the next header line completes, not at the end"""
+    parser = StoryPageStreamParser()
+    assert parser.feed('Page 1: First page.\nMore of it.\n') == []
+    assert parser.feed('Page 2') == []  # header line not finished yet
+    completed = parser.feed(': Second.\n')
+    assert _scripts(completed) == [(1, 'First page. More of it.')]
+    assert _scripts(parser.close()) == [(2, 'Second.')]
+
+
+def test_text_before_first_header_is_ignored():
+    """Preamble lines never become a page of their own"""
+    pages = _parse(['Sure! Here is a story.\nTitle: The Map\n', 'Page 1: Start.\n'])
+    assert _scripts(pages) == [(1, 'Start.')]
+
+
+def test_close_without_pages():
+    """A stream with no headers produces no pages, and empty header-only pages are dropped"""
+    assert _parse(['Sorry, I cannot help with that.']) == []
+    assert _scripts(_parse(['Page 1:\n', 'Page 2: Only this one.'])) == [(2, 'Only this one.')]
+
+
+def main():
+    """Run the story stream parser tests"""
+    print("🚀 Testing StoryPageStreamParser")
+    print("=" * 50)
+    failed = 0
+    for name, test in [(name, test) for name, test in globals().items() if name.startswith('test_')]:
+        try:
+            test()
+            print(f"✅ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {name}: {e!r}")
+    print(f"\n{'✅ All parser tests passed' if not failed else f'❌ {failed} parser test(s) failed'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
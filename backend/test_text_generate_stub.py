@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Test that text requests reach Gemini, using the local stub instead of real keys
+
+Starts gemini_stub_server in-process, builds the app against it and calls
+/api/text/generate and /api/stories/generate (plain and streamed) through
+Flask's test client.
+A request that never reaches the stub (for example because the SDK rejects
+its arguments) fails here instead of turning into an "Error ..." string
+inside a successful response. Also collected by pytest.
+"""
+
+import os
+import sys
+import tempfile
+import contextlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gemini_stub_server import start_stub_server
+
+
+@contextlib.contextmanager
+def stub_backend(work_dir):
+    """Start the stub and import the app against it, inside work_dir
+
+    The services read their settings when app is imported, so this must be
+    the first import of app in the process.
+    """
+    stub = start_stub_server(port=0, text_latency='fixed:5', image_latency='fixed:5', seed=1)
+    try:
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setenv('GEMINI_API_BASE_URL', f'http://127.0.0.1:{stub.server_address[1]}')
+            patch.setenv('GEMINI_API_KEY', 'AIzaStubFallbackKey-xxxxxxxxxxxxxxxxxxxx')
+            patch.setenv('TEXT_CACHE_ENABLED', os.getenv('TEXT_CACHE_ENABLED', 'false'))
+            # Keys file, caches and job DB are created relative to the working directory
+            patch.chdir(work_dir)
+            import app as backend
+            try:
+                yield stub, backend.app.test_client()
+            finally:
+                # Write the keys file now, not at exit in whatever directory is current then
+                backend.ApiKeyPool.flush()
+    finally:
+        stub.shutdown()
+
+
+@pytest.fixture(scope='module')
+def stub_client(tmp_path_factory):
+    with stub_backend(tmp_path_factory.mktemp('backend')) as stub_and_client:
+        yield stub_and_client
+
+
+def _stub_text_calls(stub):
+    return stub.RequestHandlerClass.state.stats()['by_model'].get('gemini-2.0-flash', 0)
+
+
+def test_text_generate_reaches_stub(stub_client):
+    """/api/text/generate makes one upstream call and returns its text"""
+    stub, client = stub_client
+    before = _stub_text_calls(stub)
+    response = client.post('/api/text/generate', json={'prompt': 'Write a two-line poem about the moon'})
+    body = response.get_json()
+    assert response.status_code == 200, body
+    assert body['success'], body
+    assert not body['text'].startswith(('Error', 'Rate limit')), body['text']
+    assert 'Once upon a time' in body['text'], body['text']
+    assert _stub_text_calls(stub) == before + 1
+
+
+def test_story_generate_uses_upstream_text(stub_client):
+    """Story pages are built from the stub's text, not from an error string"""
+    stub, client = stub_client
+    before = _stub_text_calls(stub)
+    response = client.post('/api/stories/generate', json={'prompt': 'A shy dragon', 'theme': 'Fantasy'})
+    body = response.get_json()
+    assert response.status_code == 200, body
+    assert body['success'], body
+    assert _stub_text_calls(stub) > before
+    story = body['data']
+    assert not story['title'].startswith('Error'), story['title']
+    assert 'little explorer' in story['pages'][0]['script'], story['pages'][0]
+
+
+def test_story_stream_pages_come_from_upstream(stub_client):
+    """The SSE story stream sends the stub's pages, not fallback pages"""
+    stub, client = stub_client
+    before = _stub_text_calls(stub)
+    response = client.post('/api/stories/generate?stream=true', json={'prompt': 'A brave snail', 'theme': 'Adventure'})
+    events = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert _stub_text_calls(stub) > before
+    assert 'event: story' in events and 'event: error' not in events, events[:500]
+    assert 'little explorer' in events, events[:500]
+
+
+def main():
+    """Run the stub-backed text tests"""
+    print("🚀 Testing text generation against the Gemini stub")
+    print("=" * 50)
+    failed = 0
+    with tempfile.TemporaryDirectory() as work_dir, stub_backend(work_dir) as stub_and_client:
+        for name, test in [(name, test) for name, test in globals().items() if name.startswith('test_')]:
+            try:
+                test(stub_and_client)
+                print(f"✅ {name}")
+            except Exception as e:
+                failed += 1
+                print(f"❌ {name}: {e!r}")
+    print(f"\n{'✅ All stub text tests passed' if not failed else f'❌ {failed} stub text test(s) failed'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any
+
+class TextMemoCache:
+    """Bounded, TTL-aware in-process memoization cache for generated text"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, text), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(prompt: str,
+                 system_instruction: Optional[str] = None,
+                 generation_config: Optional[Dict[str, Any]] = None,
+                 images: Optional[List[bytes]] = None,
+                 model: str = '') -> str:
+        """Canonical hash of every input that influences the generated text"""
+        canonical = json.dumps({
+            'model': model,
+            'prompt': prompt,
+            'system_instruction': system_instruction,
+            'generation_config': generation_config or {},
+            'images': [
+                hashlib.sha256(image if isinstance(image, bytes) else str(image).encode('utf-8')).hexdigest()
+                for image in images or []
+            ]
+        }, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, text: str):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,173 @@
+import os
+import time
+import random
+import logging
+import itertools
+from contextvars import ContextVar
+from typing import Optional, List, Dict, Any
+
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+TRACE_LOG_SAMPLE_RATE = float(os.getenv('TRACE_LOG_SAMPLE_RATE', '0'))
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', '500'))
+
+logger = logging.getLogger(__name__)
+
+_trace: ContextVar[Optional['Trace']] = ContextVar('timing_trace', default=None)
+_parent: ContextVar[int] = ContextVar('timing_parent', default=0)
+
+
+class Span:
+    __slots__ = ('id', 'parent', 'name', 'start', 'duration')
+
+    def __init__(self, span_id: int, parent: int, name: str, start: float, duration: float):
+        self.id = span_id
+        self.parent = parent
+        self.name = name
+        self.start = start
+        self.duration = duration
+
+
+class Trace:
+    """Spans recorded while handling one request
+
+    Spans are appended from whichever thread or task finishes them;
+    list.append is atomic, so no lock is needed.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: List[Span] = []
+        self._ids = itertools.count(1)
+        self.dropped = 0
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def add(self, span: Span):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: total time per span name, with a count when it ran more than once
+
+        Spans that ran in parallel (page images) are summed, so they can add up
+        to more than total.
+        """
+        totals: Dict[str, List[float]] = {}
+        for span in list(self.spans):
+            entry = totals.setdefault(span.name, [0.0, 0])
+            entry[0] += span.duration
+            entry[1] += 1
+        metrics = [
+            f'{name};dur={duration * 1000:.1f}' + (f';desc="x{count}"' if count > 1 else '')
+            for name, (duration, count) in totals.items()
+        ]
+        metrics.append(f'total;dur={self.elapsed_ms():.1f}')
+        return ', '.join(metrics)
+
+    def tree(self) -> List[Dict[str, Any]]:
+        """Spans nested under their parents, in start order, offsets relative to the request start"""
+        nodes = {}
+        roots = []
+        for span in sorted(list(self.spans), key=lambda s: s.start):
+            nodes[span.id] = {
+                'name': span.name,
+                'start_ms': round((span.start - self.started) * 1000, 1),
+                'dur_ms': round(span.duration * 1000, 1),
+                'children': []
+            }
+        for span in self.spans:
+            parent = nodes.get(span.parent)
+            (parent['children'] if parent else roots).append(nodes[span.id])
+        return roots
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _ActiveSpan:
+    __slots__ = ('trace', 'name', 'id', 'start', 'token')
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.id = self.trace.next_id()
+        self.token = _parent.set(self.id)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        _parent.reset(self.token)
+        self.trace.add(Span(self.id, _parent.get(), self.name, self.start, duration))
+        return False
+
+
+def span(name: str):
+    """Context manager timing a block as a child of the enclosing span
+
+    Outside a traced request it is a shared no-op, so instrumented code costs
+    one context variable lookup when timing is off.
+    """
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _ActiveSpan(trace, name)
+
+
+def record(name: str, started: float):
+    """Record a leaf span that began at time.perf_counter() value started
+
+    For code that cannot hold a span open, such as a generator that yields
+    between start and finish.
+    """
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(Span(trace.next_id(), _parent.get(), name, started, time.perf_counter() - started))
+
+
+def start_trace():
+    """Begin a trace for the current request; returns a token for end_trace, or None when disabled"""
+    if not SERVER_TIMING_ENABLED:
+        return None
+    return _trace.set(Trace())
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+def _compact(nodes: List[Dict[str, Any]]) -> str:
+    return ', '.join(
+        f"{node['name']} {node['dur_ms']}ms" + (f" [{_compact(node['children'])}]" if node['children'] else '')
+        for node in nodes
+    )
+
+
+def end_trace(token, description: str = ''):
+    """Detach the request's trace from this thread and, if sampled, log its span tree"""
+    if token is None:
+        return
+    trace = _trace.get()
+    _trace.reset(token)
+    if trace is not None and TRACE_LOG_SAMPLE_RATE > 0 and random.random() < TRACE_LOG_SAMPLE_RATE:
+        tree = trace.tree()
+        logger.info('🧭 Trace %s %.1f ms: %s', description, trace.elapsed_ms(), _compact(tree),
+                    extra={'spans': tree, 'dropped_spans': trace.dropped})